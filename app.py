@@ -7,9 +7,9 @@ We try to keep this file relatively clean, referring often to /src folder, espec
 
 """
 
-from flask import Flask, request, jsonify, make_response, render_template, redirect
+from flask import Flask, request, jsonify, make_response, render_template, redirect, Response, stream_with_context
 from flask_cors import CORS, cross_origin
-from server_src import gpt_utils, server_utils
+from server_src import gpt_utils, server_utils, parse_utils, job_utils, metrics_utils, general_utils
 import datetime
 import uuid
 from server_src.setup_db import User, UserQuery, Style, UserQuestion, NotionRequest, DBVariable, db
@@ -33,9 +33,7 @@ app = Flask(__name__)
 cors = CORS(app)
 # app.config['CORS_HEADERS'] = 'Content-Type'
 
-data_path = os.path.abspath(os.path.join(os.getcwd(), os.pardir, 'data'))  # get absolute path to one folder up
-if os.getenv("ESSENCE_DATA_PATH"):
-    data_path = os.getenv("ESSENCE_DATA_PATH")
+data_path = general_utils.get_data_path()
 
 db_path = os.path.join(data_path, "database.db")
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///'+db_path
@@ -171,39 +169,28 @@ def notionvalidate():
 ########################
 ########################
 
-@app.route('/process', methods=['POST'])
-@jwt_required()
-def process():
+def throttle_user_request(user):
     '''
-    This is the main API route for the server, processing a URL into a structured output.
-    An important principle is that the server does not reveal all query data to the user, but only the essential output.
-    Therefore, we split the processing output to 1) output and 2) backend_output.
+    Returns a "please wait" message if the previous request of the user was less than TIME_DIFF_USER_REQ_SEC ago.
+    Otherwise, marks the time of the current request and returns None.
     '''
-
-    server_utils.print_log('PROCESS initiated! ' + str(datetime.datetime.now()))
-
-    args = request.get_json()
-    
-    if not server_utils.enough_input_params(args, ["url"]):
-        return cfg["ERROR_NOT_ENOUGH_PARAMS"]
-
-    server_utils.print_request_info(args)
-    
-    username = get_jwt_identity().lower()
-    user = User.query.filter_by(name=username).first()
-    user_id = user.id
-    
-    if not server_utils.user_has_credits(app, user, type='process'):
-        return {"output": "Out of compute quota."}
-
     current_datetime = datetime.datetime.now().astimezone().strftime(server_utils.date_time_format)
     time_diff = (datetime.datetime.strptime(current_datetime, server_utils.date_time_format) - datetime.datetime.strptime(user.last_query_date, server_utils.date_time_format)).total_seconds()
     if time_diff < cfg["TIME_DIFF_USER_REQ_SEC"]:
-        return {"output": "Please wait " + str(cfg["TIME_DIFF_USER_REQ_SEC"] - time_diff) + " seconds before sending another request."}
+        return "Please wait " + str(cfg["TIME_DIFF_USER_REQ_SEC"] - time_diff) + " seconds before sending another request."
     user.last_query_date = current_datetime
     db.session.commit()
+    return None
 
-    message = {
+def release_user_throttle(user):
+    '''
+    Allows the user to send another request right away - used when a request failed.
+    '''
+    user.last_query_date = (datetime.datetime.now().astimezone() - datetime.timedelta(seconds=(cfg["TIME_DIFF_USER_REQ_SEC"]+1))).strftime(server_utils.date_time_format)
+    db.session.commit()
+
+def get_process_message(args):
+    return {
         "URL": args["url"],
         "date": datetime.datetime.now().astimezone().strftime(server_utils.date_time_format), 
         "style": args["style"] if "style" in args else "",
@@ -212,22 +199,12 @@ def process():
         "web_html": args["web_html"] if "web_html" in args else "",
     }
 
-    should_use_cache, output = server_utils.should_use_cached_data(message, db, app, UserQuery, user_id)
-    if should_use_cache:
-        server_utils.print_log("Using cached data...", username, "Using cached data...")
-        output['gpt_credits'] = 0
-    else:
-        server_utils.print_log("Not using cached data, fresh processing...", username, "Not using cached data, fresh processing...")
-        output = gpt_utils.process_url(message, data_path, max_char_length=cfg["final_char_index"], model=cfg["MODEL"])
-    if output['status'] == 'FAILED':
-        server_utils.print_log("FAILED! RETURNING: " + str(output)[:150], username, "FAILED! RETURNING...")
-
-        # since this failed, we allow the user to send another request, so we update their last_query_date.
-        user.last_query_date = (datetime.datetime.now().astimezone() - datetime.timedelta(seconds=(cfg["TIME_DIFF_USER_REQ_SEC"]+1))).strftime(server_utils.date_time_format)
-        db.session.commit()
-
-        return {'output': output['output'], 'error': 'True'}
-
+def save_user_query(message, output, user_id, reserved_credits=0):
+    '''
+    Stores a successful processing output of process() as a UserQuery, charges the user, 
+    and returns the part of the output that is shown to the user.
+    reserved_credits: credits already taken for this output (see generate_outputs()); only the difference is charged, or refunded.
+    '''
     output["date"] = message["date"]
     query_id = str(uuid.uuid4())
 
@@ -247,13 +224,16 @@ def process():
             marked_text='',
             user_id=user_id,
             style_name=message["style"],
+            version=1,
+            refining=output.get('refining', False),
             )
     )
     user = User.query.filter_by(id=user_id).first()
-    user.remaining_queries = user.remaining_queries - output['gpt_credits']
+    user.remaining_queries = user.remaining_queries - (output['gpt_credits'] - reserved_credits)
     user.last_query_date = output["date"]
 
-    db.session.commit()
+    with metrics_utils.span('db_commit'):
+        db.session.commit()
 
     user_output = {
         'query_id': query_id,
@@ -261,10 +241,479 @@ def process():
         'title': output["title"],
         'output': output["output"],
         'error': 'False'}
+    if output.get('refining', False):
+        user_output['refining'] = True
+        user_output['version'] = 1
+    return user_output
+
+def save_user_question(args, answer, backend_answer, marked_text, web_html, user_id, date, chat_mode):
+    '''
+    Stores an answered question (chat questions are not stored) and charges the user for it.
+    '''
+    if not chat_mode:
+        db.session.add(UserQuestion(
+            id=str(uuid.uuid4()),
+            url=args["url"],
+            question=args["question"],
+            model_prompt=backend_answer["model_prompt"],
+            answer=answer,
+            date=date,
+            is_private=True if ((marked_text and len(marked_text) > 0) or len(web_html) > 0) else False,
+            from_cached_query=False,
+            good_bad_flag=0,
+            marked_text=backend_answer["marked_text"],
+            original_web=backend_answer["original_web"],
+            cleaned_text=backend_answer["cleaned_web"],
+            user_id=user_id,
+        ))
+
+    user = User.query.filter_by(id=user_id).first()
+    user.remaining_questions = user.remaining_questions - 1
+
+    with metrics_utils.span('db_commit'):
+        db.session.commit()
+
+@app.route('/process', methods=['POST'])
+@jwt_required()
+def process():
+    '''
+    This is the main API route for the server, processing a URL into a structured output.
+    An important principle is that the server does not reveal all query data to the user, but only the essential output.
+    Therefore, we split the processing output to 1) output and 2) backend_output.
+    With a list of styles instead of a style, the outputs are streamed, see process_styles().
+    With "progressive", a multi-pass summary is returned after its first pass and refined in the background, see run_process().
+    A cached output older than REVISE_AFTER_HOURS is checked against the current page, and revised if it changed, see revise_cached_output().
+    '''
+
+    server_utils.print_log('PROCESS initiated! ' + str(datetime.datetime.now()))
+
+    args = request.get_json()
+    
+    if not server_utils.enough_input_params(args, ["url"]):
+        return cfg["ERROR_NOT_ENOUGH_PARAMS"]
+
+    server_utils.print_request_info(args)
+    
+    username = get_jwt_identity().lower()
+    user = User.query.filter_by(name=username).first()
+    user_id = user.id
+    
+    if not server_utils.user_has_credits(app, user, type='process'):
+        return {"output": "Out of compute quota."}
+
+    if "styles" in args:
+        return process_styles(args, user, username)
+
+    wait_message = throttle_user_request(user)
+    if wait_message is not None:
+        return {"output": wait_message}
+
+    message = get_process_message(args)
+
+    should_use_cache, output = server_utils.should_use_cached_data(message, db, app, UserQuery, user_id)
+    if should_use_cache and not server_utils.should_revise_cached_data(message, output):
+        server_utils.print_log("Using cached data...", username, "Using cached data...")
+        output['gpt_credits'] = 0
+        user_output = save_user_query(message, output, user_id)
+        server_utils.print_log('PROCESS RETURNING TO USER: ' + str(user_output)[:150], username, 'PROCESS RETURNING TO USER')
+        return user_output
+
+    # a stale cached output is revised by run_process, in the job of an async request
+    if "async" in args and args["async"]:
+        return enqueue_job('process', user_id, message=message, user_id=user_id, username=username, revise_cached=should_use_cache)
+    return run_process(message, user_id, username, progressive="progressive" in args and args["progressive"], revise_cached=should_use_cache)
+
+def revise_cached_output(message, cached_output, username):
+    '''
+    The output for a request with a cached output (see server_utils.should_use_cached_data): the cached output if it is
+    recent or the page did not change, or else the cached output revised from the changes of the page (see gpt_utils.revise_output).
+    Returns None if the page changed too much to be revised, to process it from scratch.
+    '''
+    if not server_utils.should_revise_cached_data(message, cached_output):
+        cached_output['gpt_credits'] = 0
+        return cached_output
+
+    server_utils.print_log("Checking the cached data against the current page...", username, "Checking the cached data against the current page...")
+    revised_output = gpt_utils.revise_output(cached_output, message, data_path, model=cfg["MODEL"], cache_scope=server_utils.get_cache_scope(message, username))
+    if revised_output['status'] == 'UNCHANGED':
+        cached_output['gpt_credits'] = 0
+        return cached_output
+    if revised_output['status'] == 'FAILED':
+        return None
+    server_utils.print_log("Revised the cached data from the changes of the page.", username, "Revised the cached data from the changes of the page.")
+    return revised_output
+
+def run_process(message, user_id, username, progressive=False, revise_cached=False):
+    '''
+    The fresh processing of process(). Also run by the job workers, see job_worker.py.
+    progressive: a multi-pass summary returns after its first pass, with 'refining': True and 'version': 1.
+                 The other passes run in a job (see run_refine), which updates the UserQuery; see /querystatus and /querystream.
+    revise_cached: there is a stale cached output, which is revised from the changes of the page if it can be (see revise_cached_output).
+    '''
+    if revise_cached:
+        should_use_cache, output = server_utils.should_use_cached_data(message, db, app, UserQuery, user_id)
+        output = revise_cached_output(message, output, username) if should_use_cache else None
+        if output is not None:
+            user_output = save_user_query(message, output, user_id)
+            server_utils.print_log('PROCESS RETURNING TO USER: ' + str(user_output)[:150], username, 'PROCESS RETURNING TO USER')
+            return user_output
+
+    server_utils.print_log("Not using cached data, fresh processing...", username, "Not using cached data, fresh processing...")
+    cache_scope = server_utils.get_cache_scope(message, username)
+    output = gpt_utils.process_url(message, data_path, model=cfg["MODEL"], max_passes=1 if progressive else gpt_utils.MAX_GPT_PASSES, cache_scope=cache_scope)
+    if output['status'] == 'FAILED':
+        server_utils.print_log("FAILED! RETURNING: " + str(output)[:150], username, "FAILED! RETURNING...")
+
+        # since this failed, we allow the user to send another request, so we update their last_query_date.
+        release_user_throttle(User.query.filter_by(id=user_id).first())
+
+        return {'output': output['output'], 'error': 'True'}
+
+    user_output = save_user_query(message, output, user_id)
+    if user_output.get('refining', False):
+        job_utils.enqueue('refine', {
+            'query_id': user_output['query_id'], 'user_id': user_id, 'model': output['model'], 'cache_scope': cache_scope, 'charged_credits': output['gpt_credits']}, user_id)
 
     server_utils.print_log('PROCESS RETURNING TO USER: ' + str(user_output)[:150], username, 'PROCESS RETURNING TO USER')
 
     return user_output
+
+def run_refine(query_id, user_id, model, cache_scope, charged_credits):
+    '''
+    Runs the passes left by a progressive run_process, and writes the refined output to its UserQuery as the next version.
+    Run by the job workers, see job_worker.py. Raises on failure, so that the job is retried (from the last checkpoint).
+    charged_credits: what the user was charged for the first pass; the rest is charged here.
+    '''
+    user_query = UserQuery.query.filter_by(id=query_id).first()
+    if user_query is None or not user_query.refining:
+        return {'query_id': query_id, 'refined': False}
+
+    output = gpt_utils.refine_summary(user_query.cleaned_text, user_query.style_name, model, cache_scope=cache_scope)
+    if output['status'] == 'FAILED':
+        raise Exception('Refining query ' + query_id + ' failed: ' + output['output'])
+
+    user_query.model_output = output['model_output']
+    user_query.model_output_parsed = output['output']
+    user_query.version = user_query.version + 1
+    user_query.refining = False
+    user = User.query.filter_by(id=user_id).first()
+    user.remaining_queries = user.remaining_queries - max(0, output['gpt_credits'] - charged_credits)
+    with metrics_utils.span('db_commit'):
+        db.session.commit()
+    return {'query_id': query_id, 'refined': True, 'version': user_query.version}
+
+def stop_refining(query_id):
+    '''
+    Keeps the output a query has, when its refining failed for good.
+    '''
+    user_query = UserQuery.query.filter_by(id=query_id).first()
+    if user_query is not None:
+        user_query.refining = False
+        db.session.commit()
+
+def get_query_status(user_query):
+    return {
+        'query_id': user_query.id,
+        'version': user_query.version,
+        'refining': user_query.refining,
+        'title': user_query.title,
+        'output': user_query.model_output_parsed}
+
+def enqueue_job(kind, user_id, **payload):
+    '''
+    Leaves a request to a job worker (see job_worker.py) instead of running it in this web worker.
+    payload: keyword arguments of the handler of the kind. Returns the id of the job, to poll with /jobstatus.
+    '''
+    job_id = job_utils.enqueue(kind, payload, user_id)
+    server_utils.print_log('Enqueued ' + kind + ' job ' + job_id)
+    return {'job_id': job_id, 'status': 'queued'}
+
+def find_cached_outputs(messages, user_id):
+    '''
+    The cached outputs (see server_utils.should_use_cached_data) of a dict of messages, by the same keys.
+    A stale cached output is reused as it is: revising it (see revise_cached_output) fetches the page again and may call the model,
+    one page after the other, before any fresh output is sent - so only process() and processstream() revise.
+    '''
+    cached_outputs = {}
+    for key, message in messages.items():
+        should_use_cache, cached_output = server_utils.should_use_cached_data(message, db, app, UserQuery, user_id)
+        if should_use_cache:
+            cached_outputs[key] = cached_output
+    return cached_outputs
+
+def generate_outputs(messages, cached_outputs, user_id, username, run_fresh, result_event, key_field):
+    '''
+    The outputs of several messages (a dict), for process_styles() and processbatch(). A message with a cached output
+    (see find_cached_outputs) reuses it for free. The others are processed by run_fresh(keys), which returns the events of
+    server_utils.run_with_event_stream, with the output of each message in a result_event event - its key in output[key_field].
+    A query per message to process has to be reserved (see server_utils.reserve_user_queries); it is refunded if the message
+    fails or does not finish (an error, or the client went away), and a multi-pass output is charged the rest.
+    Yields (event_type, data) pairs:
+        'result' - the output of a message, same as the output of process(), with key_field. As soon as it is ready.
+        'error' - a message failed: {key_field, 'url', 'style', 'output', 'error'}
+        'keepalive' - see server_utils.run_with_event_stream
+        'done' - all messages are done: {'succeeded', 'failed'}. The last pair.
+    '''
+    keys_to_process = [key for key in messages if key not in cached_outputs]
+    settled = set()
+    failed = 0
+    try:
+        for key, cached_output in cached_outputs.items():
+            server_utils.print_log("Using cached data for " + str(key) + "...", username, "Using cached data...")
+            cached_output['gpt_credits'] = 0
+            yield 'result', {**save_user_query(messages[key], cached_output, user_id), key_field: key}
+
+        if len(keys_to_process) > 0:
+            server_utils.print_log("Fresh processing of " + str(len(keys_to_process)) + " outputs...", username, "Fresh processing of outputs...")
+            for event_type, data in run_fresh(keys_to_process):
+                if event_type == result_event and data['status'] == 'FAILED':
+                    server_utils.print_log("FAILED " + str(data[key_field]) + "! RETURNING: " + str(data)[:150], username, "FAILED! RETURNING...")
+                    server_utils.refund_user_queries(user_id, 1, db, User)
+                    settled.add(data[key_field])
+                    failed += 1
+                    yield 'error', {key_field: data[key_field], 'url': data['URL'], 'style': data['style'], 'output': data['output'], 'error': 'True'}
+                elif event_type == result_event:
+                    # settled once saved; a failed save is refunded with the unfinished messages
+                    user_output = save_user_query(messages[data[key_field]], data, user_id, reserved_credits=1)
+                    settled.add(data[key_field])
+                    server_utils.print_log('PROCESS RETURNING TO USER: ' + str(user_output)[:150], username, 'PROCESS RETURNING TO USER')
+                    yield 'result', {**user_output, key_field: data[key_field]}
+                elif event_type == 'error':
+                    yield 'error', {'output': data, 'error': 'True'}
+                elif event_type == 'keepalive':
+                    yield event_type, data
+    finally:
+        db.session.rollback()   # of a save that failed, if any; the saves commit themselves
+        unfinished = len(keys_to_process) - len(settled)
+        failed += unfinished
+        server_utils.refund_user_queries(user_id, unfinished, db, User)
+        server_utils.print_log('PROCESS OUTPUTS DONE: ' + str(len(messages) - failed) + ' succeeded, ' + str(failed) + ' failed', username, 'PROCESS OUTPUTS DONE')
+
+    if failed == len(messages):
+        # since this failed, we allow the user to send another request
+        release_user_throttle(User.query.filter_by(id=user_id).first())
+    yield 'done', {'succeeded': len(messages) - failed, 'failed': failed}
+
+def stream_outputs(outputs, **done_data):
+    '''
+    The (event_type, data) pairs of generate_outputs() as a response of server-sent events. done_data is added to the 'done' event.
+    '''
+    def generate():
+        for event_type, data in outputs:
+            yield server_utils.format_sse(event_type, {**data, **done_data} if event_type == 'done' else data)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def process_styles(args, user, username):
+    '''
+    process() with a list of styles (args["styles"]): the page is fetched once and the styles are summarized concurrently,
+    each saved as its own UserQuery. The response is a stream of server-sent events, as in processstream():
+        'result' - the output of one style, same as the output of process() with its 'style'. Sent as soon as the style is ready.
+        'error' - a style failed: {'style', 'url', 'output', 'error'}
+        'done' - all styles are done: {'styles', 'succeeded', 'failed'}. Ends the stream.
+    A query per style that is not cached is reserved up front, and refunded if the style fails (see generate_outputs()).
+    '''
+    styles = args["styles"]
+    if not isinstance(styles, list) or len(styles) == 0 or not all(isinstance(style, str) for style in styles):
+        return cfg["ERROR_NOT_ENOUGH_PARAMS"]
+    styles = list(dict.fromkeys(styles))  # without repetitions, in order
+    if len(styles) > cfg["MAX_STYLES_PER_REQUEST"]:
+        return {"output": "ERROR: at most " + str(cfg["MAX_STYLES_PER_REQUEST"]) + " styles per request.", "error": "True"}
+
+    wait_message = throttle_user_request(user)
+    if wait_message is not None:
+        return {"output": wait_message}
+
+    user_id = user.id
+    messages = {style: get_process_message({**args, "style": style}) for style in styles}
+    cached_outputs = find_cached_outputs(messages, user_id)
+    styles_to_process = len(messages) - len(cached_outputs)
+    if not server_utils.reserve_user_queries(user_id, styles_to_process, db, User):
+        release_user_throttle(user)
+        return {"output": "Out of compute quota for " + str(styles_to_process) + " styles.", "error": "True"}
+
+    message = messages[styles[0]]
+
+    def run_fresh(styles_to_process):
+        return server_utils.run_with_event_stream(gpt_utils.process_url_styles, message, styles_to_process, data_path, model=cfg["MODEL"], cache_scope=server_utils.get_cache_scope(message, username))
+
+    return stream_outputs(generate_outputs(messages, cached_outputs, user_id, username, run_fresh, 'style_result', 'style'), styles=styles)
+
+@app.route('/processbatch', methods=['POST'])
+@jwt_required()
+def processbatch():
+    '''
+    Processes a batch of URLs, e.g. a reading list: args["items"] is a list of {"url", "style"} ("style" may be given once, in args).
+    The URLs are fetched concurrently, with a limit per domain, and summarized under a limit of concurrent summaries (see gpt_utils.process_batch).
+    A query per URL that is not cached is reserved up front, and refunded if the URL fails (see generate_outputs()).
+    A batch runs for about as long as its URLs take one summary slot after the other, so a streamed batch is limited to
+    MAX_STREAMED_BATCH_URLS, to end well inside the worker timeout. Larger batches, up to MAX_BATCH_URLS, have to be "async":
+    they run in a job (see run_process_batch), and the response is its id, to poll with /jobstatus.
+    Otherwise the response is a stream of server-sent events, as in processstream():
+        'result' - the output of one URL, same as the output of process(), with the 'index' of the item. Sent as soon as it is ready.
+        'error' - a URL failed: {'index', 'url', 'style', 'output', 'error'}
+        'done' - all URLs are done: {'succeeded', 'failed'}. Ends the stream.
+    '''
+    server_utils.print_log('PROCESS BATCH initiated! ' + str(datetime.datetime.now()))
+
+    args = request.get_json()
+
+    if not server_utils.enough_input_params(args, ["items"]) or not isinstance(args["items"], list) or len(args["items"]) == 0:
+        return cfg["ERROR_NOT_ENOUGH_PARAMS"]
+    items = []
+    for item in args["items"]:
+        if not isinstance(item, dict) or not isinstance(item.get("url"), str) or item["url"] == '':
+            return cfg["ERROR_NOT_ENOUGH_PARAMS"]
+        items.append({"url": item["url"], "style": item.get("style", args.get("style", ""))})
+    is_async = "async" in args and args["async"]
+    if len(items) > cfg["MAX_BATCH_URLS"]:
+        return {"output": "ERROR: at most " + str(cfg["MAX_BATCH_URLS"]) + " URLs per request.", "error": "True"}
+    if not is_async and len(items) > cfg["MAX_STREAMED_BATCH_URLS"]:
+        return {"output": "ERROR: at most " + str(cfg["MAX_STREAMED_BATCH_URLS"]) + " URLs per request, or " + str(cfg["MAX_BATCH_URLS"]) + " with async.", "error": "True"}
+
+    server_utils.print_request_info(args)
+
+    username = get_jwt_identity().lower()
+    user = User.query.filter_by(name=username).first()
+    user_id = user.id
+
+    wait_message = throttle_user_request(user)
+    if wait_message is not None:
+        return {"output": wait_message}
+
+    messages = {i: get_process_message({"url": item["url"], "style": item["style"]}) for i, item in enumerate(items)}
+    if is_async:
+        return enqueue_job('processbatch', user_id, messages=list(messages.values()), user_id=user_id, username=username)
+
+    cached_outputs = find_cached_outputs(messages, user_id)
+    urls_to_process = len(messages) - len(cached_outputs)
+    if not server_utils.reserve_user_queries(user_id, urls_to_process, db, User):
+        release_user_throttle(user)
+        return {"output": "Out of compute quota for " + str(urls_to_process) + " URLs.", "error": "True"}
+
+    return stream_outputs(generate_outputs(messages, cached_outputs, user_id, username, lambda indices: run_batch(messages, indices), 'batch_result', 'index'))
+
+def run_process_batch(messages, user_id, username):
+    '''
+    The job of an "async" processbatch(), run by the job workers (see job_worker.py). messages: the list of process messages.
+    Returns the outputs at once: {'results', 'errors', 'succeeded', 'failed'}, with the events of the stream of processbatch().
+    The outputs saved by an attempt that raised are cached, so a retry reuses them for free.
+    '''
+    messages = dict(enumerate(messages))
+    cached_outputs = find_cached_outputs(messages, user_id)
+    urls_to_process = len(messages) - len(cached_outputs)
+    if not server_utils.reserve_user_queries(user_id, urls_to_process, db, User):
+        release_user_throttle(User.query.filter_by(id=user_id).first())
+        return {"output": "Out of compute quota for " + str(urls_to_process) + " URLs.", "error": "True"}
+
+    batch_output = {'results': [], 'errors': []}
+    for event_type, data in generate_outputs(messages, cached_outputs, user_id, username, lambda indices: run_batch(messages, indices), 'batch_result', 'index'):
+        if event_type == 'result':
+            batch_output['results'].append(data)
+        elif event_type == 'error':
+            batch_output['errors'].append(data)
+        elif event_type == 'done':
+            batch_output.update(data)
+    return batch_output
+
+def run_batch(messages, indices):
+    '''
+    The events of gpt_utils.process_batch for the messages of the indices, with the 'index' of each output in messages.
+    '''
+    for event_type, data in server_utils.run_with_event_stream(gpt_utils.process_batch, [messages[i] for i in indices], data_path, model=cfg["MODEL"]):
+        if event_type == 'batch_result':
+            data['index'] = indices[data['index']]
+        yield event_type, data
+
+@app.route('/processstream', methods=['POST'])
+@jwt_required()
+def processstream():
+    '''
+    Streaming variant of process(). The response is a stream of server-sent events:
+        'reset' - a new completion starts (e.g. the next pass); the text and items streamed so far should be discarded
+        'token' - the next piece of the model output
+        'item' - a structured item (key-value pair, table row, bullet) parsed from the output so far, see parse_utils.IncrementalResponseParser
+        'progress' - a status message
+        'result' - the final output, same as the output of process(). Ends the stream.
+        'error' - ends the stream in case of failure.
+    The final parsing and the DB write happen at the end of the stream.
+    '''
+    server_utils.print_log('PROCESS STREAM initiated! ' + str(datetime.datetime.now()))
+
+    args = request.get_json()
+    
+    if not server_utils.enough_input_params(args, ["url"]):
+        return cfg["ERROR_NOT_ENOUGH_PARAMS"]
+
+    server_utils.print_request_info(args)
+    
+    username = get_jwt_identity().lower()
+    user = User.query.filter_by(name=username).first()
+    user_id = user.id
+    
+    if not server_utils.user_has_credits(app, user, type='process'):
+        return {"output": "Out of compute quota."}
+
+    wait_message = throttle_user_request(user)
+    if wait_message is not None:
+        return {"output": wait_message}
+
+    message = get_process_message(args)
+
+    should_use_cache, cached_output = server_utils.should_use_cached_data(message, db, app, UserQuery, user_id)
+
+    def generate():
+        if should_use_cache:
+            if server_utils.should_revise_cached_data(message, cached_output):
+                yield server_utils.format_sse('progress', 'Checking the page for changes...')
+            output = revise_cached_output(message, cached_output, username)
+            if output is not None:
+                server_utils.print_log("Using cached data...", username, "Using cached data...")
+                yield server_utils.format_sse('result', save_user_query(message, output, user_id))
+                return
+
+        server_utils.print_log("Not using cached data, fresh processing...", username, "Not using cached data, fresh processing...")
+        parser = parse_utils.IncrementalResponseParser(style=message["style"])
+        for event_type, data in server_utils.run_with_event_stream(gpt_utils.process_url, message, data_path, model=cfg["MODEL"], cache_scope=server_utils.get_cache_scope(message, username)):
+            if event_type == 'reset':
+                parser = parse_utils.IncrementalResponseParser(style=message["style"])
+                yield server_utils.format_sse(event_type, data)
+            elif event_type == 'token':
+                yield server_utils.format_sse(event_type, data)
+                if parser is None:
+                    continue
+                # the items are a preview - the result is parsed from the whole output - so a parsing error only stops them
+                try:
+                    items = parser.feed(data)
+                except Exception as e:
+                    print('Problem parsing the streamed output: ', e)
+                    parser, items = None, []
+                for item in items:
+                    yield server_utils.format_sse('item', item)
+            elif event_type == 'error':
+                release_user_throttle(user)
+                yield server_utils.format_sse('error', {'output': data, 'error': 'True'})
+            elif event_type == 'result' and data['status'] == 'FAILED':
+                server_utils.print_log("FAILED! RETURNING: " + str(data)[:150], username, "FAILED! RETURNING...")
+                release_user_throttle(user)
+                yield server_utils.format_sse('error', {'output': data['output'], 'error': 'True'})
+            elif event_type == 'result':
+                # the items of the last line, and those that wait for the end of the output to know its mode
+                if parser is not None:
+                    try:
+                        items, _ = parser.close()
+                    except Exception as e:
+                        print('Problem parsing the streamed output: ', e)
+                        items = []
+                    for item in items:
+                        yield server_utils.format_sse('item', item)
+                user_output = save_user_query(message, data, user_id)
+                server_utils.print_log('PROCESS STREAM RETURNING TO USER: ' + str(user_output)[:150], username, 'PROCESS STREAM RETURNING TO USER')
+                yield server_utils.format_sse('result', user_output)
+            else:
+                yield server_utils.format_sse(event_type, data)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
     
 @app.route('/processmarked', methods=['POST'])
 @jwt_required()
@@ -291,12 +740,9 @@ def processmarked():
     if not server_utils.user_has_credits(app, user, type='process'):
         return {"output": "Out of compute quota."}
 
-    current_datetime = datetime.datetime.now().astimezone().strftime(server_utils.date_time_format)
-    time_diff = (datetime.datetime.strptime(current_datetime, server_utils.date_time_format) - datetime.datetime.strptime(user.last_query_date, server_utils.date_time_format)).total_seconds()
-    if time_diff < cfg["TIME_DIFF_USER_REQ_SEC"]:
-        return {"output": "Please wait " + str(cfg["TIME_DIFF_USER_REQ_SEC"] - time_diff) + " seconds before sending another request."}
-    user.last_query_date = current_datetime
-    db.session.commit()
+    wait_message = throttle_user_request(user)
+    if wait_message is not None:
+        return {"output": wait_message}
 
     message = {
         "URL": args["url"],
@@ -311,13 +757,31 @@ def processmarked():
     should_use_cache, output = server_utils.should_use_cached_data(message, db, app, UserQuery, user_id)
     if should_use_cache:
         server_utils.print_log("Using cached data...", username, "Using cached data...")
-    else:
-        server_utils.print_log("Not using cached data, fresh processing...", username, "Not using cached data, fresh processing...")
-        output = gpt_utils.process_url(message, data_path, max_char_length=cfg["final_char_index"], model=cfg["MODEL"])
+        return save_marked_query(message, output, user_id, username)
+
+    if "async" in args and args["async"]:
+        return enqueue_job('processmarked', user_id, message=message, user_id=user_id, username=username)
+    return run_process_marked(message, user_id, username)
+
+def run_process_marked(message, user_id, username):
+    '''
+    The fresh processing of processmarked(). Also run by the job workers, see job_worker.py.
+    '''
+    server_utils.print_log("Not using cached data, fresh processing...", username, "Not using cached data, fresh processing...")
+    output = gpt_utils.process_url(message, data_path, model=cfg["MODEL"], cache_scope=server_utils.get_cache_scope(message, username))
     if output['status'] == 'FAILED':
         server_utils.print_log("FAILED! RETURNING: " + str(output)[:150], username, "FAILED! RETURNING...")
+
+        # since this failed, we allow the user to send another request, as in run_process()
+        release_user_throttle(User.query.filter_by(id=user_id).first())
+
         return {'output': output['output']}
+    return save_marked_query(message, output, user_id, username)
 
+def save_marked_query(message, output, user_id, username):
+    '''
+    Stores the output of processmarked() as a private UserQuery, charges the user, and returns the part of the output that is shown to the user.
+    '''
     output["date"] = message["date"]
     query_id = str(uuid.uuid4())
 
@@ -339,10 +803,12 @@ def processmarked():
             style_name=message["style"],
             )
     )
+    user = User.query.filter_by(id=user_id).first()
     user.remaining_queries = user.remaining_queries - output['gpt_credits']
     user.last_query_date = output["date"]
 
-    db.session.commit()
+    with metrics_utils.span('db_commit'):
+        db.session.commit()
 
     user_output = {
         'query_id': query_id,
@@ -583,10 +1049,6 @@ def question():
 
     if not server_utils.enough_input_params(args, ["question", "url"]):    
         return {"Error": "Not enough parameters provided."}
-    marked_text = args["marked_text"] if ("marked_text" in args) else None
-    qa_list = args["qa_list"] if ("qa_list" in args) else None
-    chat_mode = (args["chat_mode"] if ("chat_mode" in args) else False) or args["question"].startswith('/chat')
-    web_html = server_utils.handle_web_html(args)
  
     username = get_jwt_identity().lower()
     user_id = User.query.filter_by(name=username).first().id
@@ -596,50 +1058,41 @@ def question():
         return {"output": "Out of compute quota.", "answer": "Out of compute quota.", "supporting_quote": ""}
 
     current_datetime = datetime.datetime.now().astimezone().strftime(server_utils.date_time_format)
-    time_diff = (datetime.datetime.strptime(current_datetime, server_utils.date_time_format) - datetime.datetime.strptime(user.last_query_date, server_utils.date_time_format)).total_seconds()
-    if time_diff < cfg["TIME_DIFF_USER_REQ_SEC"]:
-        return {"answer": "Please wait " + str(cfg["TIME_DIFF_USER_REQ_SEC"] - time_diff) + " seconds before sending another request.", "supporting_quote": ''}
-    user.last_query_date = current_datetime
-    db.session.commit()
+    wait_message = throttle_user_request(user)
+    if wait_message is not None:
+        return {"answer": wait_message, "supporting_quote": ''}
+
+    if "async" in args and args["async"]:
+        return enqueue_job('question', user_id, args=args, user_id=user_id, username=username, current_datetime=current_datetime)
+    return run_question(args, user_id, username, current_datetime)
+
+def run_question(args, user_id, username, current_datetime):
+    '''
+    Answers the question of question(), and stores it. Also run by the job workers, see job_worker.py.
+    '''
+    marked_text = args["marked_text"] if ("marked_text" in args) else None
+    qa_list = args["qa_list"] if ("qa_list" in args) else None
+    chat_mode = (args["chat_mode"] if ("chat_mode" in args) else False) or args["question"].startswith('/chat')
+    web_html = server_utils.handle_web_html(args)
+    user = User.query.filter_by(id=user_id).first()
 
     if not chat_mode:
         print('QUESTION about PAGE')
         answer, backend_answer, supporting_quote = server_utils.get_answer_on_url(args["question"], args["url"], marked_text, web_html, qa_list, data_path, username)
         if backend_answer == {}:
             print('BACKEND ANSWER EMPTY')
-            user.last_query_date = (datetime.datetime.now().astimezone() - datetime.timedelta(seconds=(cfg["TIME_DIFF_USER_REQ_SEC"]+1))).strftime(server_utils.date_time_format)
-            db.session.commit()
+            release_user_throttle(user)
             return {"answer": answer, "supporting_quote": '', 'error': True}
-        
-        db.session.add(UserQuestion(
-            id=str(uuid.uuid4()),
-            url=args["url"],
-            question=args["question"],
-            model_prompt=backend_answer["model_prompt"],
-            answer=answer,
-            date=current_datetime,
-            is_private=True if ((marked_text and len(marked_text) > 0) or len(web_html) > 0) else False,
-            from_cached_query=False,
-            good_bad_flag=0,
-            marked_text=backend_answer["marked_text"],
-            original_web=backend_answer["original_web"],
-            cleaned_text=backend_answer["cleaned_web"],
-            user_id=user_id,
-        ))
     else:
         print('QUESTION for CHAT')
         answer, backend_answer = server_utils.get_answer_on_chat(args["question"], qa_list, data_path, username)
         if backend_answer == {}:
-            user.last_query_date = (datetime.datetime.now().astimezone() - datetime.timedelta(seconds=(cfg["TIME_DIFF_USER_REQ_SEC"]+1))).strftime(server_utils.date_time_format)
-            db.session.commit()
+            release_user_throttle(user)
             return {"answer": answer, "supporting_quote": '', 'error': True}
         
         supporting_quote = ''
 
-
-    user.remaining_questions = user.remaining_questions - 1
-
-    db.session.commit()
+    save_user_question(args, answer, backend_answer, marked_text, web_html, user_id, current_datetime, chat_mode)
 
     print('RETURNED ANSWER ON QUESTION')
     if user.user_type == 'admin':
@@ -647,6 +1100,159 @@ def question():
 
     return {"answer": answer, "supporting_quote": supporting_quote, 'error': False}
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    '''
+    Stage latencies, model calls and tokens, and the per-process counters, of all the worker processes - in the Prometheus text format.
+    The scraper has to send METRICS_TOKEN as a bearer token; without METRICS_TOKEN set, the metrics are not served at all.
+    '''
+    metrics_token = os.getenv("METRICS_TOKEN")
+    if not metrics_token:
+        return {"Error": "Metrics are not enabled."}, 404
+    if request.headers.get('Authorization') != 'Bearer ' + metrics_token:
+        return {"Error": "Unauthorized."}, 401
+    return Response(metrics_utils.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/jobstatus', methods=['POST'])
+@jwt_required()
+def jobstatus():
+    '''
+    Status of a job of an "async" request (process, processbatch, processmarked or question): 'queued', 'running', 'done' or 'failed'.
+    When done, 'result' is the output the request would have returned.
+    '''
+    args = request.get_json()
+    if not server_utils.enough_input_params(args, ["job_id"]):
+        return cfg["ERROR_NOT_ENOUGH_PARAMS"]
+
+    username = get_jwt_identity().lower()
+    user_id = User.query.filter_by(name=username).first().id
+
+    job = job_utils.get_job(args["job_id"])
+    if job is None or job['user_id'] != str(user_id):
+        return {"Error": "Job not found."}
+
+    job_status = {'job_id': job['id'], 'status': job['status']}
+    if job['status'] == 'done':
+        job_status['result'] = job['result']
+    elif job['status'] == 'failed':
+        job_status['error'] = 'ERROR: problem occured. Try again.'
+    return job_status
+
+@app.route('/querystatus', methods=['POST'])
+@jwt_required()
+def querystatus():
+    '''
+    The current output of a query, with its version - to poll a progressive process() until 'refining' is False.
+    '''
+    args = request.get_json()
+    if not server_utils.enough_input_params(args, ["query_id"]):
+        return cfg["ERROR_NOT_ENOUGH_PARAMS"]
+
+    username = get_jwt_identity().lower()
+    user_id = User.query.filter_by(name=username).first().id
+
+    user_query = UserQuery.query.filter_by(id=args["query_id"], user_id=user_id).first()
+    if user_query is None:
+        return {"Error": "Query not found."}
+    return get_query_status(user_query)
+
+@app.route('/querystream', methods=['POST'])
+@jwt_required()
+def querystream():
+    '''
+    Push variant of querystatus(). The response is a stream of server-sent events:
+        'result' - the status of the query (see querystatus), whenever its version is newer than args["version"] (default: 0)
+        'done' - the query is not refining anymore, or QUERY_STREAM_MAX_SECONDS passed. Ends the stream.
+    QUERY_STREAM_MAX_SECONDS is kept well below the worker and proxy timeouts, and an open stream holds a web worker, so a
+    stream that ends with 'refining' True is to be opened again with the 'version' of its 'done' event - or polled with /querystatus.
+    '''
+    args = request.get_json()
+    if not server_utils.enough_input_params(args, ["query_id"]):
+        return cfg["ERROR_NOT_ENOUGH_PARAMS"]
+
+    username = get_jwt_identity().lower()
+    user_id = User.query.filter_by(name=username).first().id
+    query_id = args["query_id"]
+    if UserQuery.query.filter_by(id=query_id, user_id=user_id).first() is None:
+        return {"Error": "Query not found."}
+
+    def generate():
+        last_version = args["version"] if "version" in args else 0
+        start_time = time.time()
+        while True:
+            # end the transaction, so that the next read sees what the job worker wrote
+            db.session.rollback()
+            user_query = UserQuery.query.filter_by(id=query_id).first()
+            if user_query.version > last_version:
+                last_version = user_query.version
+                yield server_utils.format_sse('result', get_query_status(user_query))
+            if not user_query.refining or time.time() - start_time > cfg["QUERY_STREAM_MAX_SECONDS"]:
+                yield server_utils.format_sse('done', {'query_id': query_id, 'version': last_version, 'refining': user_query.refining})
+                return
+            yield server_utils.format_sse('keepalive')
+            time.sleep(cfg["QUERY_STREAM_POLL_SECONDS"])
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/questionstream', methods=['POST'])
+@jwt_required()
+def questionstream():
+    '''
+    Streaming variant of question(). The response is a stream of server-sent events, as in processstream().
+    The final 'result' event has the same payload as the output of question().
+    '''
+    server_utils.print_log('question stream POST initiated')
+    
+    args = request.get_json()
+    
+    server_utils.print_request_info(args)
+
+    if not server_utils.enough_input_params(args, ["question", "url"]):    
+        return {"Error": "Not enough parameters provided."}
+    marked_text = args["marked_text"] if ("marked_text" in args) else None
+    qa_list = args["qa_list"] if ("qa_list" in args) else None
+    chat_mode = (args["chat_mode"] if ("chat_mode" in args) else False) or args["question"].startswith('/chat')
+    web_html = server_utils.handle_web_html(args)
+ 
+    username = get_jwt_identity().lower()
+    user = User.query.filter_by(name=username).first()
+    user_id = user.id
+
+    if not server_utils.user_has_credits(app, user, type='question'):
+        return {"output": "Out of compute quota.", "answer": "Out of compute quota.", "supporting_quote": ""}
+
+    current_datetime = datetime.datetime.now().astimezone().strftime(server_utils.date_time_format)
+    wait_message = throttle_user_request(user)
+    if wait_message is not None:
+        return {"answer": wait_message, "supporting_quote": ''}
+
+    def generate():
+        if not chat_mode:
+            events = server_utils.run_with_event_stream(server_utils.get_answer_on_url, args["question"], args["url"], marked_text, web_html, qa_list, data_path, username)
+        else:
+            events = server_utils.run_with_event_stream(server_utils.get_answer_on_chat, args["question"], qa_list, data_path, username)
+
+        for event_type, data in events:
+            if event_type == 'error':
+                release_user_throttle(user)
+                yield server_utils.format_sse('error', {"answer": data, "supporting_quote": '', 'error': True})
+            elif event_type == 'result':
+                if not chat_mode:
+                    answer, backend_answer, supporting_quote = data
+                else:
+                    (answer, backend_answer), supporting_quote = data, ''
+                if backend_answer == {}:
+                    release_user_throttle(user)
+                    yield server_utils.format_sse('error', {"answer": answer, "supporting_quote": '', 'error': True})
+                    continue
+                save_user_question(args, answer, backend_answer, marked_text, web_html, user_id, current_datetime, chat_mode)
+                print('RETURNED STREAMED ANSWER ON QUESTION')
+                yield server_utils.format_sse('result', {"answer": answer, "supporting_quote": supporting_quote, 'error': False})
+            else:
+                yield server_utils.format_sse(event_type, data)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/exportsession', methods=['POST'])
 @jwt_required()
 def exportsession():
@@ -721,7 +1327,7 @@ def getautotitle():
     if not server_utils.enough_input_params(args, ["titles"]):    
         return {"Error": "Not enough parameters provided."}
     
-    title = server_utils.get_auto_title(args["titles"])
+    title = server_utils.get_auto_title(args["titles"], get_jwt_identity().lower())
     if title is None:
         return {"Error": "Cannot generate title.", "title": ""}
     else:
@@ -0,0 +1,94 @@
+'''
+Compares the extractive stage (styles with 'compression: extractive', see nlp_utils.compress_text_extractive) with chained passes
+on long texts: number of model calls, tokens sent, and latency. Calls go to a local stand-in for the model API,
+whose latency is modeled as a fixed cost plus a cost per prompt token and per completion token.
+
+Run from the repository root, with text files to summarize (or without, for a synthetic long article):
+    python -m benchmarks.bench_extractive [--style travel] [--files a.txt b.txt] [--time-scale 0.1]
+'''
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from types import MappingProxyType
+
+from benchmarks.bench_llm_client import start_server, StandInHandler
+
+BASE_SECONDS = 0.3
+SECONDS_PER_PROMPT_TOKEN = 0.0002
+SECONDS_PER_COMPLETION_TOKEN = 0.02
+COMPLETION_TOKENS = 250
+
+TOPICS = ['the harbor', 'the old town', 'the railway', 'the market', 'the museum', 'the river walk', 'the castle', 'the vineyards']
+TEMPLATES = [
+    'We spent a long morning around {topic}, which was busier than we expected.',
+    'Getting to {topic} took about {n} minutes by bus from the center.',
+    'Tickets for {topic} cost {n} euros, and they are cheaper online.',
+    'Most guides recommend visiting {topic} early, before the tour groups arrive.',
+    'The food stalls near {topic} were the best value of the whole trip.',
+    'In the evening, {topic} is quieter and the light is beautiful.',
+    'Our host told us the story of {topic}, going back {n} years.',
+    'If you only have one day, {topic} is the place to prioritize.',
+]
+
+def synthetic_article(n_paragraphs=120, seed=0):
+    rng = random.Random(seed)
+    paragraphs = []
+    for _ in range(n_paragraphs):
+        topic = rng.choice(TOPICS)
+        paragraphs.append(' '.join(rng.choice(TEMPLATES).format(topic=topic, n=rng.randint(2, 90)) for _ in range(rng.randint(3, 6))))
+    return '\n'.join(paragraphs)
+
+class MeteredHandler(StandInHandler):
+    '''A stand-in whose latency depends on the size of the call; records the tokens of every prompt.'''
+    delay = 0
+    prompt_tokens = []
+    time_scale = 1.0
+    count_tokens = None
+
+    def answer(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        prompt = body['prompt'] if 'prompt' in body else ''.join(message['content'] for message in body['messages'])
+        n_tokens = self.count_tokens(prompt)
+        MeteredHandler.prompt_tokens.append(n_tokens)
+        time.sleep(self.time_scale * (BASE_SECONDS + n_tokens * SECONDS_PER_PROMPT_TOKEN + COMPLETION_TOKENS * SECONDS_PER_COMPLETION_TOKEN))
+        self.send_json(200, {'choices': [{'message': {'role': 'assistant', 'content': 'Summary: the text.'}, 'text': 'Summary: the text.'}]})
+
+def set_compression(style_utils, style, compression):
+    style_utils.styles = MappingProxyType({**style_utils.styles, style: style_utils.styles[style]._replace(compression=compression)})
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--style', default='travel', help='a style with chained passes')
+    parser.add_argument('--model', default='gpt-3.5-turbo')
+    parser.add_argument('--files', nargs='*', default=[])
+    parser.add_argument('--time-scale', type=float, default=0.1, help='scales the modeled latency of the stand-in')
+    args = parser.parse_args()
+
+    server = start_server(0, MeteredHandler)
+    os.environ['OPENAI_API_BASE'] = 'http://127.0.0.1:%d/v1' % server.server_address[1]
+    os.environ['OPENAI_API_KEY'] = 'stand-in'
+    os.environ.pop('AZURE_OPENAI_KEY', None)
+    os.environ['ESSENCE_DATA_PATH'] = tempfile.mkdtemp()    # an empty completion cache
+    from server_src import gpt_utils, style_utils, token_utils, rate_limit_utils
+    rate_limit_utils.RATE_LIMITS.clear()
+    MeteredHandler.count_tokens = staticmethod(lambda text: token_utils.count_tokens(text, args.model))
+    MeteredHandler.time_scale = args.time_scale
+
+    texts = [(path, open(path).read()) for path in args.files] or [('synthetic article', synthetic_article())]
+    for name, text in texts:
+        print(f'{name}: {len(text)} characters, {token_utils.count_tokens(text, args.model)} tokens')
+        for compression in [None, 'extractive']:
+            set_compression(style_utils, args.style, compression)
+            MeteredHandler.prompt_tokens = []
+            start = time.perf_counter()
+            gpt_utils.get_gpt_summary(text, style=args.style, model=args.model)
+            seconds = time.perf_counter() - start
+            print(f'  {compression or "chained":10}: {len(MeteredHandler.prompt_tokens)} call(s), {sum(MeteredHandler.prompt_tokens)} prompt tokens, '
+                  f'{seconds:.2f} s (modeled latency x{args.time_scale})')
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+Compares the latency of chat calls with and without hedging (see server_src/llm_utils), against two local stand-ins:
+an "Azure" primary with a heavy tail (most calls are quick, a few take seconds) and a steady "OpenAI" secondary.
+
+Run from the repository root:
+    python -m benchmarks.bench_hedging [--calls N] [--tail-fraction F] [--min-delay S]
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.bench_llm_client import start_server
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def run_calls(llm_utils, n_calls, n_threads):
+    messages = [{'role': 'user', 'content': 'Hi'}]
+    def timed_call(_):
+        start = time.perf_counter()
+        llm_utils.chat_completion(messages, 'gpt-3.5-turbo')
+        return time.perf_counter() - start
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(timed_call, range(n_calls)))
+
+def report(name, latencies):
+    print(f'{name}: p50 {percentile(latencies, 50) * 1000:.0f} ms, p95 {percentile(latencies, 95) * 1000:.0f} ms, p99 {percentile(latencies, 99) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--tail-fraction', type=float, default=0.03, help='fraction of primary calls that are slow')
+    parser.add_argument('--tail-seconds', type=float, default=3)
+    parser.add_argument('--min-delay', type=float, default=0.2, help='HEDGE_MIN_DELAY_SECONDS for the run (scaled down with the stand-in latencies)')
+    args = parser.parse_args()
+
+    def primary_delay():
+        return args.tail_seconds if random.random() < args.tail_fraction else random.uniform(0.05, 0.15)
+    primary = start_server(primary_delay)
+    secondary = start_server(lambda: random.uniform(0.08, 0.12))
+
+    os.environ['AZURE_OPENAI_ENDPOINT'] = 'http://127.0.0.1:%d' % primary.server_address[1]
+    os.environ['AZURE_OPENAI_KEY'] = 'stand-in'
+    os.environ['OPENAI_API_BASE'] = 'http://127.0.0.1:%d/v1' % secondary.server_address[1]
+    os.environ['OPENAI_API_KEY'] = 'stand-in'
+    os.environ['ESSENCE_DATA_PATH'] = tempfile.mkdtemp()
+    from server_src import llm_utils, rate_limit_utils   # read the environment at import
+    rate_limit_utils.RATE_LIMITS.clear()
+    llm_utils.HEDGE_MIN_DELAY_SECONDS = args.min_delay
+
+    secondary_backend = llm_utils.secondary_backend
+    llm_utils.secondary_backend = None
+    report('Primary only', run_calls(llm_utils, args.calls, args.threads))
+
+    llm_utils.secondary_backend = secondary_backend
+    latencies = run_calls(llm_utils, args.calls, args.threads)
+    report('Hedged      ', latencies)
+    stats = llm_utils.get_hedge_stats()
+    print(f'Hedged {stats["hedged"]} of {stats["requests"]} calls ({stats["hedged"] / max(1, stats["requests"]) * 100:.1f}%), '
+          f'secondary won {stats["hedge_wins"]}, skipped {stats["hedges_skipped"]}; '
+          f'hedge delay {llm_utils.get_hedge_delay(llm_utils.primary_backend, "chat", "gpt-3.5-turbo", {}) * 1000:.0f} ms')
+
+if __name__ == '__main__':
+    main()
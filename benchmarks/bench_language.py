@@ -0,0 +1,189 @@
+'''
+Compares nlp_utils.detect_language with the heuristic it replaced (langdetect, unseeded, on up to six slices of the text):
+accuracy on labeled texts, how often the answer changes between runs, and time per call - cold, and memoized as when
+the same document gets several questions.
+
+Run from the repository root, with text files labeled by language (or without, for the built-in samples):
+    python -m benchmarks.bench_language [--files en:a.txt de:b.txt] [--runs 5]
+'''
+import argparse
+import time
+
+from langdetect import DetectorFactory, detect
+
+EN_ARTICLE = (
+    'The city has changed a lot over the last twenty years. What used to be a quiet port is now one of the busiest places on the coast, '
+    'and most of the people who move here come for work rather than for the beaches. The old harbor was rebuilt after the war, '
+    'but the streets around it still follow the medieval plan, which makes driving there a bad idea. If you arrive by train, '
+    'walk down from the station through the market; it takes about fifteen minutes and you pass some of the best bakeries in town. '
+    'The museum on the hill is worth a visit even if you are not interested in history, because the view from its terrace covers the whole bay. '
+    'In the evening, the restaurants along the river fill up quickly, so it is better to book a table or to eat early. '
+    'Prices are higher than in the villages nearby, but the quality of the fish is hard to beat. Those who stay longer than a weekend should '
+    'take the ferry to the islands, where there are no cars and the pace of life is very different from the city.'
+)
+EN_TECHNICAL = (
+    'To configure the cache, set the threshold and the default timeout in config.yml. The server reads these values at start-up, '
+    'so changes require a restart of all worker processes. Entries are stored as files under the data folder; when the number of '
+    'files exceeds the threshold, the oldest ones are removed. The API returns HTTP 429 when the rate limit is reached, and clients '
+    'should retry with exponential backoff. Each request must include an Authorization header with a valid JWT. '
+    'The response body is a JSON object with the fields status, output and gpt_credits. Errors are returned with status ERROR '
+    'and a message that can be shown to the user as is. See the README for an example of a request and its response.'
+)
+EN_SHORT = 'Click here to read the full story about the election results.'
+DE_ARTICLE = (
+    'Die Stadt hat sich in den letzten zwanzig Jahren stark verändert. Was früher ein ruhiger Hafen war, ist heute einer der '
+    'belebtesten Orte an der Küste, und die meisten Menschen, die hierher ziehen, kommen wegen der Arbeit und nicht wegen der Strände. '
+    'Der alte Hafen wurde nach dem Krieg wieder aufgebaut, aber die Straßen rundherum folgen noch immer dem mittelalterlichen Plan. '
+    'Wer mit dem Zug ankommt, sollte vom Bahnhof durch den Markt hinunter laufen; das dauert etwa fünfzehn Minuten. '
+    'Das Museum auf dem Hügel lohnt sich auch für diejenigen, die sich nicht für Geschichte interessieren, denn die Aussicht von '
+    'seiner Terrasse umfasst die ganze Bucht. Am Abend füllen sich die Restaurants am Fluss schnell, also sollte man einen Tisch reservieren.'
+)
+FR_ARTICLE = (
+    "La ville a beaucoup changé au cours des vingt dernières années. Ce qui était autrefois un port tranquille est aujourd'hui l'un "
+    "des endroits les plus animés de la côte, et la plupart des gens qui s'y installent viennent pour le travail plutôt que pour les plages. "
+    "Le vieux port a été reconstruit après la guerre, mais les rues autour suivent toujours le plan médiéval. Si vous arrivez en train, "
+    "descendez de la gare en traversant le marché ; cela prend environ quinze minutes. Le musée sur la colline vaut la visite, même si "
+    "l'histoire ne vous intéresse pas, car la vue depuis sa terrasse couvre toute la baie. Le soir, les restaurants au bord de la rivière "
+    "se remplissent vite, il vaut donc mieux réserver une table ou dîner tôt."
+)
+ES_ARTICLE = (
+    'La ciudad ha cambiado mucho en los últimos veinte años. Lo que antes era un puerto tranquilo es ahora uno de los lugares más '
+    'concurridos de la costa, y la mayoría de las personas que se mudan aquí vienen por trabajo y no por las playas. El puerto viejo '
+    'fue reconstruido después de la guerra, pero las calles a su alrededor todavía siguen el plano medieval. Si llega en tren, baje '
+    'desde la estación por el mercado; se tarda unos quince minutos. El museo de la colina merece una visita aunque no le interese la '
+    'historia, porque la vista desde su terraza abarca toda la bahía. Por la noche, los restaurantes junto al río se llenan rápido, '
+    'así que es mejor reservar una mesa o cenar temprano.'
+)
+IT_ARTICLE = (
+    'La città è cambiata molto negli ultimi vent\'anni. Quello che un tempo era un porto tranquillo è oggi uno dei luoghi più '
+    'frequentati della costa, e la maggior parte delle persone che si trasferiscono qui viene per lavoro e non per le spiagge. '
+    'Il porto vecchio è stato ricostruito dopo la guerra, ma le strade intorno seguono ancora la pianta medievale. Se arrivate in treno, '
+    'scendete dalla stazione attraverso il mercato; ci vogliono circa quindici minuti. Il museo sulla collina merita una visita anche '
+    'se la storia non vi interessa, perché la vista dalla sua terrazza abbraccia tutta la baia.'
+)
+PT_ARTICLE = (
+    'A cidade mudou muito nos últimos vinte anos. O que antes era um porto tranquilo é hoje um dos lugares mais movimentados da costa, '
+    'e a maioria das pessoas que se mudam para cá vem pelo trabalho e não pelas praias. O porto velho foi reconstruído depois da guerra, '
+    'mas as ruas à sua volta ainda seguem o traçado medieval. Se chegar de comboio, desça da estação pelo mercado; demora cerca de quinze '
+    'minutos. O museu na colina vale a visita mesmo para quem não se interessa por história, porque a vista do seu terraço abrange toda a baía.'
+)
+NL_ARTICLE = (
+    'De stad is de afgelopen twintig jaar sterk veranderd. Wat vroeger een rustige haven was, is nu een van de drukste plekken aan de kust, '
+    'en de meeste mensen die hier komen wonen, komen voor het werk en niet voor de stranden. De oude haven is na de oorlog herbouwd, '
+    'maar de straten eromheen volgen nog steeds het middeleeuwse plan. Wie met de trein aankomt, loopt het best vanaf het station door de '
+    'markt naar beneden; dat duurt ongeveer vijftien minuten. Het museum op de heuvel is een bezoek waard, ook als je niet van geschiedenis '
+    'houdt, want het uitzicht vanaf het terras is prachtig.'
+)
+DA_ARTICLE = (
+    'Byen har ændret sig meget i løbet af de sidste tyve år. Det, der engang var en stille havn, er i dag et af de travleste steder på kysten, '
+    'og de fleste, der flytter hertil, kommer for at arbejde og ikke for strandene. Den gamle havn blev genopbygget efter krigen, men gaderne '
+    'omkring den følger stadig den middelalderlige plan. Hvis du kommer med toget, så gå fra stationen gennem markedet; det tager omkring '
+    'femten minutter. Museet på bakken er et besøg værd, også for dem der ikke interesserer sig for historie.'
+)
+RU_ARTICLE = (
+    'За последние двадцать лет город сильно изменился. То, что раньше было тихим портом, теперь одно из самых оживлённых мест на побережье, '
+    'и большинство людей, которые сюда переезжают, приезжают ради работы, а не ради пляжей. Старую гавань восстановили после войны, '
+    'но улицы вокруг неё по-прежнему следуют средневековому плану. Если вы приезжаете на поезде, спуститесь от вокзала через рынок; '
+    'это занимает около пятнадцати минут. Музей на холме стоит посетить, даже если вас не интересует история.'
+)
+HE_ARTICLE = (
+    'העיר השתנתה מאוד בעשרים השנים האחרונות. מה שהיה פעם נמל שקט הוא היום אחד המקומות העמוסים ביותר בחוף, '
+    'ורוב האנשים שעוברים לגור כאן מגיעים בשביל העבודה ולא בשביל החופים. הנמל הישן נבנה מחדש אחרי המלחמה, '
+    'אבל הרחובות סביבו עדיין שומרים על התכנון מימי הביניים. אם מגיעים ברכבת, כדאי לרדת מהתחנה דרך השוק; '
+    'זה לוקח כרבע שעה. המוזיאון על הגבעה שווה ביקור גם למי שלא מתעניין בהיסטוריה.'
+)
+ZH_ARTICLE = (
+    '这座城市在过去二十年里发生了很大的变化。过去的安静港口，如今已成为海岸上最繁忙的地方之一，大多数搬到这里的人是为了工作，而不是为了海滩。'
+    '老港口在战后重建，但周围的街道仍然保留着中世纪的布局。如果您乘火车到达，可以从车站穿过市场走下去，大约需要十五分钟。'
+    '山上的博物馆值得一去，即使您对历史不感兴趣，因为从它的露台上可以看到整个海湾。晚上，河边的餐馆很快就会坐满，所以最好提前订座。'
+)
+JA_ARTICLE = (
+    'この街はここ二十年で大きく変わりました。かつて静かな港だった場所は、今では海岸で最もにぎやかな場所の一つになり、'
+    'ここに移り住む人の多くは海辺ではなく仕事のためにやって来ます。古い港は戦後に再建されましたが、周りの通りは今も中世の町割りのままです。'
+    '電車で来る場合は、駅から市場を抜けて歩くのがおすすめで、十五分ほどかかります。丘の上の博物館は、歴史に興味がなくても訪れる価値があります。'
+)
+DE_BANNER = 'Wir verwenden Cookies, um Ihnen das beste Nutzererlebnis zu bieten. Alle akzeptieren. Einstellungen. Datenschutzerklärung. Impressum. '
+
+SAMPLES = [
+    ('en', 'English article', EN_ARTICLE * 3),
+    ('en', 'English technical', EN_TECHNICAL * 2),
+    ('en', 'English, short', EN_SHORT),
+    ('en', 'English with German banner', DE_BANNER * 6 + EN_ARTICLE * 3 + DE_BANNER * 6),
+    ('non-en', 'German', DE_ARTICLE * 2),
+    ('non-en', 'French', FR_ARTICLE * 2),
+    ('non-en', 'Spanish', ES_ARTICLE * 2),
+    ('non-en', 'Italian', IT_ARTICLE * 2),
+    ('non-en', 'Portuguese', PT_ARTICLE * 2),
+    ('non-en', 'Dutch', NL_ARTICLE * 2),
+    ('non-en', 'Danish', DA_ARTICLE * 2),
+    ('non-en', 'Russian', RU_ARTICLE * 2),
+    ('non-en', 'Hebrew', HE_ARTICLE * 2),
+    ('non-en', 'Chinese', ZH_ARTICLE * 2),
+    ('non-en', 'Japanese', JA_ARTICLE * 2),
+    ('non-en', 'German with English quotes', DE_ARTICLE + ' "The best view on the coast," says the guide. ' + DE_ARTICLE),
+]
+
+def legacy_text_not_in_english(text):
+    # the heuristic detect_language replaced
+    try:
+        if (detect(text[:150]) == 'en' or detect(text[len(text)//2:len(text)//2+150]) == 'en' or detect(text[-150:]) == 'en'):
+            return False
+        if (detect(text[:500]) == 'en' or detect(text[len(text)//2:len(text)//2+500]) == 'en' or detect(text[-500:]) == 'en'):
+            return False
+    except Exception:
+        return True
+    return True
+
+def legacy_detect_language(text):
+    return 'en' if not legacy_text_not_in_english(text) else 'non-en'
+
+def evaluate(detector, samples, n_runs):
+    correct, unstable = 0, []
+    for label, name, text in samples:
+        answers = [detector(text) for _ in range(n_runs)]
+        correct += answers[0] == label
+        if len(set(answers)) > 1:
+            unstable.append(name)
+        if answers[0] != label:
+            print(f'    wrong on {name}: {answers[0]}')
+    return correct, unstable
+
+def time_per_call(detector, samples, n_calls, before_call=None):
+    seconds = 0
+    for _ in range(n_calls):
+        for _, _, text in samples:
+            if before_call is not None:
+                before_call()
+            start = time.perf_counter()
+            detector(text)
+            seconds += time.perf_counter() - start
+    return seconds / (n_calls * len(samples))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', nargs='*', default=[], help='label:path, label is en or non-en')
+    parser.add_argument('--runs', type=int, default=5, help='runs per text, to find answers that change between runs')
+    args = parser.parse_args()
+
+    from server_src import nlp_utils
+    samples = [(spec.split(':', 1)[0], spec.split(':', 1)[1], open(spec.split(':', 1)[1]).read()) for spec in args.files] or SAMPLES
+
+    DetectorFactory.seed = None     # as before: langdetect unseeded
+    print('Legacy heuristic:')
+    correct, unstable = evaluate(legacy_detect_language, samples, args.runs)
+    print(f'  {correct}/{len(samples)} correct, {len(unstable)} text(s) with answers changing between runs {unstable}')
+    legacy_seconds = time_per_call(legacy_detect_language, samples, args.runs)
+    DetectorFactory.seed = 0
+
+    print('detect_language:')
+    correct, unstable = evaluate(lambda text: (nlp_utils.detect_language_of_samples.cache_clear(), nlp_utils.detect_language(text))[1], samples, args.runs)
+    print(f'  {correct}/{len(samples)} correct, {len(unstable)} text(s) with answers changing between runs {unstable}')
+    cold_seconds = time_per_call(nlp_utils.detect_language, samples, args.runs, before_call=nlp_utils.detect_language_of_samples.cache_clear)
+    nlp_utils.detect_language(samples[0][2])
+    memoized_seconds = time_per_call(nlp_utils.detect_language, samples, args.runs)
+
+    print(f'Time per call: legacy {legacy_seconds * 1000:.2f} ms, detect_language {cold_seconds * 1000:.3f} ms, '
+          f'memoized {memoized_seconds * 1000:.3f} ms')
+
+if __name__ == '__main__':
+    main()
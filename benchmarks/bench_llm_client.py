@@ -0,0 +1,175 @@
+'''
+Runs server_src/llm_utils against a local stand-in for the model API, and compares pooled (keep-alive) calls with
+a new connection per call - the way the openai module was used before.
+
+The stand-in answers chat, completion and embedding calls (streamed or not) after a fixed delay, and counts the
+connections it accepted. Also checks that 429s and timeouts surface as LLMRateLimitError and LLMTimeout.
+
+Run from the repository root:
+    python -m benchmarks.bench_llm_client [--calls N] [--delay-ms D]
+'''
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import httpx
+
+connections = {'count': 0}
+connections_lock = threading.Lock()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive
+    delay = 0.02                    # seconds, or a function returning them
+
+    def setup(self):
+        super().setup()
+        with connections_lock:
+            connections['count'] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, chunks):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for data in [json.dumps(chunk) for chunk in chunks] + ['[DONE]']:
+            event = ('data: ' + data + '\n\n').encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(event), event))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_POST(self):
+        try:
+            self.answer()
+        except BrokenPipeError:
+            pass    # the client gave up, e.g. on the timeout check
+
+    def answer(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.delay() if callable(self.delay) else self.delay)
+        path = urlparse(self.path).path  # Azure calls carry an api-version query
+        model = body.get('model', '')
+        if model == 'rate-limited':
+            return self.send_json(429, {'error': {'message': 'Rate limit reached'}})
+        if model == 'slow':
+            time.sleep(2)
+        if path.endswith('/chat/completions'):
+            words = ['Hello', ' from', ' the', ' stand-in']
+            if body.get('stream'):
+                return self.send_stream([{'choices': [{'delta': {'content': word}}]} for word in words] + [{'choices': [{'delta': {}}]}])
+            return self.send_json(200, {'choices': [{'message': {'role': 'assistant', 'content': ''.join(words)}}]})
+        if path.endswith('/completions'):
+            if body.get('stream'):
+                return self.send_stream([{'choices': [{'text': word}]} for word in ['Hello', ' there']])
+            return self.send_json(200, {'choices': [{'text': 'Hello there'}]})
+        if path.endswith('/embeddings'):
+            return self.send_json(200, {'data': [{'embedding': [0.1, 0.2, 0.3], 'index': i} for i in range(len(body['input']))]})
+        return self.send_json(404, {'error': {'message': 'Not found'}})
+
+def start_server(delay, handler_class=StandInHandler):
+    handler = type(handler_class.__name__, (handler_class,), {'delay': staticmethod(delay) if callable(delay) else delay})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def reset_connections():
+    with connections_lock:
+        connections['count'] = 0
+
+def check_calls(llm_utils):
+    messages = [{'role': 'user', 'content': 'Hi'}]
+    assert llm_utils.chat_completion(messages, 'gpt-3.5-turbo')['choices'][0]['message']['content'] == 'Hello from the stand-in'
+    assert llm_utils.completion('Hi', 'text-davinci-003')['choices'][0]['text'] == 'Hello there'
+    assert len(llm_utils.embeddings(['a', 'b'], 'text-embedding-ada-002')['data']) == 2
+    streamed = ''.join(chunk['choices'][0]['delta'].get('content') or '' for chunk in llm_utils.chat_completion(messages, 'gpt-3.5-turbo', stream=True))
+    assert streamed == 'Hello from the stand-in'
+    streamed = ''.join(chunk['choices'][0]['text'] for chunk in llm_utils.completion('Hi', 'text-davinci-003', stream=True))
+    assert streamed == 'Hello there'
+
+    try:
+        llm_utils.chat_completion(messages, 'rate-limited')
+        raise AssertionError('expected LLMRateLimitError')
+    except llm_utils.LLMRateLimitError as e:
+        assert e.status_code == 429
+    try:
+        llm_utils.chat_completion(messages, 'slow', timeout=0.5)
+        raise AssertionError('expected LLMTimeout')
+    except llm_utils.LLMTimeout:
+        pass
+
+    async def check_async():
+        response = await llm_utils.achat_completion(messages, 'gpt-3.5-turbo')
+        assert response['choices'][0]['message']['content'] == 'Hello from the stand-in'
+        assert len((await llm_utils.aembeddings(['a'], 'text-embedding-ada-002'))['data']) == 1
+        chunks = [chunk async for chunk in await llm_utils.achat_completion(messages, 'gpt-3.5-turbo', stream=True)]
+        assert ''.join(chunk['choices'][0]['delta'].get('content') or '' for chunk in chunks) == 'Hello from the stand-in'
+    asyncio.run(check_async())
+    print('Calls: chat, completion, embeddings, streaming, async and error mapping OK')
+
+def unpooled_call(llm_utils, messages):
+    # a new connection for every call, like the openai module without a shared session
+    url, headers, body = llm_utils.get_request('openai', 'chat', 'gpt-3.5-turbo', {'messages': messages})
+    with httpx.Client() as client:
+        return client.post(url, headers=headers, json=body).json()
+
+def time_calls(call, n_calls, n_threads):
+    reset_connections()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(lambda _: call(), range(n_calls)))
+    return time.perf_counter() - start, connections['count']
+
+async def time_async_calls(llm_utils, messages, n_calls, n_concurrent):
+    semaphore = asyncio.Semaphore(n_concurrent)
+    async def call():
+        async with semaphore:
+            return await llm_utils.achat_completion(messages, 'gpt-3.5-turbo')
+    reset_connections()
+    start = time.perf_counter()
+    await asyncio.gather(*[call() for _ in range(n_calls)])
+    return time.perf_counter() - start, connections['count']
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8, help='concurrent calls')
+    parser.add_argument('--delay-ms', type=float, default=5, help='response delay of the stand-in')
+    args = parser.parse_args()
+
+    server = start_server(args.delay_ms / 1000)
+    os.environ['OPENAI_API_BASE'] = 'http://127.0.0.1:%d/v1' % server.server_address[1]
+    os.environ['OPENAI_API_KEY'] = 'stand-in'
+    os.environ.pop('AZURE_OPENAI_KEY', None)
+    os.environ['ESSENCE_DATA_PATH'] = tempfile.mkdtemp()   # for the rate limiter
+    from server_src import llm_utils   # reads the environment at import
+
+    check_calls(llm_utils)
+
+    messages = [{'role': 'user', 'content': 'Hi'}]
+    seconds, n_connections = time_calls(lambda: unpooled_call(llm_utils, messages), args.calls, args.threads)
+    print(f'New connection per call: {args.calls} calls in {seconds:.2f} s ({seconds / args.calls * 1000:.1f} ms/call), {n_connections} connections')
+    seconds, n_connections = time_calls(lambda: llm_utils.chat_completion(messages, 'gpt-3.5-turbo'), args.calls, args.threads)
+    print(f'Pooled (sync):           {args.calls} calls in {seconds:.2f} s ({seconds / args.calls * 1000:.1f} ms/call), {n_connections} connections')
+    seconds, n_connections = asyncio.run(time_async_calls(llm_utils, messages, args.calls, args.threads))
+    print(f'Pooled (async):          {args.calls} calls in {seconds:.2f} s ({seconds / args.calls * 1000:.1f} ms/call), {n_connections} connections')
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
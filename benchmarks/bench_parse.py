@@ -0,0 +1,95 @@
+'''
+Checks that server_src/parse_utils.parse_gpt_response gives the same output as the earlier implementation (legacy_parse.py),
+and compares their throughput - on parse_corpus.json, and on long synthetic tables.
+
+The one intended difference: the earlier implementation left its '<<STT>>' / '<<|HTTP|>>' placeholders in keys and in plain text
+output (e.g. "10<<STT>>30"), so these are restored in its output before comparing.
+
+Run from the repository root:
+    python -m benchmarks.bench_parse [--repeat N]
+'''
+import argparse
+import contextlib
+import io
+import json
+import time
+
+from server_src import parse_utils
+from benchmarks import legacy_parse
+
+CORPUS_PATH = 'benchmarks/parse_corpus.json'
+SYNTHETIC_ROWS = [100, 1000, 10000]
+
+def restore_placeholders(s):
+    return s.replace('<<STT>>', ':').replace('<<|HTTP|>>', ':').replace('<<CAT>>', ':')
+
+def normalize_legacy_output(parsed):
+    normalized = []
+    for item in parsed:
+        key, value = item['key'], item['value']
+        if isinstance(key, str):
+            key = restore_placeholders(key)
+        if isinstance(value, str):
+            value = restore_placeholders(value)
+        normalized.append({'key': key, 'value': value})
+    return normalized
+
+def quiet(func, *args, **kwargs):
+    # the parsers print a line for bullet points
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+def time_parser(parse_func, entries, repeat):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            for entry in entries:
+                parse_func(entry['output'], style=entry['style'])
+    return time.perf_counter() - start
+
+def synthetic_table(n_rows):
+    lines = ['Destinations: Lisbon, Porto', 'Itinerary:', 'Day | Destination | Activities | Notes']
+    for i in range(n_rows):
+        lines.append(f'{i+1} | City {i} (area: {i % 7}) | Walk, museum, dinner at 19:30 | see https://example.com/day/{i}')
+    lines.append('Budget: Not available')
+    return '\n'.join(lines)
+
+def check_equivalence(entries):
+    mismatches = 0
+    for i, entry in enumerate(entries):
+        expected = normalize_legacy_output(quiet(legacy_parse.parse_gpt_response, entry['output'], style=entry['style']))
+        parsed = quiet(parse_utils.parse_gpt_response, entry['output'], style=entry['style'])
+        if parsed != expected:
+            mismatches += 1
+            print(f'MISMATCH in entry {i} ({entry["style"]}):')
+            print('  expected:', expected)
+            print('  parsed:  ', parsed)
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200, help='number of passes over the corpus for timing')
+    args = parser.parse_args()
+
+    with open(CORPUS_PATH, 'r') as f:
+        corpus = json.load(f)
+    synthetic = [{'style': 'travel', 'output': synthetic_table(n_rows)} for n_rows in SYNTHETIC_ROWS]
+
+    mismatches = check_equivalence(corpus + synthetic)
+    print(f'Equivalence: {len(corpus) + len(synthetic) - mismatches}/{len(corpus) + len(synthetic)} outputs match')
+
+    n_chars = sum(len(entry['output']) for entry in corpus) * args.repeat
+    legacy_seconds = time_parser(legacy_parse.parse_gpt_response, corpus, args.repeat)
+    new_seconds = time_parser(parse_utils.parse_gpt_response, corpus, args.repeat)
+    print(f'Corpus ({len(corpus)} outputs x {args.repeat}): legacy {n_chars / legacy_seconds / 1e6:.2f} MB/s, new {n_chars / new_seconds / 1e6:.2f} MB/s, speedup {legacy_seconds / new_seconds:.1f}x')
+
+    for n_rows, entry in zip(SYNTHETIC_ROWS, synthetic):
+        legacy_seconds = time_parser(legacy_parse.parse_gpt_response, [entry], 1)
+        new_seconds = time_parser(parse_utils.parse_gpt_response, [entry], 1)
+        print(f'Table of {n_rows} rows ({len(entry["output"])} chars): legacy {legacy_seconds * 1000:.1f} ms, new {new_seconds * 1000:.1f} ms')
+
+    if mismatches > 0:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
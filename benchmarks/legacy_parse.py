@@ -0,0 +1,197 @@
+'''
+The earlier implementation of parse_gpt_response (before server_src/parse_utils.py), kept as a reference for bench_parse.py.
+It runs several regex substitutions over the whole output and three character loops per line, and builds strings by concatenation.
+'''
+import re
+
+from server_src.parse_utils import BULLETS_GENERIC_STYLE_NAME, TABULARIZE_STYLE_NAME, VALUES_TO_DROP, is_likely_key_val_list, parse_gpt_response_bullets
+
+def look_for_delimiter_inside_paranthesis(s, delimiter, replacement_delimiter):
+    open_paranthesis_flag = False
+    new_s = ''
+    for c in s:
+        if c == '(':
+            open_paranthesis_flag = True
+        elif c == ')':
+            open_paranthesis_flag = False
+        if c == delimiter and open_paranthesis_flag:
+            new_s += replacement_delimiter
+            continue
+        new_s += c
+    return new_s
+
+def look_for_delimiter_inside_table(s, table_delimiter, delimiter, replacement_delimiter):
+    inside_table = False
+    new_s = ''
+    prev = 0
+    for i, c in enumerate(s):
+        if c == table_delimiter:
+            inside_table = True
+        elif c == delimiter and inside_table:
+            new_s += s[prev:i] + replacement_delimiter
+            prev = i + 1
+    new_s += s[prev:]
+    return new_s
+
+def look_for_delimiter_after_comma(s, delimiter, replacement_delimiter, comma=','):
+    comma_occ = []
+    colon_occ = []
+    for i, c in enumerate(s):
+        if c == comma:
+            comma_occ.append(i)
+        elif c == delimiter:
+            colon_occ.append(i)
+
+    replace_colon = []
+    for colon_acc_i in colon_occ[::-1]:
+        while len(comma_occ) > 0 and comma_occ[-1] > colon_acc_i:
+            comma_occ.pop()
+        if len(comma_occ) == 0:
+            break
+        replace_colon.append(comma_occ[-1])
+
+    new_s = ''
+    prev = 0
+    for replace_colon_i in replace_colon:
+        new_s += s[prev:replace_colon_i].strip() + replacement_delimiter
+        prev = replace_colon_i + 1
+    new_s += s[prev:].strip()
+    return new_s
+
+def parse_gpt_response(s, style='', category_delimiter=':', table_delimiter='|', special_time_token='<<STT>>', special_cat_token='<<CAT>>', special_https_token='<<|HTTP|>>', values_to_drop=VALUES_TO_DROP):
+    """Converts a string, usually of the form 'key1:value1,key2:value2', to a dictionary/JSON."""
+    
+    if style == BULLETS_GENERIC_STYLE_NAME:
+        if not is_likely_key_val_list(s):
+            if s.strip()[:s.find('\n')].count(':') == 1:
+                s = '- ' + s.strip()
+            print('Parsing as bullet points.')
+            parsed_s = parse_gpt_response_bullets(s)
+            return parsed_s
+        # remove incoming '-'. It's a thing that ChatGPT does.
+        s = '\n'.join([line if not line.startswith('- ') else line[2:] for line in s.splitlines()])
+    
+    if style == TABULARIZE_STYLE_NAME:
+        if not s.startswith('Table:'):
+            s = 'Table:\n' + s
+
+    stripped_s = s.strip()
+    
+    # replace places in stripped_s in which a digit occurs before and after ':' with special_time_token
+    stripped_s = re.sub(r'(\d+)(:)(\d+)', r'\1'+special_time_token+r'\3', stripped_s)
+    
+    # replace places where 'http://' or 'https://' occurs with special_https_token
+    url_pattern = re.compile(r'(https?://[^\s:]+(?::\d+)?(?:/[^\s]*)?)', re.IGNORECASE)
+    stripped_s = url_pattern.sub(lambda match: match.group().replace(":", special_https_token), stripped_s)
+    
+    # check if string is not a list
+    if category_delimiter not in stripped_s[0:30]: # If the string does not contain ':' in the first ~30 characters, then it is probably not a list.
+        return [{'key': ' ', 'value': stripped_s}]
+
+    # proceed to parsing of the form {key1: value1, key2: value2, ...}, with values potentially being tables
+    s_lines = stripped_s.split('\n')
+    n_lines = len(s_lines)
+    
+    # if s contains category_delimiter (initially ':'), then it is usually a key-value pair (until next line with ':')
+    # EXCPETIONS: ':' could appear elsewhere, e.g. in paranthesis or if the model failed to start a new line
+    # we improve it now.
+    new_s_lines = []
+    for s_lines_i in s_lines:
+        # case 1: check if ':' is in paranthesis, i.e. it has one '(' some characters before and one ')' some characeters after it.
+        new_s_line = look_for_delimiter_inside_paranthesis(s_lines_i, category_delimiter, special_cat_token)
+        # case 1a: check if ':' is in a table, i.e. it has one '|' some characters before it.
+        new_s_line = look_for_delimiter_inside_table(new_s_line, table_delimiter, category_delimiter, special_cat_token)
+        # case 2: a ',' that comes before a ':' is probably a mistake - need to replace ',' with '\n'
+        new_s_line = look_for_delimiter_after_comma(new_s_line, category_delimiter, '\n')
+        
+        new_s_lines.append(new_s_line)
+    s_lines = new_s_lines
+
+    d = {}
+    # iterate over the list of strings
+    last_key = '' # last key - used to store multi-line values
+    for i in range(n_lines):
+        # split the string into parts separated by ':'
+        s_split_i = s_lines[i].split(category_delimiter)
+        
+        # if the string contains category_delimiter - e.g., ':'
+        if len(s_split_i) > 1:
+            last_key = ''
+            # add the key-value pair to the dictionary
+            d[s_split_i[0].strip()] = s_split_i[1].strip()
+            if s_split_i[1].strip() == '':
+                last_key = s_split_i[0].strip()
+                d[last_key] = []
+        elif last_key != '':
+            # if the string does not contain ':', then it should be a table
+            # count number of '|' in string s
+            n_pipes = s_lines[i].count(table_delimiter)
+            # if s contains '|', then it is a table
+            if n_pipes > 0:
+                # split the string into parts separated by '|'
+                s_split_i = s_lines[i].split(table_delimiter)
+                # if the string contains '|'
+                if len(s_split_i) > 1:
+                    # add the key-value pair to the dictionary
+                    d[last_key].append(s_lines[i])
+            else: # if s does not contain '|', then it is a multi-line value. For now we treat it the same
+                d[last_key].append(s_lines[i])
+
+    # recursively run on d, apply .replace(special_time_token, ':') on all strings
+    # also apply .replace(special_cat_token, ':'/category_delimiter) on all strings
+    for key in d:
+        if isinstance(d[key], list):
+            for i in range(len(d[key])):
+                d[key][i] = d[key][i].replace(special_time_token, category_delimiter)
+                d[key][i] = d[key][i].replace(special_cat_token, category_delimiter)
+                d[key][i] = d[key][i].replace(special_https_token, category_delimiter)
+        else:
+            d[key] = d[key].replace(special_time_token, category_delimiter)
+            d[key] = d[key].replace(special_cat_token, category_delimiter)
+            d[key] = d[key].replace(special_https_token, ':')
+    
+    '''
+    # split comma-separated values - currently unused.
+    for key in d:
+        if isinstance(d[key], list): 
+            d[key] = d[key]
+            continue
+        # print(d[key].split(','))
+        d[key] = [s_i.strip() for s_i in d[key].split(',')]
+    '''
+
+    # "plaster" - replace empty lists by empty strings
+    for key in d:
+        if d[key] == []:
+            d[key] = ''
+
+    # split "tables" into lists
+    for key in d:
+        if isinstance(d[key], list):
+            prev_col_len = 0 # we keep track of the number of columns in the previous row. Sometimes the table is not aligned, and we need to add a column to the beginning of the row.
+            for i in range(len(d[key])):
+                columns = d[key][i].count(table_delimiter)
+                if columns < prev_col_len:
+                    d[key][i] = [s_i.strip() for s_i in (' ' + table_delimiter + ' ' + d[key][i]).split(table_delimiter)]
+                else:
+                    d[key][i] = [s_i.strip() for s_i in d[key][i].split(table_delimiter)]
+                    prev_col_len = columns
+
+    # remove "empty" values - i.e. values that are not lists and are in values_to_drop
+    new_d = {}
+    for key in d:
+        if not isinstance(d[key], list):
+            if d[key] not in values_to_drop:
+                # remove key from d
+                # .pop(key, None)
+                new_d[key] = d[key]
+        else:
+            new_d[key] = d[key]
+    d = new_d
+
+    # convert {key: val} to [{key: key, value: val}]
+    l_dict = []
+    for key in d:
+        l_dict.append({'key': key, 'value': d[key]})
+
+    return l_dict
@@ -0,0 +1,108 @@
+"""
+Worker processes for the job queue of "async" requests and of the refinement of progressive /process requests (see server_src/job_utils.py).
+
+The web workers only enqueue jobs, so the number of requests waiting on the model at a time is set by the number of
+job workers here, not by the gunicorn workers - which stay free for the rest of the site.
+Each worker runs the handler of the request in app.py, in an app context, and stores what it returns as the result of the job.
+
+Run from the repository root:
+    python job_worker.py [--workers N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import yaml
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+CLEANUP_EVERY_SECONDS = 3600
+
+def heartbeat(job_utils, job, stop):
+    '''
+    Extends the claim of the running job until stop is set, so that a job longer than the visibility timeout is not run twice.
+    '''
+    while not stop.wait(cfg["JOB_HEARTBEAT_SECONDS"]):
+        try:
+            if not job_utils.extend_visibility(job['id'], job['attempts']):
+                return
+        except Exception as e:
+            print('Job heartbeat error: ', e)
+
+def give_up(web, job):
+    '''
+    Cleans up after a job that failed for good.
+    '''
+    if job['kind'] == 'refine':
+        # the query keeps its first output
+        web.stop_refining(job['payload']['query_id'])
+        return
+    # allow the user to send another request, as the web workers do on failure
+    user = web.User.query.filter_by(id=job['payload']['user_id']).first()
+    if user is not None:
+        web.release_user_throttle(user)
+
+def work():
+    # imported in the worker process, so that DB connections and HTTP clients are not shared across a fork
+    import app as web
+    from server_src import job_utils
+
+    handlers = {'process': web.run_process, 'processbatch': web.run_process_batch, 'processmarked': web.run_process_marked, 'question': web.run_question, 'refine': web.run_refine}
+    print('Job worker ' + str(os.getpid()) + ' started.')
+    last_cleanup = 0
+    while True:
+        if time.time() - last_cleanup > CLEANUP_EVERY_SECONDS:
+            job_utils.delete_old_jobs()
+            last_cleanup = time.time()
+
+        job = job_utils.claim()
+        if job is None:
+            time.sleep(cfg["JOB_POLL_SECONDS"])
+            continue
+
+        if job['status'] == 'failed':
+            # its workers died on every attempt
+            print('Job ' + job['id'] + ' timed out on its last attempt.')
+            with web.app.app_context():
+                give_up(web, job)
+            continue
+
+        print('Running ' + job['kind'] + ' job ' + job['id'] + ', attempt ' + str(job['attempts']))
+        stop_heartbeat = threading.Event()
+        threading.Thread(target=heartbeat, args=(job_utils, job, stop_heartbeat), daemon=True).start()
+        with web.app.app_context():
+            try:
+                result = handlers[job['kind']](**job['payload'])
+            except Exception as e:
+                traceback.print_exc()
+                web.db.session.rollback()
+                stop_heartbeat.set()
+                if not job_utils.fail(job['id'], job['attempts'], str(e)):
+                    give_up(web, job)
+                continue
+        stop_heartbeat.set()
+        if not job_utils.complete(job['id'], job['attempts'], result):
+            print('Job ' + job['id'] + ' was claimed again by another worker; its result is dropped.')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=cfg["JOB_WORKERS"])
+    args = parser.parse_args()
+
+    processes = []
+    while True:
+        # start the workers, and restart those that died; their claimed jobs run again after the visibility timeout
+        processes = [process for process in processes if process.is_alive()]
+        for _ in range(args.workers - len(processes)):
+            process = multiprocessing.Process(target=work, daemon=True)
+            process.start()
+            processes.append(process)
+        time.sleep(5)
+
+if __name__ == '__main__':
+    main()
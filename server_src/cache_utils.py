@@ -0,0 +1,83 @@
+'''
+Cache of model completions, shared by all worker processes through the data folder.
+
+Entries are keyed by a hash of everything that determines the completion: model, prompt/messages, max_tokens and temperature.
+Completions of private input (a page's HTML sent by the extension, marked text, chat history) are keyed with a cache_scope
+- usually the username - and so they are only ever returned for the same scope.
+
+Eviction is least-recently-used: a hit rewrites the entry with a fresh timeout, and when the cache exceeds its threshold,
+FileSystemCache removes the entries that are closest to expiring. Independently, an entry is not used once it is older than
+CACHE_COMPLETION_SECONDS.
+'''
+import hashlib
+import json
+import os
+import threading
+import time
+import yaml
+from cachelib.file import FileSystemCache
+from . import general_utils, metrics_utils
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+CACHE_COMPLETION_SECONDS = cfg["CACHE_COMPLETION_SECONDS"]
+CACHE_COMPLETION_THRESHOLD = cfg["CACHE_COMPLETION_THRESHOLD"]
+
+data_path = general_utils.get_data_path()
+completion_cache = FileSystemCache(os.path.join(data_path, 'completion_cache'), threshold=CACHE_COMPLETION_THRESHOLD, default_timeout=CACHE_COMPLETION_SECONDS)
+
+# counters of this worker process
+cache_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'errors': 0}
+cache_stats_lock = threading.Lock()
+
+def count_cache_event(event):
+    with cache_stats_lock:
+        cache_stats[event] += 1
+
+def get_cache_stats():
+    with cache_stats_lock:
+        return dict(cache_stats)
+
+metrics_utils.register_process_stats('essence_completion_cache_events_total', get_cache_stats)
+
+def get_completion_key(model, messages, max_tokens, temperature, cache_scope=None):
+    '''
+    messages: the prompt (for completion models) or the list of chat messages.
+    cache_scope: None for input that may be shared between users; otherwise e.g. the username.
+    '''
+    key_input = json.dumps([model, messages, max_tokens, temperature, cache_scope], ensure_ascii=False)
+    return 'completion_' + hashlib.sha256(key_input.encode('utf-8')).hexdigest()
+
+def get_cached_completion(key):
+    '''
+    Returns the cached response, or None on a miss.
+    '''
+    try:
+        elem = completion_cache.get(key)
+    except Exception as e:
+        print('Completion cache error: ', e)
+        count_cache_event('errors')
+        return None
+
+    if elem is None or time.time() - elem['created'] > CACHE_COMPLETION_SECONDS:
+        count_cache_event('misses')
+        return None
+
+    count_cache_event('hits')
+    print('Using cached completion...')
+    # rewriting the entry pushes its expiry forward, so the least recently used entries are evicted first
+    completion_cache.set(key, elem)
+    return elem['response']
+
+def cache_completion(key, response):
+    '''
+    Stores a response; only plain data is stored, so that it can be read by any worker.
+    '''
+    try:
+        completion_cache.set(key, {'created': time.time(), 'response': json.loads(json.dumps(response))})
+        count_cache_event('stores')
+    except Exception as e:
+        print('Completion cache error: ', e)
+        count_cache_event('errors')
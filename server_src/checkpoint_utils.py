@@ -0,0 +1,60 @@
+'''
+Checkpoints of multi-pass (chained) summaries, see gpt_utils.get_gpt_summary.
+
+After every pass, its output and how far into the text it got are saved under a key of (text hash, style, model,
+max_char_length, cache_scope). A run that was cut short - e.g. a gunicorn worker killed at its timeout, or a job worker that
+died - is picked up at the next pass by the next run on the same text: the user's retry, or the retry of the job.
+The checkpoint is removed once the summary is done.
+'''
+import hashlib
+import json
+import os
+import time
+import yaml
+from cachelib.file import FileSystemCache
+from . import general_utils
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+CACHE_CHECKPOINT_SECONDS = cfg["CACHE_CHECKPOINT_SECONDS"]
+CACHE_CHECKPOINT_THRESHOLD = cfg["CACHE_CHECKPOINT_THRESHOLD"]
+
+data_path = general_utils.get_data_path()
+checkpoint_cache = FileSystemCache(os.path.join(data_path, 'summary_checkpoints'), threshold=CACHE_CHECKPOINT_THRESHOLD, default_timeout=CACHE_CHECKPOINT_SECONDS)
+
+def get_checkpoint_key(coarse_text, style, model, max_char_length=None, cache_scope=None):
+    '''
+    The key of the checkpoint of a chained summary - of the text, in the style, by the model; cache_scope as in gpt_utils.gpt_completion.
+    '''
+    text_hash = hashlib.sha256(coarse_text.encode('utf-8')).hexdigest()
+    key_input = json.dumps([text_hash, style, model, max_char_length, cache_scope])
+    return 'checkpoint_' + hashlib.sha256(key_input.encode('utf-8')).hexdigest()
+
+def load_checkpoint(key):
+    '''
+    Returns the last checkpoint - a dictionary with passes, response_text, actual_final_char_index and gpt_credits - or None.
+    '''
+    try:
+        return checkpoint_cache.get(key)
+    except Exception as e:
+        print('Checkpoint error: ', e)
+        return None
+
+def save_checkpoint(key, passes, response_text, actual_final_char_index, gpt_credits):
+    try:
+        checkpoint_cache.set(key, {
+            'passes': passes,
+            'response_text': response_text,
+            'actual_final_char_index': actual_final_char_index,
+            'gpt_credits': gpt_credits,
+            'created': time.time()})
+    except Exception as e:
+        print('Checkpoint error: ', e)
+
+def clear_checkpoint(key):
+    try:
+        checkpoint_cache.delete(key)
+    except Exception as e:
+        print('Checkpoint error: ', e)
@@ -0,0 +1,67 @@
+'''
+Revision of cached outputs of pages that changed since, see gpt_utils.revise_output.
+
+The current text of the page is compared with the cleaned text of the cached query, paragraph by paragraph. When the
+change is small - e.g. a few entries added to a live blog, or a fixed section of the docs - only the changed paragraphs,
+with the previous output, are sent to the model to revise it, instead of processing the whole text again.
+A page that changed more than REVISE_MAX_CHANGED_FRACTION is processed from scratch.
+'''
+import difflib
+import yaml
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+REVISE_AFTER_HOURS = cfg["REVISE_AFTER_HOURS"]
+REVISE_MAX_CHANGED_FRACTION = cfg["REVISE_MAX_CHANGED_FRACTION"]
+REVISE_CONTEXT_CHARS = cfg["REVISE_CONTEXT_CHARS"]
+
+REVISE_PROMPT_TITLE = "You keep an output written from a document up to date. The document has changed since the output was written. You are given the previous output and the changes to the document: the paragraphs that were removed and those that were added, each after the paragraph that precedes them. Revise the previous output to reflect the changes - add what is new, remove or correct what no longer holds - and keep the rest of it as is. Output the revised output in exactly the same format as the previous output.\n"
+REVISE_PREV_OUTPUT_PROMPT = "\n\nPrevious output:\n"
+REVISE_CHANGES_PROMPT = "\n\nChanges to the document:\n"
+REVISE_OUTPUT_PROMPT = "\n\nRevised output:\n"
+
+def split_paragraphs(text):
+    return [paragraph.strip() for paragraph in text.split('\n') if paragraph.strip() != '']
+
+def get_changes(old_text, new_text):
+    '''
+    Compares the texts paragraph by paragraph.
+    Returns (changed_fraction, changes): the fraction of the characters of the paragraphs of both texts that are in removed or
+    added paragraphs, and a list of changes, dictionaries with context (the unchanged paragraph before, '' at the start), removed and added (lists of paragraphs).
+    '''
+    old_paragraphs, new_paragraphs = split_paragraphs(old_text), split_paragraphs(new_text)
+    matcher = difflib.SequenceMatcher(None, old_paragraphs, new_paragraphs, autojunk=False)
+
+    changes = []
+    changed_chars = 0
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        removed, added = old_paragraphs[i1:i2], new_paragraphs[j1:j2]
+        changed_chars += sum(len(paragraph) for paragraph in removed + added)
+        changes.append({'context': new_paragraphs[j1 - 1] if j1 > 0 else '', 'removed': removed, 'added': added})
+
+    total_chars = sum(len(paragraph) for paragraph in old_paragraphs + new_paragraphs)
+    return (changed_chars / total_chars if total_chars > 0 else 0), changes
+
+def format_changes(changes):
+    '''
+    The changes of get_changes as the text sent with the revise prompt.
+    '''
+    sections = []
+    for change in changes:
+        context = change['context']
+        if len(context) > REVISE_CONTEXT_CHARS:
+            context = '...' + context[-REVISE_CONTEXT_CHARS:]
+        section = 'After: ' + (context if context != '' else '(the start of the document)')
+        if len(change['removed']) > 0:
+            section += '\nRemoved:\n' + '\n'.join(change['removed'])
+        if len(change['added']) > 0:
+            section += '\nAdded:\n' + '\n'.join(change['added'])
+        sections.append(section)
+    return '\n\n'.join(sections)
+
+def get_revise_prompt(previous_output):
+    return REVISE_PROMPT_TITLE + REVISE_PREV_OUTPUT_PROMPT + previous_output + REVISE_CHANGES_PROMPT
@@ -0,0 +1,96 @@
+'''
+Style-neutral digests of long documents, shared by the styles that only need the gist of the text (digest: true in styles.yml).
+
+A digest is dense structured notes of the whole document, written once (see gpt_utils.get_document_digest) and cached under
+a hash of the cleaned text. Such styles are then summarized from the digest instead of the text, so a second style over the
+same long document reads a few thousand tokens instead of the whole text again.
+A digest is only written when at least two such styles summarize the text (in process_url_styles, or in a batch with the URL
+more than once, see gpt_utils.should_share_digest); otherwise a style reads the text itself, and uses the digest only if it is
+already cached. Styles with extractive compression never use it.
+
+Digests of the same text are written one at a time per worker process, so that concurrent styles (see gpt_utils.process_url_styles)
+wait for the first one instead of each writing their own.
+'''
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+import yaml
+from cachelib.file import FileSystemCache
+from . import general_utils
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+USE_DOCUMENT_DIGEST = cfg["USE_DOCUMENT_DIGEST"]
+DIGEST_MAX_TOKENS = cfg["DIGEST_MAX_TOKENS"]
+CACHE_DIGEST_SECONDS = cfg["CACHE_DIGEST_SECONDS"]
+CACHE_DIGEST_THRESHOLD = cfg["CACHE_DIGEST_THRESHOLD"]
+
+DIGEST_MIN_TOKENS_PER_PART = 128
+DIGEST_MAX_PART_TOKENS = 768    # the completion length the parts are sized for, see gpt_utils.split_text_to_chunks
+DIGEST_PROMPT_TITLE = "You are writing a dense, neutral digest of a document, from which summaries, bullet points and explanations of it will be written later. Write short structured notes, in the order of the text: the topic and purpose, the background, the main points and arguments, key facts, numbers, names and definitions, and the conclusions. Do not add opinions or information that is not in the text.\n"
+DIGEST_PART_PROMPT = "The text is part {part} of {parts} of the document.\n"
+DIGEST_INPUT_PROMPT = "Text: "
+DIGEST_OUTPUT_PROMPT = "\n\nDigest:\n"
+
+data_path = general_utils.get_data_path()
+digest_cache = FileSystemCache(os.path.join(data_path, 'digest_cache'), threshold=CACHE_DIGEST_THRESHOLD, default_timeout=CACHE_DIGEST_SECONDS)
+
+# per digest key: [lock, number of threads holding or waiting for it]
+digest_locks = {}
+digest_locks_lock = threading.Lock()
+
+def get_digest_key(coarse_text, model, cache_scope=None):
+    '''
+    The key of the digest of the text by the model. The digest of a private text is only shared within its cache_scope (see gpt_utils.gpt_completion).
+    '''
+    text_hash = hashlib.sha256(coarse_text.encode('utf-8')).hexdigest()
+    return 'digest_' + hashlib.sha256(json.dumps([text_hash, model, cache_scope]).encode('utf-8')).hexdigest()
+
+@contextmanager
+def digest_lock(key):
+    '''
+    Holds the lock of the digest key. The lock is removed when the last thread that holds or waits for it is done with it,
+    so that a thread that comes later never runs next to one that is still waiting.
+    '''
+    with digest_locks_lock:
+        entry = digest_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with digest_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del digest_locks[key]
+
+def get_part_prompt(part, parts):
+    '''
+    The prompt before the text of a part of the document; the text is split into parts that fit a call each.
+    '''
+    if parts == 1:
+        return DIGEST_PROMPT_TITLE + DIGEST_INPUT_PROMPT
+    return DIGEST_PROMPT_TITLE + DIGEST_PART_PROMPT.format(part=part, parts=parts) + DIGEST_INPUT_PROMPT
+
+def get_part_max_tokens(parts):
+    '''
+    The completion length of the digest of each part, such that the whole digest is about DIGEST_MAX_TOKENS long.
+    '''
+    return max(DIGEST_MIN_TOKENS_PER_PART, min(DIGEST_MAX_PART_TOKENS, DIGEST_MAX_TOKENS // parts))
+
+def get_cached_digest(key):
+    try:
+        return digest_cache.get(key)
+    except Exception as e:
+        print('Digest cache error: ', e)
+        return None
+
+def cache_digest(key, digest):
+    try:
+        digest_cache.set(key, digest)
+    except Exception as e:
+        print('Digest cache error: ', e)
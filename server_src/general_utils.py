@@ -1,7 +1,16 @@
+import os
 from retry import retry
 from timeout_decorator import timeout, TimeoutError
 from multiprocessing import Process, Manager
 
+def get_data_path():
+    '''
+    The data folder (databases, caches): ESSENCE_DATA_PATH if set, otherwise 'data' one folder up from the working directory.
+    '''
+    if os.getenv("ESSENCE_DATA_PATH"):
+        return os.getenv("ESSENCE_DATA_PATH")
+    return os.path.abspath(os.path.join(os.getcwd(), os.pardir, 'data'))
+
 def run(func, args, kwargs, return_value, exception):
     try:
         return_value.value = func(*args, **kwargs)
@@ -1,13 +1,12 @@
-import os
 from pathlib import Path
 import re
-from . import scraping_utils, nlp_utils, general_utils
+from . import scraping_utils, nlp_utils, general_utils, token_utils, parse_utils, style_utils, cache_utils, llm_utils, history_utils, metrics_utils, routing_utils, checkpoint_utils, digest_utils, diff_utils
 import numpy as np
 import time
 import yaml
 from retry import retry
-
-import openai
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 
 
 with open("server_src/config.yml", 'r') as ymlfile:
@@ -16,445 +15,40 @@ with open("server_src/config.yml", 'r') as ymlfile:
 
 max_req_to_server = cfg["max_req_to_server"]
 qa_model = cfg["QA_MODEL"]
-BULLETS_GENERIC_STYLE_NAME = cfg["BULLETS_GENERIC_STYLE_NAME"]
-TABULARIZE_STYLE_NAME = cfg["TABULARIZE_STYLE_NAME"]
 MAX_GPT_PASSES = cfg["MAX_GPT_PASSES"]
 MIN_MARKED_TEXT_LENGTH = cfg["MIN_MARKED_TEXT_LENGTH"]
 MULTIPLE_PASSES_MAX_TOKENS = cfg["MULTIPLE_PASSES_MAX_TOKENS"]
-CHARS_TO_DECREASE_ON_DECLINE = cfg["chars_to_decrease_on_decline"]
 COMPLETION_TIMEOUT = cfg["COMPLETION_TIMEOUT"]
-
-openai.api_key = os.getenv("OPENAI_API_KEY")
-if not os.getenv("OPENAI_API_KEY"):
-    # try to get the key from file in parent folder
-    with open('../../openai_gpt3_key.txt', 'r') as f:
-        openai.api_key = f.read()
-
-azure_flag = False
-if os.getenv("AZURE_OPENAI_KEY") and os.getenv("AZURE_OPENAI_ENDPOINT"):
-    openai.api_type = "azure"
-    openai.api_base = os.getenv("AZURE_OPENAI_ENDPOINT") 
-    openai.api_version = "2023-06-01-preview" # "2023-05-15"
-    openai.api_key = os.getenv("AZURE_OPENAI_KEY")
-    azure_flag = True
-
-def parse_gpt_response_bullets(response: str):
-    """Converts a string of the form '- bullet1 \n- bullet2' to a [bullet1, bullet2]."""
-    
-    stripped_s = response.strip()
-
-    # remove lines which are whitespace only
-    stripped_s = re.sub(r'^[\s]*\n', '', stripped_s, flags=re.MULTILINE)
-
-    l_dict = []
-    for j, line in enumerate(stripped_s.split('\n')):
-        if len(line) < 3: 
-            continue
-        line = line.strip()
-        if line[1].isdigit():
-            line = line[2:]
-        else:
-            line = line.strip()[1:]
-
-        # find index of first letter or number in any alphabet
-        first_letter_index = -1
-        for i, c in enumerate(line):
-            if c.isalnum():
-                first_letter_index = i
-                break
-        if first_letter_index == -1:
-            continue
-        
-        l_dict.append({'key': j+1, 'value': line[first_letter_index:]})
-
-    return l_dict
-
-def look_for_delimiter_inside_paranthesis(s, delimiter, replacement_delimiter):
-    open_paranthesis_flag = False
-    new_s = ''
-    for c in s:
-        if c == '(':
-            open_paranthesis_flag = True
-        elif c == ')':
-            open_paranthesis_flag = False
-        if c == delimiter and open_paranthesis_flag:
-            new_s += replacement_delimiter
-            continue
-        new_s += c
-    return new_s
-
-def look_for_delimiter_inside_table(s, table_delimiter, delimiter, replacement_delimiter):
-    inside_table = False
-    new_s = ''
-    prev = 0
-    for i, c in enumerate(s):
-        if c == table_delimiter:
-            inside_table = True
-        elif c == delimiter and inside_table:
-            new_s += s[prev:i] + replacement_delimiter
-            prev = i + 1
-    new_s += s[prev:]
-    return new_s
-
-def look_for_delimiter_after_comma(s, delimiter, replacement_delimiter, comma=','):
-    comma_occ = []
-    colon_occ = []
-    for i, c in enumerate(s):
-        if c == comma:
-            comma_occ.append(i)
-        elif c == delimiter:
-            colon_occ.append(i)
-
-    replace_colon = []
-    for colon_acc_i in colon_occ[::-1]:
-        while len(comma_occ) > 0 and comma_occ[-1] > colon_acc_i:
-            comma_occ.pop()
-        if len(comma_occ) == 0:
-            break
-        replace_colon.append(comma_occ[-1])
-
-    new_s = ''
-    prev = 0
-    for replace_colon_i in replace_colon:
-        new_s += s[prev:replace_colon_i].strip() + replacement_delimiter
-        prev = replace_colon_i + 1
-    new_s += s[prev:].strip()
-    return new_s
-
-def is_likely_key_val_list(s):
-    """Returns True if the string is likely to be of the form 'key1:\nvalue1\nvalue2\nkey2:value1'"""
-    if len(s) < 10:
-        return False
-    if s.count(':') < 2:
-        return False
-    if s.count('\n') < 2:
-        return False
-    s = s.strip()
-    s_lines = s.split('\n')
-    if s_lines[0].count(':') == 0:
-        return False
-    if s_lines[0].split(':')[1].strip() != '':
-        return False
-    return True
-
-def parse_gpt_response(s, style='', category_delimiter=':', table_delimiter='|', special_time_token='<<STT>>', special_cat_token='<<CAT>>', special_https_token='<<|HTTP|>>', values_to_drop=['', '-', 'None', 'N/A', 'n/a', 'N/a', 'NA', 'Not available', 'Not Available', 'not available', 'Not available.', 'Not Available.', 'not available.', 'varies', 'Varies', 'Unknown', 'unknown', 'Not provided', 'not mentioned', 'none mentioned']):
-    """Converts a string, usually of the form 'key1:value1,key2:value2', to a dictionary/JSON."""
-    
-    if style == BULLETS_GENERIC_STYLE_NAME:
-        if not is_likely_key_val_list(s):
-            if s.strip()[:s.find('\n')].count(':') == 1:
-                s = '- ' + s.strip()
-            print('Parsing as bullet points.')
-            parsed_s = parse_gpt_response_bullets(s)
-            return parsed_s
-        # remove incoming '-'. It's a thing that ChatGPT does.
-        s = '\n'.join([line if not line.startswith('- ') else line[2:] for line in s.splitlines()])
-    
-    if style == TABULARIZE_STYLE_NAME:
-        if not s.startswith('Table:'):
-            s = 'Table:\n' + s
-
-    stripped_s = s.strip()
-    
-    # replace places in stripped_s in which a digit occurs before and after ':' with special_time_token
-    stripped_s = re.sub(r'(\d+)(:)(\d+)', r'\1'+special_time_token+r'\3', stripped_s)
-    
-    # replace places where 'http://' or 'https://' occurs with special_https_token
-    url_pattern = re.compile(r'(https?://[^\s:]+(?::\d+)?(?:/[^\s]*)?)', re.IGNORECASE)
-    stripped_s = url_pattern.sub(lambda match: match.group().replace(":", special_https_token), stripped_s)
-    
-    # check if string is not a list
-    if category_delimiter not in stripped_s[0:30]: # If the string does not contain ':' in the first ~30 characters, then it is probably not a list.
-        return [{'key': ' ', 'value': stripped_s}]
-
-    # proceed to parsing of the form {key1: value1, key2: value2, ...}, with values potentially being tables
-    s_lines = stripped_s.split('\n')
-    n_lines = len(s_lines)
-    
-    # if s contains category_delimiter (initially ':'), then it is usually a key-value pair (until next line with ':')
-    # EXCPETIONS: ':' could appear elsewhere, e.g. in paranthesis or if the model failed to start a new line
-    # we improve it now.
-    new_s_lines = []
-    for s_lines_i in s_lines:
-        # case 1: check if ':' is in paranthesis, i.e. it has one '(' some characters before and one ')' some characeters after it.
-        new_s_line = look_for_delimiter_inside_paranthesis(s_lines_i, category_delimiter, special_cat_token)
-        # case 1a: check if ':' is in a table, i.e. it has one '|' some characters before it.
-        new_s_line = look_for_delimiter_inside_table(new_s_line, table_delimiter, category_delimiter, special_cat_token)
-        # case 2: a ',' that comes before a ':' is probably a mistake - need to replace ',' with '\n'
-        new_s_line = look_for_delimiter_after_comma(new_s_line, category_delimiter, '\n')
-        
-        new_s_lines.append(new_s_line)
-    s_lines = new_s_lines
-
-    d = {}
-    # iterate over the list of strings
-    last_key = '' # last key - used to store multi-line values
-    for i in range(n_lines):
-        # split the string into parts separated by ':'
-        s_split_i = s_lines[i].split(category_delimiter)
-        
-        # if the string contains category_delimiter - e.g., ':'
-        if len(s_split_i) > 1:
-            last_key = ''
-            # add the key-value pair to the dictionary
-            d[s_split_i[0].strip()] = s_split_i[1].strip()
-            if s_split_i[1].strip() == '':
-                last_key = s_split_i[0].strip()
-                d[last_key] = []
-        elif last_key != '':
-            # if the string does not contain ':', then it should be a table
-            # count number of '|' in string s
-            n_pipes = s_lines[i].count(table_delimiter)
-            # if s contains '|', then it is a table
-            if n_pipes > 0:
-                # split the string into parts separated by '|'
-                s_split_i = s_lines[i].split(table_delimiter)
-                # if the string contains '|'
-                if len(s_split_i) > 1:
-                    # add the key-value pair to the dictionary
-                    d[last_key].append(s_lines[i])
-            else: # if s does not contain '|', then it is a multi-line value. For now we treat it the same
-                d[last_key].append(s_lines[i])
-
-    # recursively run on d, apply .replace(special_time_token, ':') on all strings
-    # also apply .replace(special_cat_token, ':'/category_delimiter) on all strings
-    for key in d:
-        if isinstance(d[key], list):
-            for i in range(len(d[key])):
-                d[key][i] = d[key][i].replace(special_time_token, category_delimiter)
-                d[key][i] = d[key][i].replace(special_cat_token, category_delimiter)
-                d[key][i] = d[key][i].replace(special_https_token, category_delimiter)
-        else:
-            d[key] = d[key].replace(special_time_token, category_delimiter)
-            d[key] = d[key].replace(special_cat_token, category_delimiter)
-            d[key] = d[key].replace(special_https_token, ':')
-    
-    '''
-    # split comma-separated values - currently unused.
-    for key in d:
-        if isinstance(d[key], list): 
-            d[key] = d[key]
-            continue
-        # print(d[key].split(','))
-        d[key] = [s_i.strip() for s_i in d[key].split(',')]
-    '''
-
-    # "plaster" - replace empty lists by empty strings
-    for key in d:
-        if d[key] == []:
-            d[key] = ''
-
-    # split "tables" into lists
-    for key in d:
-        if isinstance(d[key], list):
-            prev_col_len = 0 # we keep track of the number of columns in the previous row. Sometimes the table is not aligned, and we need to add a column to the beginning of the row.
-            for i in range(len(d[key])):
-                columns = d[key][i].count(table_delimiter)
-                if columns < prev_col_len:
-                    d[key][i] = [s_i.strip() for s_i in (' ' + table_delimiter + ' ' + d[key][i]).split(table_delimiter)]
-                else:
-                    d[key][i] = [s_i.strip() for s_i in d[key][i].split(table_delimiter)]
-                    prev_col_len = columns
-
-    # remove "empty" values - i.e. values that are not lists and are in values_to_drop
-    new_d = {}
-    for key in d:
-        if not isinstance(d[key], list):
-            if d[key] not in values_to_drop:
-                # remove key from d
-                # .pop(key, None)
-                new_d[key] = d[key]
-        else:
-            new_d[key] = d[key]
-    d = new_d
-
-    # convert {key: val} to [{key: key, value: val}]
-    l_dict = []
-    for key in d:
-        l_dict.append({'key': key, 'value': d[key]})
-
-    return l_dict
+COMPLETION_TEMPERATURE = 0.7    # of completion models (text-davinci-003, text-curie-001)
+CHAT_TEMPERATURE = 1            # chat models are called with the API default
+MAP_REDUCE_MAX_WORKERS = cfg["MAP_REDUCE_MAX_WORKERS"]
+MAP_REDUCE_MAX_CHUNKS = cfg["MAP_REDUCE_MAX_CHUNKS"]
+
+PIPELINE_MAX_WORKERS = cfg["PIPELINE_MAX_WORKERS"]
+CHAT_HISTORY_TOKEN_BUDGET = cfg["CHAT_HISTORY_TOKEN_BUDGET"]
+QA_HISTORY_TOKEN_BUDGET = cfg["QA_HISTORY_TOKEN_BUDGET"]
+BATCH_MAX_WORKERS = cfg["BATCH_MAX_WORKERS"]
+BATCH_MAX_FETCHES_PER_DOMAIN = cfg["BATCH_MAX_FETCHES_PER_DOMAIN"]
+BATCH_MAX_CONCURRENT_SUMMARIES = cfg["BATCH_MAX_CONCURRENT_SUMMARIES"]
+
+# bounded pool shared by all map-reduce summaries in this worker process
+map_reduce_executor = ThreadPoolExecutor(max_workers=MAP_REDUCE_MAX_WORKERS)
+# pool for the independent stages of process_url (title) and process_url_styles (title, a summary per style). Kept apart from 
+# map_reduce_executor, since a summary stage submits map-reduce tasks and waits for them.
+pipeline_executor = ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS)
+# pool for the URLs of batch requests (process_batch), shared by all batches in this worker process. A URL is fetched under
+# the limit of its domain, and summarized under the limit of summaries, so that a batch does not flood a site or the model API.
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS)
+batch_summary_semaphore = threading.BoundedSemaphore(BATCH_MAX_CONCURRENT_SUMMARIES)
+domain_semaphores = {}
+domain_semaphores_lock = threading.Lock()
 
 def get_gpt_prompt(style='travel'):
-    if style == 'travel':
-        prompt_title = "You help a traveler design a multi-day or multi-destination itinerary and gather information about a trip. Convert the blog entries to structured data. When writing a table, put different destinations or activities in separate rows.\n"
-        input_prompt = "Text: "
-        output_prompt = "\n\nOutput, possible fields {Activity name, Accommodation, Eating, Transportation, Best Seasons, Preparation, Budget, Itinerary table}:\n" # "Structured data:\nActivity:"
-        example_pairs = [
-            ["We had an amazing time in Peru, especially in Huaraz. We went to the a bunch of day treks and the Santa Cruz trek! It is a 3-day trek in the Andes mountains. In the first day, we walked 4 hours on a rugged trail and camped near a river. In the second day, we had tough 16 kilometers through beautiful terrain. In the third day, we went over a high altitude pass of 5100m, finishing the trek in a small town. We rode on a shared taxi back to Huaraz. The whole thing cost us about 400 Soles.\n\n",
-            '''Activity name: Santa Cruz trek
-Accommodation: camping
-Transportation: shared taxi
-Budget: 400 Soles
-Itinerary table:
-Day | Length | Details
-1 | 4 hrs | rugged, river camping
-2 | 16 km | beautiful terrain
-3 |  | 5100m pass'''],
-            ["Recommended hotels in France, where mid/high end means over 100 euros per night, budget means less.\n\n",
-             '''Destination name: France
-Hotels:
-Location | Name | Details
-Paris | Hotel de Crillon | High-end
- | Hotel de Ville | Mid-range
-Lyon | Comte Ornon | High-range
- | Hotel Boutique | Mid-range
-Bourdeaux | Hotel de Seze | Mid-range
- | Best Western Francais | Budget'''],
-            ["In the last summer I was in Nepal, exploring the Himalayas. In one of the most memorable experiences, I went on the Tilicho lake trek. After hiring a porter at Pokhara, I took a bus to Besi-Sahar. After a day of altitude acclimatization in Manang, enjoying the local food at a simple hotel, I set out at sunrise to Tilicho lake base camp. This day was beautiful but a little dangerous, as some paths suffer from landslide. After another night at a simple hotel, I began the climb to the lake. After about 3 hours and 1000m of climb, I made it to the lake. Boy-oh-boy, the views were amazing! Snow-capped mountains with a far-reaching pristine lake in the middle. The walk was definitely worth it. After climbing down I stopped at base camp for another night with a hearty meal along fellow travelers. In the next day, I hiked back 15 km to Manang and made the trip back to Pokhara.",
-            '''Activity name: Tilicho lake trek
-Accommodation: simple hotels
-Transportation: bus to Besi-Sahar
-Itinerary table:
-Day | Destination | Details
-1 | Manang | altitude acclimatization
-2 | Base camp | landslide danger
-3 | Tilicho lake and back | 3 hours, 1000m climb
-4 | Manang | 15km hike
-| Pokhara | ''']
-        ]
-        keywords = ['Santa Cruz', 'Andes', 'Huaraz', '5100m', 'Crillon', 'France', 'Paris', 'Lyon', 'Comte', 'Ornon', 'Western', 'Bourdeaux', 'Seze', 'Tilicho', 'Pokhara', 'Manang', 'Besi-Sahar']
-        
-        continued_prompt_title = "You help a traveler design a multi-day or multi-destination itinerary and gather information about a trip. You are given the data collected so far and a relevant body of text. You need to use the text to add details and expand the data and output the revised data in the same format. Be informative and succinct.\n"
-        continued_prev_data_prompt = "\n\nPrevious data:\n"
-        continued_new_text_prompt = "\n\nNew text:\n"
-        continued_output_prompt = "\n\nRevised data:\n"
-        continued_prompt_dict = {
-            "continued_prompt_title": continued_prompt_title, 
-            "continued_prev_data_prompt": continued_prev_data_prompt, 
-            "continued_new_text_prompt": continued_new_text_prompt, 
-            "continued_output_prompt": continued_output_prompt,
-            "keywords": ["multi-day", "gather information about a trip", "Be informative and succinct"]}
-    elif style == 'bizanalytics':
-        prompt_title = "You are trying to help an analyst appraise businesses and gather information from business news. Convert the following text snippets to structured data.\n"
-        input_prompt = "Text: "
-        output_prompt = "\n\nOutput, possible fields include {Main company/ies, Business/service, Valuation, Product, Features, Pricing, Investors, Business decisions/events, Area, Personnel, Challenges}:\n"
-        example_pairs = [
-            ['''On-demand shuttle and software company Via has raised another $130 million, capital that has pushed its valuation to about $3.3 billion as demand from cities to update its legacy transit systems rises.
-The round was led by Janus Henderson with participation from funds and accounts managed by BlackRock, ION Crossover Partners, Koch Disruptive Technologies and existing investor Exor. To date, the company has raised $800 million.
-Via, which today employs about 950 people, has two sides to its business. The company operates consumer-facing shuttles in Washington, D.C. and New York. Its underlying software platform, which it sells to cities, transportation authorities, school districts and universities to deploy their own shuttles, is not only the core of its business; it has become the primary driver of growth.
-Co-founder and CEO Daniel Ramot previously told TechCrunch that there was was little interest from cities in the software-as-a-service platform when the company first launched in 2012. Via landed its first city partnership with Austin in late 2017, after providing the platform to the transit authority for free. It was enough to allow Via to develop case studies and convince other cities to buy into the service. In 2019, the partnerships side of the business “took off,” Ramot said in an interview last year.
-Today, the software side — branded internally as TransitTech — has eclipsed its consumer-facing operations. Via said TransitTech revenue more than doubled year on year to exceed an annual run rate of $100 million. The software platform is used by more than 500 partners, including Los Angeles Metro. Jersey City and Miami in the United States as well as Arriva Bus UK, a Deutsche Bahn company that uses it for a first and last-mile service connecting commuters to a high-speed train station in Kent, U.K.
-Via doesn’t provide specifics on what it plans to use the funds for. The company has made two acquisitions in the past 18 months, including Fleetonomy in 2020.
-Earlier this year, Via used $100 million in cash and equity to acquire a company called RemixCorpTM, a startup that developed mapping software used by cities for transportation planning and street design. The startup became a subsidiary of Via, an arrangement that will let the startup maintain its independent brand.\n\n''',
-            '''Main company: Via
-Business/service: On-demand shuttle, software-as-a-service
-Since: 2012
-Total funding: $800M
-Valuation: $3.3B
-Revenue: Doubling YOY
-Investors: Janus Henderson, BlackRock, ION Crossover Partners, Koch Disruptive Technologies, Exor
-Geography: Washington, D.C., New York, Austin, Los Angeles Metro, Jersey City, Miami, Arriva Bus UK
-Clients: over 500
-Personnel:
-Daniel Ramot | CEO
-Employees | 950
-Business decisions:
-Type | Details
-Funding round | $130M
-Acquired Fleetonomy | 2020
-Acquired RemixCorpTM | $100M, cash and equity, mapping software'''
-            ],
-        ]
-        keywords = ['Via', 'Daniel Ramot', 'Fleetonomy', 'RemixCorpTM', 'Los Angeles Metro', 'Arriva Bus UK','Deutsche Bahn', 'Janus Henderson', 'BlackRock', 'ION Crossover Partners', 'Koch Disruptive Technologies', 'Exor']
-        continued_prompt_dict = None
-    elif style == 'spaper':
-        prompt_title = "You are trying to help an academic researcher to quickly understand the key points of a scientific paper. In the following, convert each text snippet to structured data.\n"
-        input_prompt = "Text: "
-        output_prompt = "\n\nOutput, possible fields {Scientific field, Background, Novelty, Conclusions/Key takeaways, Methods}:\n"
-        example_pairs = [
-            ['''Ultra-diffuse galaxies that contain a large sample of globular clusters (GCs) offer an opportunity to test the predictions of galactic dynamics theory. NGC5846-UDG1 is an excellent example, with a high-quality sample of dozens of GC candidates. We show that the observed distribution of GCs in NGC5846-UDG1 is suggestive of mass segregation induced by gravitational dynamical friction. We present simple analytic calculations, backed by a series of numerical simulations, that naturally explain the observed present-day pattern of GC masses and radial positions. Subject to some assumptions on the GC population at birth, the analysis supports the possibility that NGC5846-UDG1 resides in a massive dark matter halo. This is an example for the use of GC-rich systems as dynamical (in addition to kinematical) tracers of dark matter.\n\n''' ,
-            '''Scientific field: Galaxies, globular clusters, dark matter
-Background: Ultra-diffuse galaxies that contain a large sample of globular clusters (GCs) offer an opportunity to test the predictions of galactic dynamics theory. NGC5846-UDG1 is an excellent example, with a high-quality sample of dozens of GC candidates.
-Novelty: NGC5846-UDG1 has a high-quality sample of dozens of GC candidates and dynamical friction is likely effective in the galaxy
-Main conclusion: NGC5846-UDG1 is an example for the use of GC-rich systems as dynamical (in addition to kinematical) tracers of dark matter
-Methods: simple analytic calculations, numerical simulations''']]
-        keywords = ['NGC5846-UDG1', 'galaxies', 'globular clusters', 'dark matter', 'dynamical friction']
-        continued_prompt_dict = None
-    elif style == 'spaper_variant':
-        prompt_title = "You are trying to help an academic researcher to quickly understand the key points of a scientific paper. In the following, convert each text snippet to structured data.\n"
-        input_prompt = "Text: "
-        output_prompt = "\n\nOutput, possible fields {Scientific field, Background, Novelty, Conclusions/Key takeaways, Methods}:\n"
-        example_pairs = [
-            ['''The dominant sequence transduction models are based on complex recurrent or convolutional neural networks that include an encoder and a decoder. The best performing models also connect the encoder and decoder through an attention mechanism. We propose a new simple network architecture, the Transformer, based solely on attention mechanisms, dispensing with recurrence and convolutions entirely. We implement sequence ordering by using fixed positional encodings. Experiments on two machine translation tasks show these models to be superior in quality while being more parallelizable and requiring significantly less time to train. Our model achieves 28.4 BLEU on the WMT 2014 English-to-German translation task, improving over the existing best results, including ensembles, by over 2 BLEU. On the WMT 2014 English-to-French translation task, our model establishes a new single-model state-of-the-art BLEU score of 41.8 after training for 3.5 days on eight GPUs, a small fraction of the training costs of the best models from the literature. We show that the Transformer generalizes well to other tasks by applying it successfully to English constituency parsing both with large and limited training data.\n\n''' ,
-            '''Scientific field: Neural networks, machine translation
-Background: The dominant sequence transduction models are based on complex recurrent or convolutional neural networks that include an encoder and a decoder. The best performing models also connect the encoder and decoder through an attention mechanism.
-Novelty: We propose a new simple network architecture, the Transformer, based solely on attention mechanisms, dispensing with recurrence and convolutions entirely.
-Key achievements: Our model achieves 28.4 BLEU on the WMT 2014 English-to-German translation task and 41.8 on the WMT 2014 English-to-French translation task, establishing a new single-model state-of-the-art BLEU score. The model generalizes well to other tasks and can be trained relatively fast.
-Methods: Attention mechanism, fixed positional encodings, performance on language tasks''']]
-        keywords = ['attention mechanism', 'Attention mechanism', 'BLEU', 'German', 'neural', 'convolutions', 'Transformer', 'positional encodings']
-        continued_prompt_dict = None
-    elif style == 'generic':
-        prompt_title = "You are trying to help a layperson get a summary with the main background required to understand the following text and the main conclusions that stem from it. The summary should not exceed 8 sentences.\n"
-        input_prompt = "Text: "
-        output_prompt = "\n\nSummary:\n"
-        example_pairs = []
-        keywords = ['exceed 8 sentences']
-        continued_prompt_dict = None
-    elif style == BULLETS_GENERIC_STYLE_NAME:
-        prompt_title = "Summarize the following text into bullet points. Try to make the bullet points progress in logic, i.e. background would appear before conclusions. Be informative and succinct.\n"
-        input_prompt = "Text: "
-        output_prompt = "\n\nBullet points:\n"
-        example_pairs = []
-        keywords = ['into bullet points', 'progress in logic']
-        
-        continued_prompt_title = "You help a user get the essence of a body of text. You are given the bullet points collected so far and a relevant body of text. You need to use the text to add details and expand the bullet points and output the revised bullet points. Try to make the bullet points progress in logic, i.e. background would appear before conclusions. Be informative and succinct. If the new text does not appear to be relevant, you can ignore it and output the previous bullet points."
-        continued_prev_data_prompt = "\n\nPrevious bullet points:\n"
-        continued_new_text_prompt = "\n\nNew text:\n"
-        continued_output_prompt = "\n\nRevised bullet points:\n"
-        continued_prompt_dict = {
-            "continued_prompt_title": continued_prompt_title, 
-            "continued_prev_data_prompt": continued_prev_data_prompt, 
-            "continued_new_text_prompt": continued_new_text_prompt, 
-            "continued_output_prompt": continued_output_prompt,
-            "keywords": ["get the essence of a body", "You are given the bullet points", "Be informative and succinct"]}
-    elif style == 'criticizepaper':    
-        prompt_title = "You are helping a reviewer review a scientific paper. You are given an excerpt from a paper with the purpose of finding flaws in logic, execution, etc. Summarize your report in bullet points. Try to support your criticism with quotes from the text. If you can't find flaws, do not say any.\n"
-        input_prompt = "Paper excerpt: "
-        output_prompt = "\n\nCritical review of flaws in the paper:\n"
-        example_pairs = []
-        keywords = []
-        
-        continued_prompt_dict = None
-    elif style == 'explain':
-        prompt_title = 'You are helping someone read complicated text. Given some text, do your best to explain the text in simple terms. Do not drop key aspects of the text.'
-        input_prompt = 'Text: '
-        output_prompt = '\n\nExplanation:\n'
-        example_pairs = []
-        keywords = []
-
-        continued_prompt_dict = None
-    elif style == 'tabularize':
-        prompt_title = 'You are helping parse textual data into a table. The table cells should be separated by \'|\' and new lines.'
-        input_prompt = 'Text: '
-        output_prompt = '\n\nTable:\n'
-        example_pairs = [
-            ['''Above limb I(195.12 Å)
-(arcsec) erg cm2s−1sr−1
-I-P P
-0.00 52.45 164.67
-1.00 62.02 235.34
-2.00 69.19 338.49
-3.00 75.52 466.16\n\n''' ,
-'''Above limb | I(195.12 Å) |
-(arcsec) | erg cm2s−1sr−1 |
- | I-P | P
-0.00 | 52.45 | 164.67
-1.00 | 62.02 | 235.34
-2.00 | 69.19 | 338.49
-3.00 | 75.52 | 466.16
-''']]
-
-        keywords = ['parse textual data', 'table cells should be separated by \'|\'']
-
-        continued_prompt_dict = None
-
-    else:
+    """Returns the prompts of the style, see style_utils."""
+    style_definition = style_utils.get_style(style)
+    if style_definition is None:
         raise ValueError(f"style {style} not supported")
-
-    examples = [input_prompt + example_pair[0] + output_prompt + example_pair[1] for example_pair in example_pairs]
-
-    return prompt_title, input_prompt, output_prompt, examples, example_pairs, keywords, continued_prompt_dict
+    return style_definition.prompt_title, style_definition.input_prompt, style_definition.output_prompt, list(style_definition.examples), list(style_definition.example_pairs), list(style_definition.keywords), style_definition.continued_prompt_dict
 
 def hijack_and_bad_quality_check(coarse_text: str, response_text: str, keywords: list):
     '''
@@ -472,129 +66,415 @@ def hijack_and_bad_quality_check(coarse_text: str, response_text: str, keywords:
 
 def gpt_response_to_clean_text(response, model):
     response_text = ''
-    if model == 'text-davinci-003' or model == 'text-curie-001':    
-        response_text = response['choices'][0].text
+    if not token_utils.is_chat_model(model):
+        response_text = response['choices'][0]['text']
         response_text = re.sub(r'\n{2,}', '\n', response_text)
         response_text = response_text.strip()
-    elif model == "gpt-3.5-turbo" or model == "gpt-4":
+    else:
         response_text = response["choices"][-1]["message"]["content"]
         response_text = re.sub(r'\n{2,}', '\n', response_text)
         response_text = response_text.strip()
     return response_text
 
-@retry(exceptions=openai.error.Timeout, tries=4)
-def gpt_completion(query_to_model, max_tokens=768, model='text-davinci-003', prev_msgs=[]):
-    if model == 'text-davinci-003' or model == 'text-curie-001':
-        print('Operating on ' + model)
-        return openai.Completion.create(
-            model=model, 
-            prompt=query_to_model,
-            temperature=0.7,
-            max_tokens=max_tokens,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            best_of=1,
-            request_timeout=COMPLETION_TIMEOUT)
-    elif model == "gpt-3.5-turbo" or model == "gpt-4":
-        print('Operating on ' + model)
-        new_msgs = prev_msgs + [{"role": "user", "content": query_to_model}] if query_to_model != '' else prev_msgs
-        if azure_flag:
-            print('Using Azure completion')
-            return openai.ChatCompletion.create(
-                engine="essence-gpt35turbo", 
-                messages=new_msgs)
+def get_completion_cache_key(query_to_model, max_tokens, model, prev_msgs, cache_scope):
+    if not token_utils.is_chat_model(model):
+        return cache_utils.get_completion_key(model, query_to_model, max_tokens, COMPLETION_TEMPERATURE, cache_scope)
+    new_msgs = prev_msgs + [{"role": "user", "content": query_to_model}] if query_to_model != '' else prev_msgs
+    return cache_utils.get_completion_key(model, new_msgs, max_tokens, CHAT_TEMPERATURE, cache_scope)
+
+def gpt_completion(query_to_model, max_tokens=768, model='text-davinci-003', prev_msgs=[], stream=False, cache_scope=None):
+    """Sends the query to the model. With stream=True, returns an iterator over the completion chunks.
+    Non-streamed completions are first looked up in the completion cache, see cache_utils.
+    cache_scope: None if the query may be shared between users; otherwise (private input) e.g. the username.
+    """
+    if stream:
+        return request_completion(query_to_model, max_tokens=max_tokens, model=model, prev_msgs=prev_msgs, stream=True)
+
+    cache_key = get_completion_cache_key(query_to_model, max_tokens, model, prev_msgs, cache_scope)
+    response = cache_utils.get_cached_completion(cache_key)
+    if response is None:
+        response = request_completion(query_to_model, max_tokens=max_tokens, model=model, prev_msgs=prev_msgs)
+        if response is not None:
+            cache_utils.cache_completion(cache_key, response)
+    return response
+
+@retry(exceptions=llm_utils.LLMRateLimitError, tries=4, delay=1, backoff=2, jitter=(0, 1))
+def request_completion(query_to_model, max_tokens=768, model='text-davinci-003', prev_msgs=[], stream=False):
+    """Sends the query to the model, see llm_utils. With stream=True, returns an iterator over the completion chunks.
+    The outcome of the call is recorded for routing, see routing_utils.record_call. Rate-limited calls are retried;
+    a timed out call is not, as the callers fall back to another model instead.
+    """
+    print('Operating on ' + model)
+    start_time = time.time()
+    try:
+        if not token_utils.is_chat_model(model):
+            response = llm_utils.completion(query_to_model, model, max_tokens=max_tokens, temperature=COMPLETION_TEMPERATURE, stream=stream, timeout=COMPLETION_TIMEOUT)
+        else:
+            new_msgs = prev_msgs + [{"role": "user", "content": query_to_model}] if query_to_model != '' else prev_msgs
+            if llm_utils.azure_flag:
+                print('Using Azure completion')
+            response = llm_utils.chat_completion(new_msgs, model, stream=stream, timeout=COMPLETION_TIMEOUT)
+    except llm_utils.LLMError:
+        routing_utils.record_call(model, False, time.time() - start_time)
+        raise
+    routing_utils.record_call(model, True, time.time() - start_time)
+    return response
+
+def gpt_streamed_completion(query_to_model, stream_handler, max_tokens=768, model='text-davinci-003', prev_msgs=[], cache_scope=None):
+    """Like gpt_completion, but streams the completion and passes every new piece of text to stream_handler('token', text).
+    stream_handler('reset', None) is sent first, so that the client discards text streamed by a previous (failed or earlier-pass) completion.
+    Returns a response of the same form as a non-streamed gpt_completion, so it can go through gpt_response_to_clean_text.
+    Shares the completion cache with gpt_completion; a cached completion is sent as a single piece.
+    """
+    stream_handler('reset', None)
+    is_chat_model = token_utils.is_chat_model(model)
+
+    cache_key = get_completion_cache_key(query_to_model, max_tokens, model, prev_msgs, cache_scope)
+    response = cache_utils.get_cached_completion(cache_key)
+    if response is not None:
+        stream_handler('token', response['choices'][-1]['message']['content'] if is_chat_model else response['choices'][0]['text'])
+        return response
+
+    response_text = ''
+    for chunk in request_completion(query_to_model, max_tokens=max_tokens, model=model, prev_msgs=prev_msgs, stream=True):
+        if len(chunk['choices']) == 0:
+            continue # Azure sends content-filtering chunks without choices
+        if is_chat_model:
+            text_delta = chunk['choices'][0]['delta'].get('content', '')
         else:
-            return openai.ChatCompletion.create(
-                model=model, 
-                messages=new_msgs,
-                request_timeout=COMPLETION_TIMEOUT)
-    return None
+            text_delta = chunk['choices'][0]['text']
+        if text_delta:
+            response_text += text_delta
+            stream_handler('token', text_delta)
 
-def get_gpt_response(prompt, coarse_text, output_prompt, keywords, model, initial_char_index=0, final_char_index=10000, max_tokens=768):
-    final_char_index = min(final_char_index, len(coarse_text))
+    if is_chat_model:
+        response = {'choices': [{'message': {'role': 'assistant', 'content': response_text}}]}
+    else:
+        response = {'choices': [{'text': response_text}]}
+    cache_utils.cache_completion(cache_key, response)
+    return response
+
+def get_gpt_response(prompt, coarse_text, output_prompt, keywords, model, initial_char_index=0, final_char_index=None, max_tokens=768, stream_handler=None, cache_scope=None):
+    """Sends prompt + coarse_text[initial_char_index:final_char_index] + output_prompt to the model.
+    The text is sized locally to fit the context window of the model (see token_utils), 
+    so that the first request is usually accepted. final_char_index is an optional upper bound on top of that.
+    When a call fails or times out, the next model of routing_utils.get_fallbacks is tried, with the text sized to its window.
+    stream_handler: if given, the completion is streamed to it, see gpt_streamed_completion.
+    cache_scope: see gpt_completion.
+    """
+    max_final_char_index = final_char_index
+    models = routing_utils.get_fallbacks(model)[:max_req_to_server]
 
     successful_response = False
-    number_of_attemps = 0
-    while not successful_response and number_of_attemps < max_req_to_server and final_char_index > initial_char_index:
-        number_of_attemps += 1
+    for i, model in enumerate(models):
+        budget_tokens = token_utils.get_input_budget(model, [prompt, output_prompt], max_tokens)
+        final_char_index = token_utils.fit_text_to_budget(coarse_text, budget_tokens, model, initial_char_index=initial_char_index)
+        if max_final_char_index is not None:
+            final_char_index = min(final_char_index, max_final_char_index)
+        final_char_index = min(final_char_index, len(coarse_text))
+        if final_char_index <= initial_char_index:
+            continue
 
-        text_to_decode = coarse_text[initial_char_index:final_char_index] # limit the text, since models are limited to 4k tokens
+        text_to_decode = coarse_text[initial_char_index:final_char_index] # limit the text, since models are limited in context window
         query_to_model = prompt + text_to_decode + output_prompt
         try:
-            response = gpt_completion(query_to_model, max_tokens=max_tokens, model=model)
+            if stream_handler is None:
+                response = gpt_completion(query_to_model, max_tokens=max_tokens, model=model, cache_scope=cache_scope)
+            else:
+                response = gpt_streamed_completion(query_to_model, stream_handler, max_tokens=max_tokens, model=model, cache_scope=cache_scope)
             response_text = gpt_response_to_clean_text(response, model)
             successful_response = True
-        except openai.error.Timeout:
-            time.sleep(0.3)
-            print('BIG Timeout. Trying again.')
-            continue
+            break
         except Exception as e:
-            print(e)
-            final_char_index -= CHARS_TO_DECREASE_ON_DECLINE
-            print('Decreasing amount of tokens. New final_char_index: ', final_char_index)
-            time.sleep(0.3) # wait a little, to not to overquery the API
-            
-    if number_of_attemps == max_req_to_server:
+            if i < len(models) - 1:
+                routing_utils.log_fallback('summary', model, models[i + 1], e)
+            else:
+                print(e)
+
+    if not successful_response:
         return False, 'ERROR: Server encountered problems or query is long.', 0
     
-    if final_char_index < initial_char_index:
-        return False, 'ERROR: Processing failed.', 0
-    
     if (keywords is not None) and hijack_and_bad_quality_check(coarse_text, response_text, keywords):
         raise Exception('Hijacked')
     
     return True, response_text, final_char_index
 
-def get_gpt_summary(coarse_text, style='travel', max_char_length=10000, model='text-davinci-003', backwards_chars=0):
+def get_window_final_char_index(text, prompt, output_prompt, model, max_tokens, initial_char_index=0, max_char_length=None):
+    """Returns the end of the window of text starting at initial_char_index that fits a single call.
+    max_char_length: optional upper bound on the window length, in characters.
+    """
+    budget_tokens = token_utils.get_input_budget(model, [prompt, output_prompt], max_tokens)
+    final_char_index = token_utils.fit_text_to_budget(text, budget_tokens, model, initial_char_index=initial_char_index)
+    if max_char_length is not None:
+        final_char_index = min(final_char_index, initial_char_index + max_char_length)
+    return min(final_char_index, len(text))
+
+def split_text_to_chunks(text, prompt, output_prompt, model, max_chunks, max_char_length=None, boundary_fraction=0.2):
+    """Splits text into consecutive chunks, each fitting a single call with prompt and output_prompt.
+    Where possible, a chunk ends at a paragraph or sentence boundary found in its last boundary_fraction.
+    At most max_chunks chunks are returned; the rest of the text is dropped.
+    """
+    chunks = []
+    start = 0
+    while start < len(text) and len(chunks) < max_chunks:
+        end = get_window_final_char_index(text, prompt, output_prompt, model, 768, initial_char_index=start, max_char_length=max_char_length)
+        if end <= start:
+            break
+        if end < len(text):
+            min_end = end - int((end - start) * boundary_fraction)
+            boundary = max(text.rfind('\n', min_end, end), text.rfind('. ', min_end, end))
+            if boundary > start:
+                end = boundary + 1
+        chunks.append(text[start:end])
+        start = end
+    if start < len(text):
+        print('Map-reduce: dropping ' + str(len(text) - start) + ' characters beyond ' + str(max_chunks) + ' chunks.')
+    return chunks
+
+def reduce_partial_summaries(partial_summaries, continued_prompt_dict, model, stream_handler=None, cache_scope=None):
+    """Merges partial summaries into one, using the reduce prompts of continued_prompt_dict.
+    When the partial summaries do not fit into a single call, they are merged in groups (concurrently),
+    and the merged groups are reduced again - i.e. a tree of reduce calls.
+    Only the last reduce call is streamed to stream_handler.
+    """
+    partial_prompt = continued_prompt_dict["reduce_partial_prompt"]
+    budget_tokens = token_utils.get_input_budget(
+        model, 
+        [continued_prompt_dict["reduce_prompt_title"], continued_prompt_dict["reduce_output_prompt"]], 
+        MULTIPLE_PASSES_MAX_TOKENS)
+    while len(partial_summaries) > 1:
+        # group consecutive partial summaries such that every group fits a single call
+        groups = [[]]
+        group_tokens = 0
+        for partial_summary in partial_summaries:
+            partial_tokens = token_utils.count_tokens(partial_prompt + partial_summary, model)
+            if groups[-1] and group_tokens + partial_tokens > budget_tokens:
+                groups.append([])
+                group_tokens = 0
+            groups[-1].append(partial_summary)
+            group_tokens += partial_tokens
+        if len(groups) == len(partial_summaries):
+            # no two partial summaries fit together; merge them pairwise so that the tree still converges
+            groups = [partial_summaries[i:i+2] for i in range(0, len(partial_summaries), 2)]
+
+        print('Reducing ' + str(len(partial_summaries)) + ' partial summaries in ' + str(len(groups)) + ' group(s)...')
+        futures = [map_reduce_executor.submit(
+            get_gpt_response,
+            continued_prompt_dict["reduce_prompt_title"],
+            ''.join([partial_prompt + partial_summary for partial_summary in group]),
+            continued_prompt_dict["reduce_output_prompt"],
+            continued_prompt_dict["reduce_keywords"],
+            model,
+            max_tokens=MULTIPLE_PASSES_MAX_TOKENS,
+            stream_handler=stream_handler if len(groups) == 1 else None,
+            cache_scope=cache_scope) if len(group) > 1 else None for group in groups]
+
+        reduced_summaries = []
+        for group, future in zip(groups, futures):
+            if future is None:
+                reduced_summaries.append(group[0])
+                continue
+            success_flag, response_text, _ = future.result()
+            if not success_flag:
+                return success_flag, response_text
+            reduced_summaries.append(response_text)
+        partial_summaries = reduced_summaries
+
+    return True, partial_summaries[0]
+
+def get_gpt_summary_map_reduce(coarse_text, prompt, output_prompt, keywords, continued_prompt_dict, model, max_char_length=None, stream_handler=None, cache_scope=None):
+    """Summarizes long text in map-reduce fashion.
+    The text is split into chunks, the chunks are summarized concurrently (map), 
+    and the chunk summaries are merged by one or more reduce calls (reduce).
+    A chunk whose call failed is tried once more; if it fails again, the summary fails, rather than leave out part of the text.
+    Returns response_text and the number of gpt credits.
+    """
+    chunks = split_text_to_chunks(coarse_text, prompt, output_prompt, model, MAP_REDUCE_MAX_CHUNKS, max_char_length=max_char_length)
+    print('Map-reduce over ' + str(len(chunks)) + ' chunk(s)...')
+    if stream_handler is not None:
+        stream_handler('progress', 'Summarizing ' + str(len(chunks)) + ' parts of the text...')
+    with metrics_utils.span('map', model=model):
+        futures = [map_reduce_executor.submit(
+            get_gpt_response, prompt, chunk, output_prompt, keywords, model, cache_scope=cache_scope) for chunk in chunks]
+
+        partial_summaries = []
+        for i, future in enumerate(futures):
+            success_flag, response_text, _ = future.result()
+            if not success_flag:
+                print('Map-reduce: chunk ' + str(i + 1) + ' of ' + str(len(chunks)) + ' failed, trying it again...')
+                success_flag, response_text, _ = get_gpt_response(prompt, chunks[i], output_prompt, keywords, model, cache_scope=cache_scope)
+            if not success_flag:
+                print('Map-reduce: chunk ' + str(i + 1) + ' of ' + str(len(chunks)) + ' failed again. Failing the summary.')
+                for other_future in futures:
+                    other_future.cancel()
+                return response_text, 1
+            partial_summaries.append(response_text)
+
+    if len(partial_summaries) == 1:
+        return partial_summaries[0], 1
+
+    with metrics_utils.span('reduce', model=model):
+        success_flag, response_text = reduce_partial_summaries(partial_summaries, continued_prompt_dict, model, stream_handler=stream_handler, cache_scope=cache_scope)
+    return response_text, 2
+
+def get_document_digest(coarse_text, model, stream_handler=None, cache_scope=None):
+    """Returns the style-neutral digest of the text (see digest_utils), from the cache or written now. Returns '' on failure.
+    The text is split into parts that fit a call each; the parts are digested concurrently and their digests joined in order.
+    """
+    key = digest_utils.get_digest_key(coarse_text, model, cache_scope=cache_scope)
+    digest = digest_utils.get_cached_digest(key)
+    if digest is not None:
+        print('Using cached digest...')
+        return digest
+
+    with digest_utils.digest_lock(key):
+        digest = digest_utils.get_cached_digest(key)
+        if digest is None:
+            if stream_handler is not None:
+                stream_handler('progress', 'Reading the whole text...')
+            chunks = split_text_to_chunks(coarse_text, digest_utils.get_part_prompt(MAP_REDUCE_MAX_CHUNKS, MAP_REDUCE_MAX_CHUNKS), digest_utils.DIGEST_OUTPUT_PROMPT, model, MAP_REDUCE_MAX_CHUNKS)
+            print('Digesting ' + str(len(chunks)) + ' part(s)...')
+            with metrics_utils.span('digest', model=model):
+                futures = [map_reduce_executor.submit(
+                    get_gpt_response, digest_utils.get_part_prompt(i + 1, len(chunks)), chunk, digest_utils.DIGEST_OUTPUT_PROMPT, None, model,
+                    max_tokens=digest_utils.get_part_max_tokens(len(chunks)), cache_scope=cache_scope) for i, chunk in enumerate(chunks)]
+                results = [future.result() for future in futures]
+            if all(success_flag for success_flag, _, _ in results):
+                digest = '\n'.join(response_text for _, response_text, _ in results)
+                digest_utils.cache_digest(key, digest)
+            else:
+                digest = ''
+    return digest
+
+def get_gpt_summary(coarse_text, style='travel', max_char_length=None, model='text-davinci-003', backwards_chars=0, max_passes=MAX_GPT_PASSES, stream_handler=None, cache_scope=None, share_digest=False):
     """Get a summary based on GPT-3 API.
     coarse_text: text to be parsed by GPT-3
     style: style of the text, e.g. 'travel'
-    final_char_index: index of the last character of coarse_text to be processed by GPT-3
-
-    The prompts are defined in get_gpt_prompt(style) function.
+    max_char_length: optional upper bound on the characters of coarse_text sent in a single pass. 
+                     By default, every pass gets as much text as fits the context window of the model.
+
+    The prompts are defined in styles.yml, see style_utils.
+    Long texts are handled according to continued_prompt_dict["mode"]: 
+        'chained' - passes run one after the other, each revising the previous output.
+        'map_reduce' - chunks are summarized concurrently and then merged, see get_gpt_summary_map_reduce.
+    unless the style has compression: extractive, in which case the text is compressed to a single pass (see nlp_utils.compress_text_extractive).
+    Chained passes are checkpointed, so that a run cut short is resumed at its next pass, see checkpoint_utils.
+    max_passes: with fewer than MAX_GPT_PASSES, a chained summary stops after max_passes and leaves a checkpoint for the
+                rest, to be picked up by a later call with the default (see summarize_text and refine_summary).
+    A style with digest: true (and without extractive compression) summarizes a text longer than a single pass from its digest
+    instead, see get_document_digest - if the digest is cached, or if share_digest is set: other styles of the text read it too.
+    stream_handler: if given, the completions are streamed to it, see gpt_streamed_completion.
+    cache_scope: see gpt_completion.
+    Returns (response_text, gpt_credits, unfinished) - unfinished is True if the summary stopped at max_passes and left a checkpoint.
     """
-    try:
-        prompt_title, input_prompt, output_prompt, examples, example_pairs, keywords, continued_prompt_dict = get_gpt_prompt(style=style)
-    except ValueError as e:
-        print(e)
-        return '', 0
+    style_definition = style_utils.get_style(style)
+    if style_definition is None:
+        print(f"style {style} not supported")
+        return '', 0, False
+    output_prompt, keywords, continued_prompt_dict = style_definition.output_prompt, style_definition.keywords, style_definition.continued_prompt_dict
+
+    first_pass_prompt = style_definition.first_pass_prompt
+    first_pass_final_char_index = get_window_final_char_index(coarse_text, first_pass_prompt, output_prompt, model, 768, max_char_length=max_char_length)
+
+    if style_definition.compression == 'extractive' and first_pass_final_char_index < len(coarse_text):
+        if stream_handler is not None:
+            stream_handler('progress', 'Selecting the key sentences of the text...')
+        budget_tokens = token_utils.get_input_budget(model, [first_pass_prompt, output_prompt], 768)
+        with metrics_utils.span('extractive_compression', style=style, model=model):
+            compressed_text = nlp_utils.compress_text_extractive(coarse_text, budget_tokens, model, max_chars=max_char_length)
+        # never summarize an empty text; the start of the text is what a single pass would read anyway
+        coarse_text = compressed_text if compressed_text != '' else coarse_text[:first_pass_final_char_index]
+        first_pass_final_char_index = len(coarse_text)
+
+    if style_definition.digest and digest_utils.USE_DOCUMENT_DIGEST and first_pass_final_char_index < len(coarse_text):
+        # a digest is only written for several styles of the text that read it; otherwise the text itself is read, unless the digest is cached
+        if share_digest:
+            digest = get_document_digest(coarse_text, model, stream_handler=stream_handler, cache_scope=cache_scope)
+        else:
+            digest = digest_utils.get_cached_digest(digest_utils.get_digest_key(coarse_text, model, cache_scope=cache_scope)) or ''
+        if digest != '':
+            print('Summarizing from the digest of the text...')
+            coarse_text = digest
+            first_pass_final_char_index = get_window_final_char_index(coarse_text, first_pass_prompt, output_prompt, model, 768, max_char_length=max_char_length)
+
+    if (continued_prompt_dict is not None) and continued_prompt_dict.get("mode") == "map_reduce" and first_pass_final_char_index < len(coarse_text):
+        response_text, gpt_credits = get_gpt_summary_map_reduce(
+            coarse_text, 
+            first_pass_prompt, 
+            output_prompt, 
+            keywords, 
+            continued_prompt_dict, 
+            model, 
+            max_char_length=max_char_length,
+            stream_handler=stream_handler,
+            cache_scope=cache_scope)
+        return response_text, gpt_credits, False
 
     gpt_credits = 1
-
-    # single pass
-    print('First pass... ' + str(len(coarse_text)))
-    success_flag, response_text, actual_final_char_index = get_gpt_response(
-        prompt_title + ''.join(examples) + input_prompt, 
-        coarse_text, 
-        output_prompt, 
-        keywords,
-        model,
-        initial_char_index=0, final_char_index=max_char_length)
+    passes = 1
+
+    # a chained summary resumes from the checkpoint of an earlier run that was cut short, if there is one
+    checkpoint_key, checkpoint = None, None
+    if (continued_prompt_dict is not None) and first_pass_final_char_index < len(coarse_text):
+        checkpoint_key = checkpoint_utils.get_checkpoint_key(coarse_text, style, model, max_char_length=max_char_length, cache_scope=cache_scope)
+        checkpoint = checkpoint_utils.load_checkpoint(checkpoint_key)
+
+    if checkpoint is not None:
+        print('Resuming after pass ' + str(checkpoint['passes']) + ' from a checkpoint...')
+        if stream_handler is not None:
+            stream_handler('progress', 'Continuing from part ' + str(checkpoint['passes'] + 1) + ' of the text...')
+        success_flag, response_text, actual_final_char_index = True, checkpoint['response_text'], checkpoint['actual_final_char_index']
+        passes, gpt_credits = checkpoint['passes'], checkpoint['gpt_credits']
+    else:
+        # single pass
+        print('First pass... ' + str(len(coarse_text)))
+        with metrics_utils.span('first_pass', style=style, model=model):
+            success_flag, response_text, actual_final_char_index = get_gpt_response(
+                first_pass_prompt, 
+                coarse_text, 
+                output_prompt, 
+                keywords,
+                model,
+                initial_char_index=0, final_char_index=first_pass_final_char_index,
+                stream_handler=stream_handler,
+                cache_scope=cache_scope)
 
     # multiple passes
     if (continued_prompt_dict is not None) and success_flag and (actual_final_char_index < len(coarse_text)):
-        gpt_credits += 1
-        passes = 1
-        while success_flag and (actual_final_char_index < len(coarse_text)) and passes < MAX_GPT_PASSES:
+        while success_flag and (actual_final_char_index < len(coarse_text)) and passes < min(max_passes, MAX_GPT_PASSES):
+            gpt_credits = 2
+            if checkpoint_key is not None:
+                checkpoint_utils.save_checkpoint(checkpoint_key, passes, response_text, actual_final_char_index, gpt_credits)
             print('Continuing with the next pass...')
-            success_flag, response_text, actual_final_char_index = get_gpt_response(
-                continued_prompt_dict["continued_prompt_title"] + continued_prompt_dict["continued_prev_data_prompt"] + response_text + continued_prompt_dict["continued_new_text_prompt"], 
-                coarse_text, 
-                continued_prompt_dict['continued_output_prompt'], 
-                continued_prompt_dict['keywords'], 
-                model, 
-                initial_char_index=actual_final_char_index - backwards_chars, final_char_index=actual_final_char_index + max_char_length - backwards_chars,
-                max_tokens=MULTIPLE_PASSES_MAX_TOKENS)
+            initial_char_index = actual_final_char_index - backwards_chars
+            with metrics_utils.span('continued_pass', style=style, model=model):
+                success_flag, response_text, actual_final_char_index = get_gpt_response(
+                    continued_prompt_dict["continued_prompt_title"] + continued_prompt_dict["continued_prev_data_prompt"] + response_text + continued_prompt_dict["continued_new_text_prompt"], 
+                    coarse_text, 
+                    continued_prompt_dict['continued_output_prompt'], 
+                    continued_prompt_dict['keywords'], 
+                    model, 
+                    initial_char_index=initial_char_index, 
+                    final_char_index=None if max_char_length is None else initial_char_index + max_char_length,
+                    max_tokens=MULTIPLE_PASSES_MAX_TOKENS,
+                    stream_handler=stream_handler,
+                    cache_scope=cache_scope)
             passes += 1
 
-    return response_text, gpt_credits
+    # a failed pass keeps the checkpoint of the passes before it, for the retry
+    unfinished = checkpoint_key is not None and success_flag and actual_final_char_index < len(coarse_text) and passes < MAX_GPT_PASSES
+    if unfinished:
+        checkpoint_utils.save_checkpoint(checkpoint_key, passes, response_text, actual_final_char_index, gpt_credits)
+    elif checkpoint_key is not None and success_flag:
+        checkpoint_utils.clear_checkpoint(checkpoint_key)
 
-def get_title_for_entry(coarse_text, query_to_model='', model='gpt-3.5-turbo') -> str:
+    return response_text, gpt_credits, unfinished
+
+def get_title_for_entry(coarse_text, query_to_model='', model=routing_utils.TITLE_MODEL, cache_scope=None) -> str:
     """
     Get a title of the entry from the text.
     coarse_text: text to be processed by a title-generating-model
-    model: model to be used by OpenAI API (currently we only use OpenAI, but other models can be used)
+    model: model to be used by OpenAI API; TITLE_MODEL, the cheapest and fastest one, by default
     """
 
     # We prompt the model with the very beginning of the text, assuming that the title is there
@@ -606,7 +486,7 @@ def get_title_for_entry(coarse_text, query_to_model='', model='gpt-3.5-turbo') -
     number_of_attempts = 0
     while (not successful_flag) and number_of_attempts < 5:
         try:
-            response = gpt_completion(query_to_model, max_tokens=64, model=model)
+            response = gpt_completion(query_to_model, max_tokens=64, model=model, cache_scope=cache_scope)
             successful_flag = True
             response_text = gpt_response_to_clean_text(response, model)
         except Exception as e:
@@ -618,118 +498,431 @@ def get_title_for_entry(coarse_text, query_to_model='', model='gpt-3.5-turbo') -
 
     # some specific cleanings for title generation
     response_text = response_text.replace('"', '') # remove quotes, since they sometimes come up as wrapping of the title in the output
-    if response_text[-1] == '.': 
+    if response_text != '' and response_text[-1] == '.': 
         response_text = response_text[:-1]  # remove '.' in the end of response_text if exists
 
     return response_text
 
-def process_url(request_dict, data_path, max_char_length=1000, model='text-davinci-003'):
-    """Process URL and return structured data.
-    request_dict: dictionary with the following keys:
-        URL: URL of the web page
-        style: style of the web page
-        max_char_length: denotes how many leading characters of the text to be processed by GPT-3
-                         Default value of 1000 for development purposes, since GPT-3 is expensive
-    The function defines a failed output by default, and updates it if the processing is successful.
+def get_title(coarse_text, metadata, url='', cache_scope=None) -> str:
+    """
+    Get a title of the entry: the title in the page metadata (see scraping_utils.url_to_text) if it is usable,
+    otherwise one generated by get_title_for_entry.
+    """
+    title = scraping_utils.get_metadata_title(metadata, url)
+    if title != '':
+        print('Using title from metadata (' + metadata.get('title_source', '') + '): ' + title)
+        return title
+    return get_title_for_entry(coarse_text, cache_scope=cache_scope)
+
+def get_gpt_summary_with_variant(coarse_text, style, max_char_length=None, model='text-davinci-003', max_passes=MAX_GPT_PASSES, stream_handler=None, cache_scope=None, share_digest=False):
+    """Runs get_gpt_summary, and if the output seems hijacked, tries again with the '_variant' of the style if exists.
+    Returns (response, gpt_credits, unfinished), see get_gpt_summary. Never raises; returns ('', 0, False) on failure.
+    """
+    try:
+        response, gpt_credits, unfinished = get_gpt_summary(coarse_text, style=style, max_char_length=max_char_length, model=model, max_passes=max_passes, stream_handler=stream_handler, cache_scope=cache_scope, share_digest=share_digest)
+    except Exception as e:
+        variant = style_utils.get_variant(style)
+        if 'Hijacked' in str(e) and variant is not None:
+            print('Hijacked error occured. Trying again with ' + variant.name)
+            try:
+                response, gpt_credits, unfinished = get_gpt_summary(coarse_text, style=variant.name, max_char_length=max_char_length, model=model, max_passes=max_passes, stream_handler=stream_handler, cache_scope=cache_scope, share_digest=share_digest)
+            except Exception as e:
+                print('Some error occured on second try. Error: ', e)
+                response, gpt_credits, unfinished = '', 0, False
+        else:
+            print(e)
+            response, gpt_credits, unfinished = '', 0, False
+    return response, gpt_credits, unfinished
+
+def run_timed(func, *args, **kwargs):
+    """Runs func(*args, **kwargs) and returns its result together with the time it took, in seconds."""
+    start_time = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start_time
+
+def record_stage_latency(stage_latency, style, model):
+    """Records the stage latencies of summarize_text in metrics_utils. The scraping is recorded once per document, by fetch_text."""
+    for stage, seconds in stage_latency.items():
+        if stage != 'scraping':
+            metrics_utils.observe('essence_stage_seconds', seconds, stage=stage, style=style, model='' if stage == 'title' else model)
+
+def get_fallback_title(coarse_text, max_length=60):
+    """A title taken from the text itself, used when the title model fails."""
+    first_line = coarse_text.strip().split('\n')[0].strip()
+    if len(first_line) > max_length:
+        first_line = first_line[:max_length].rsplit(' ', 1)[0] + '...'
+    return first_line
+
+def fetch_text(request_dict, data_path, refresh=False):
+    """Gets the text of a process request: the marked text, or the text of the URL - from the HTML, if supplied.
+    refresh: the URL is fetched again even if it is cached, see scraping_utils.url_to_text.
+    Returns (document, error). document is a dictionary with the keys url, coarse_text (the text to be processed by GPT-3,
+    after it was processed by a cleaning backend such as jusText or Trafilatura), original_web (the downloaded webpage),
+    metadata (e.g. the title of the page, if it has one), marked_text and scraping_latency.
+    On failure, document is None and error is the message for the user.
     """
-    
-    output = {
-        'URL': request_dict['URL'] if 'URL' in request_dict else '', 
-        'style': request_dict['style'] if 'style' in request_dict else '', 
-        'output': '',
-        'status': 'FAILED'}
-
-    # get the URL
     url = request_dict['URL'] if 'URL' in request_dict else ''
-    
-    # check validity of url
     if url == '':
-        output['output'] = 'ERROR: no URL provided.'
-        return output
+        return None, 'ERROR: no URL provided.'
 
-    # get the style
-    style = request_dict['style'] if 'style' in request_dict else ''
-    
+    start_time = time.time()
     if 'is_marked_text' in request_dict and request_dict['is_marked_text']:
         # we use the marked text by the user, instead of scraping the URL
         if 'marked_text' not in request_dict:
-            output['output'] = 'ERROR: marked text not provided.'
-            return output
+            return None, 'ERROR: marked text not provided.'
         request_dict['marked_text'] = nlp_utils.clean_marked_text(request_dict['marked_text'])
         if len(request_dict['marked_text']) < MIN_MARKED_TEXT_LENGTH:
-            output['output'] = 'ERROR: marked text too short.'
-            return output
+            return None, 'ERROR: marked text too short.'
         coarse_text = request_dict['marked_text']
         original_url_webpage = request_dict['marked_text']
-    elif 'is_marked_text' not in request_dict or not request_dict['is_marked_text']:    
-        # get the text from the URL - or - if supplied, from the HTML.
-        # original_url_webpage is simply the downloaded webpage
-        # coarse_text is the text to be processed by GPT-3, after it was processed by a cleaning backend
-        # such as jusText or Trafilatura
+        metadata = {}
+    else:
         if request_dict['web_html'] == '':
-            coarse_text, original_url_webpage = scraping_utils.url_to_text(url, data_path)
+            coarse_text, original_url_webpage, metadata = scraping_utils.url_to_text(url, data_path, refresh=refresh)
         else:
-            coarse_text, original_url_webpage = scraping_utils.html_to_text(request_dict['web_html'])
+            coarse_text, original_url_webpage, metadata = scraping_utils.html_to_text(request_dict['web_html'])
         if coarse_text == '':
-            output['output'] = 'ERROR: time-out or problem cleaning the webpage. Try marking the text you\'re interested in and click the Brush button to Process that text in particular.'
-            return output
+            return None, 'ERROR: time-out or problem cleaning the webpage. Try marking the text you\'re interested in and click the Brush button to Process that text in particular.'
 
     # We previously limited the use to English only. For not we allow all languages.
     if False: # nlp_utils.text_not_in_english(coarse_text):
-        output['output'] = 'ERROR: We currently only support English.'
-        return output
+        return None, 'ERROR: We currently only support English.'
+
+    scraping_latency = time.time() - start_time
+    metrics_utils.observe('essence_stage_seconds', scraping_latency, stage='scraping')
+    return {
+        'url': url,
+        'coarse_text': coarse_text,
+        'original_web': original_url_webpage,
+        'metadata': metadata,
+        'marked_text': request_dict['marked_text'] if 'marked_text' in request_dict else '',
+        'scraping_latency': scraping_latency}, ''
+
+def get_html_tables_output(document, style):
+    """The output of the tabularize style taken from the tables in the HTML of the document, without the model (see scraping_utils.html_to_tables).
+    Returns (model_output, output): the tables as the model would write them, and parsed as by parse_utils.parse_gpt_response
+    - the first table under 'Table', the next ones under 'Table 2', 'Table 3', ...
+    Returns ('', None) for other styles, marked text, and pages without data tables, which are left to the model.
+    """
+    if style != parse_utils.TABULARIZE_STYLE_NAME or document['marked_text'] != '':
+        return '', None
+    tables = scraping_utils.html_to_tables(document['original_web'])
+    if len(tables) == 0:
+        return '', None
+    output = [{'key': 'Table' if i == 0 else 'Table ' + str(i + 1), 'value': table} for i, table in enumerate(tables)]
+    model_output = '\n'.join(item['key'] + ':\n' + '\n'.join(' | '.join(cell.replace('|', '/') for cell in row) for row in item['value']) for item in output)
+    return model_output, output
+
+def summarize_text(document, style, title_future, max_char_length=None, model='text-davinci-003', max_passes=MAX_GPT_PASSES, stream_handler=None, cache_scope=None, share_digest=False):
+    """Summarizes a document fetched by fetch_text in the style, and returns the output of process_url.
+    title_future: future of (title, latency), see get_title and run_timed. The title only depends on the text (or metadata),
+                  so it is generated at the same time as the summary - once for all the styles of a document.
+    model: the requested model; the summary is routed by routing_utils.route, which may pick another one (output["model"]).
+    max_passes: see get_gpt_summary. output["refining"] is True if passes were left for refine_summary.
+    share_digest: the document is summarized in other styles that read its digest as well, see should_share_digest.
+    """
+    output = {'URL': document['url'], 'style': style, 'output': '', 'status': 'FAILED'}
+    stage_latency = {'scraping': document['scraping_latency']}
+    start_time = time.time()
+
+    # tables of the HTML are taken as they are; the model only tabularizes text
+    (response, parsed_output), stage_latency['html_tables'] = run_timed(get_html_tables_output, document, style)
+    if parsed_output is not None:
+        print('Using the tables of the HTML...')
+        gpt_credits, unfinished, model = 0, False, ''
+    else:
+        style_definition = style_utils.get_style(style)
+        if style_definition is not None:
+            model = routing_utils.route('summary', text=document['coarse_text'], prompts=[style_definition.first_pass_prompt, style_definition.output_prompt], style=style, preferred=model)[0]
 
-    # Get the structured data from GPT-3
-    try:
-        response, gpt_credits = get_gpt_summary(coarse_text, style=style, max_char_length=max_char_length, model=model)
-    except Exception as e:
-        if 'Hijacked' in str(e):
-            print('Hijacked error occured. Trying again with variant if exists.')
-            try:
-                response, gpt_credits = get_gpt_summary(coarse_text, style=style + '_variant', max_char_length=max_char_length, model=model)
-            except Exception as e:
-                print('Some error occured on second try. Error: ', e)
-                response, gpt_credits = '', 0
-        else:
-            response, gpt_credits = '', 0
-            
-    if response == '':
-        output['output'] = 'ERROR: problem occured. Try changing the style or shorten the text.'
-        return output
-    elif response.startswith('ERROR'):
-        output['output'] = response
+        # Get the structured data from GPT-3.
+        (response, gpt_credits, unfinished), stage_latency['summary'] = run_timed(get_gpt_summary_with_variant, document['coarse_text'], style, max_char_length=max_char_length, model=model, max_passes=max_passes, stream_handler=stream_handler, cache_scope=cache_scope, share_digest=share_digest)
+
+    if response == '' or response.startswith('ERROR'):
+        print('Stage latency: ' + str(stage_latency))
+        record_stage_latency(stage_latency, style, model)
+        output['output'] = response if response != '' else 'ERROR: problem occured. Try changing the style or shorten the text.'
         return output
 
     # convert the structured data to a dictionary
     output["model_output"] = response
-    output["output"] = parse_gpt_response(output["model_output"], style=style)
+    if parsed_output is not None:
+        output["output"] = parsed_output
+    else:
+        output["output"], stage_latency['parsing'] = run_timed(parse_utils.parse_gpt_response, output["model_output"], style=style)
 
-    output["title"] = get_title_for_entry(coarse_text)
+    # a failed title does not fail the request
+    try:
+        output["title"], stage_latency['title'] = title_future.result()
+    except Exception as e:
+        print('Title stage failed. Error: ', e)
+        output["title"] = ''
+    if output["title"] in ['', 'ERROR OCCURRED']:
+        output["title"] = get_fallback_title(document['coarse_text'])
+
+    stage_latency['total'] = stage_latency['scraping'] + time.time() - start_time
+    print('Stage latency: ' + str(stage_latency))
+    record_stage_latency(stage_latency, style, model)
+    output["stage_latency"] = stage_latency
 
-    output["cleaned_text"] = coarse_text
-    output["original_web"] = original_url_webpage
-    output["marked_text"] = request_dict["marked_text"] if 'marked_text' in request_dict else ''
+    output["cleaned_text"] = document['coarse_text']
+    output["original_web"] = document['original_web']
+    output["marked_text"] = document['marked_text']
 
     output["status"] = "SUCCESS"
     output["gpt_credits"] = gpt_credits
+    output["model"] = model
+    output["refining"] = unfinished
+
+    return output
+
+def refine_summary(coarse_text, style, model, max_char_length=None, cache_scope=None):
+    """Runs the passes left by a summary with max_passes (see summarize_text), resuming from its checkpoint.
+    model, max_char_length and cache_scope have to be those of the first call - output["model"] for the model.
+    Returns a dictionary with status, and on success output (parsed), model_output and gpt_credits (of the whole summary).
+    """
+    response, gpt_credits, _ = get_gpt_summary_with_variant(coarse_text, style, max_char_length=max_char_length, model=model, cache_scope=cache_scope)
+    if response == '' or response.startswith('ERROR'):
+        return {'status': 'FAILED', 'output': response}
+    return {
+        'status': 'SUCCESS',
+        'output': parse_utils.parse_gpt_response(response, style=style),
+        'model_output': response,
+        'gpt_credits': gpt_credits}
+
+def revise_output(cached_output, request_dict, data_path, model='text-davinci-003', cache_scope=None):
+    """Brings a cached output of process_url up to date with the current text of its page, see diff_utils.
+    cached_output: see server_utils.should_use_cached_data. request_dict: the request, as for process_url.
+    Returns a dictionary with status:
+        'UNCHANGED' - the text did not change, or could not be fetched: the cached output stands.
+        'SUCCESS' - the output revised from the changed paragraphs, with the keys of the output of process_url.
+        'FAILED' - the text changed too much, or the revision failed: the request should be processed from scratch.
+    Tables of the HTML are extracted again instead (see get_html_tables_output), as that needs no model.
+    """
+    style = cached_output['style']
+    document, error = fetch_text(request_dict, data_path, refresh=True)
+    if document is None:
+        print('Could not fetch the text to revise, keeping the cached output: ' + error)
+        return {'status': 'UNCHANGED'}
+
+    response_text, parsed_output = get_html_tables_output(document, style)
+    if parsed_output is not None:
+        return {
+            'URL': cached_output['URL'],
+            'style': style,
+            'output': parsed_output,
+            'model_output': response_text,
+            'original_web': document['original_web'],
+            'cleaned_text': document['coarse_text'],
+            'from_cached_query': cached_output['from_cached_query'],
+            'title': cached_output['title'],
+            'status': 'SUCCESS' if response_text != cached_output['model_output'] else 'UNCHANGED',
+            'gpt_credits': 0,
+            'model': ''}
+
+    with metrics_utils.span('diff', style=style):
+        changed_fraction, changes = diff_utils.get_changes(cached_output['cleaned_text'], document['coarse_text'])
+    if len(changes) == 0:
+        metrics_utils.count('essence_revise_total', outcome='unchanged')
+        return {'status': 'UNCHANGED'}
+    print('The text changed: ' + str(len(changes)) + ' changes, ' + str(round(changed_fraction * 100, 1)) + '% of the text.')
+    style_definition = style_utils.get_style(style)
+    if changed_fraction > diff_utils.REVISE_MAX_CHANGED_FRACTION or style_definition is None or cached_output['model_output'] == '':
+        metrics_utils.count('essence_revise_total', outcome='changed_too_much')
+        return {'status': 'FAILED'}
+
+    changes_text = diff_utils.format_changes(changes)
+    prompt = diff_utils.get_revise_prompt(cached_output['model_output'])
+    model = routing_utils.route('revise', text=changes_text, prompts=[prompt, diff_utils.REVISE_OUTPUT_PROMPT], max_tokens=MULTIPLE_PASSES_MAX_TOKENS, style=style, preferred=model)[0]
+    try:
+        with metrics_utils.span('revise', style=style, model=model):
+            success_flag, response_text, final_char_index = get_gpt_response(
+                prompt,
+                changes_text,
+                diff_utils.REVISE_OUTPUT_PROMPT,
+                None,
+                model,
+                max_tokens=MULTIPLE_PASSES_MAX_TOKENS,
+                cache_scope=cache_scope)
+    except Exception as e:
+        print('Revision failed. Error: ', e)
+        success_flag = False
+    # the changes have to fit a single call, otherwise the revision would miss some of them. The hijack check is against
+    # the whole text, as the previous output may hold keywords of the paragraphs that did not change.
+    if not success_flag or final_char_index < len(changes_text) or hijack_and_bad_quality_check(document['coarse_text'], response_text, style_definition.keywords):
+        metrics_utils.count('essence_revise_total', outcome='failed')
+        return {'status': 'FAILED'}
+
+    metrics_utils.count('essence_revise_total', outcome='revised')
+    return {
+        'URL': cached_output['URL'],
+        'style': style,
+        'output': parse_utils.parse_gpt_response(response_text, style=style),
+        'model_output': response_text,
+        'original_web': document['original_web'],
+        'cleaned_text': document['coarse_text'],
+        'from_cached_query': cached_output['from_cached_query'],
+        'title': cached_output['title'],
+        'status': 'SUCCESS',
+        'gpt_credits': 1,
+        'model': model}
+
+def process_url(request_dict, data_path, max_char_length=None, model='text-davinci-003', max_passes=MAX_GPT_PASSES, stream_handler=None, cache_scope=None):
+    """Process URL and return structured data.
+    request_dict: dictionary with the following keys:
+        URL: URL of the web page
+        style: style of the web page
+    max_char_length: optional upper bound on how many characters of the text are processed by GPT-3 in a single pass.
+                     By default, the text is sized to the context window of the model.
+    stream_handler: if given, the summary completions are streamed to it as they arrive, see gpt_streamed_completion.
+    cache_scope: scope of the completion cache, see gpt_completion. Should be set when the text is private (HTML or marked text).
+    max_passes: see summarize_text.
+    The function defines a failed output by default, and updates it if the processing is successful.
+    """
+    
+    output = {
+        'URL': request_dict['URL'] if 'URL' in request_dict else '', 
+        'style': request_dict['style'] if 'style' in request_dict else '', 
+        'output': '',
+        'status': 'FAILED'}
+
+    # check validity of url
+    if output['URL'] == '':
+        output['output'] = 'ERROR: no URL provided.'
+        return output
+
+    # get the style
+    style = output['style']
+    if not style_utils.style_exists(style):
+        output['output'] = 'ERROR: style not supported.'
+        return output
+
+    document, error = fetch_text(request_dict, data_path)
+    if document is None:
+        output['output'] = error
+        return output
+
+    return process_document(document, style, max_char_length=max_char_length, model=model, max_passes=max_passes, stream_handler=stream_handler, cache_scope=cache_scope)
 
+def process_document(document, style, max_char_length=None, model='text-davinci-003', max_passes=MAX_GPT_PASSES, stream_handler=None, cache_scope=None, share_digest=False):
+    """The part of process_url after fetch_text: the summary runs in this thread, the title next to it."""
+    title_future = pipeline_executor.submit(run_timed, get_title, document['coarse_text'], document['metadata'], url=document['url'], cache_scope=cache_scope)
+    output = summarize_text(document, style, title_future, max_char_length=max_char_length, model=model, max_passes=max_passes, stream_handler=stream_handler, cache_scope=cache_scope, share_digest=share_digest)
+    if output['status'] == 'FAILED':
+        # the title is not needed anymore; cancel it if it has not started yet, and do not wait for it otherwise
+        title_future.cancel()
     return output
 
-def promptize_qa_list(qa_list, max_prev_questions=2):
+def should_share_digest(styles):
+    """Whether a text summarized in the styles is worth a digest: at least two distinct styles read it, see get_gpt_summary."""
+    digest_styles = 0
+    for style in set(styles):
+        style_definition = style_utils.get_style(style)
+        if style_definition is not None and style_definition.digest and style_definition.compression != 'extractive':
+            digest_styles += 1
+    return digest_styles >= 2
+
+def process_url_styles(request_dict, styles, data_path, max_char_length=None, model='text-davinci-003', stream_handler=None, cache_scope=None):
+    """Processes the URL of request_dict (see process_url) in several styles: the text is fetched once, the title is generated once,
+    and the styles are summarized concurrently.
+    stream_handler: if given, the output of every style is sent to it as a 'style_result' event as soon as it is ready.
+    Returns the outputs, in the order of styles.
+    """
+    outputs = {}
+
+    def finish(output):
+        outputs[output['style']] = output
+        if stream_handler is not None:
+            stream_handler('style_result', output)
+
+    document, error = fetch_text(request_dict, data_path)
+    title_future = None
+    summary_futures = {}
+    share_digest = should_share_digest(styles)
+    for style in styles:
+        if document is None or not style_utils.style_exists(style):
+            finish({'URL': request_dict['URL'] if 'URL' in request_dict else '', 'style': style, 'output': error if document is None else 'ERROR: style not supported.', 'status': 'FAILED'})
+            continue
+        if title_future is None:
+            # submitted before the summaries that wait for it
+            title_future = pipeline_executor.submit(run_timed, get_title, document['coarse_text'], document['metadata'], url=document['url'], cache_scope=cache_scope)
+        summary_futures[pipeline_executor.submit(summarize_text, document, style, title_future, max_char_length=max_char_length, model=model, cache_scope=cache_scope, share_digest=share_digest)] = style
+
+    for future in as_completed(summary_futures):
+        try:
+            finish(future.result())
+        except Exception as e:
+            print('Summary of style ' + summary_futures[future] + ' failed. Error: ', e)
+            finish({'URL': document['url'], 'style': summary_futures[future], 'output': 'ERROR: problem occured. Try changing the style or shorten the text.', 'status': 'FAILED'})
+    return [outputs[style] for style in styles]
+
+def get_domain_semaphore(url):
+    domain = scraping_utils.get_domain_name(url)
+    with domain_semaphores_lock:
+        if domain not in domain_semaphores:
+            domain_semaphores[domain] = threading.BoundedSemaphore(BATCH_MAX_FETCHES_PER_DOMAIN)
+        return domain_semaphores[domain]
+
+def process_batch_item(request_dict, data_path, max_char_length=None, model='text-davinci-003', cache_scope=None, share_digest=False):
+    """process_url, with the fetch under the limit of the domain of the URL and the summary under the limit of batch summaries.
+    share_digest: the URL is in the batch in other styles that read its digest as well, see should_share_digest.
+    """
+    output = {'URL': request_dict['URL'], 'style': request_dict['style'], 'output': '', 'status': 'FAILED'}
+    if not style_utils.style_exists(request_dict['style']):
+        output['output'] = 'ERROR: style not supported.'
+        return output
+    with get_domain_semaphore(request_dict['URL']):
+        document, error = fetch_text(request_dict, data_path)
+    if document is None:
+        output['output'] = error
+        return output
+    with batch_summary_semaphore:
+        return process_document(document, request_dict['style'], max_char_length=max_char_length, model=model, cache_scope=cache_scope, share_digest=share_digest)
+
+def process_batch(request_dicts, data_path, max_char_length=None, model='text-davinci-003', stream_handler=None, cache_scope=None):
+    """Processes a batch of URLs, each with its style (request_dicts, see process_url), concurrently.
+    stream_handler: if given, the output of every URL is sent to it as a 'batch_result' event as soon as it is ready,
+                    with the 'index' of its request_dict.
+    Returns the outputs, in the order of request_dicts.
+    """
+    url_styles = {}
+    for request_dict in request_dicts:
+        url_styles.setdefault(request_dict['URL'], []).append(request_dict['style'])
+    futures = {batch_executor.submit(process_batch_item, request_dict, data_path, max_char_length=max_char_length, model=model, cache_scope=cache_scope,
+                                     share_digest=should_share_digest(url_styles[request_dict['URL']])): i
+               for i, request_dict in enumerate(request_dicts)}
+    outputs = [None] * len(request_dicts)
+    for future in as_completed(futures):
+        i = futures[future]
+        try:
+            outputs[i] = future.result()
+        except Exception as e:
+            print('Batch item ' + request_dicts[i]['URL'] + ' failed. Error: ', e)
+            outputs[i] = {'URL': request_dicts[i]['URL'], 'style': request_dicts[i]['style'], 'output': 'ERROR: problem occured. Try again.', 'status': 'FAILED'}
+        if stream_handler is not None:
+            stream_handler('batch_result', {**outputs[i], 'index': i})
+    return outputs
+
+def promptize_qa_list(qa_list, budget_tokens=QA_HISTORY_TOKEN_BUDGET, model=qa_model, cache_scope=None):
     """Promptize the list of questions and answers.
     qa_list: list of tuples (question, answer)
-    max_prev_questions: maximum number of previous questions to include in the prompt
+    budget_tokens: the most recent questions and answers that fit are included as is, the ones before them as a summary, see history_utils
     """
+    summary, recent_turns = history_utils.compact_history(qa_list, budget_tokens, model, cache_scope=cache_scope)
     prompt = ''
-    for i in range(min(max_prev_questions, len(qa_list))):
-        question, answer = qa_list[-1-i][:2]
-        prompt = f'Question: {question}\nAnswer: {answer}\n{prompt}'
+    if summary != '':
+        prompt = f'Summary of earlier questions and answers: {summary}\n'
+    for question, answer in recent_turns:
+        prompt += f'Question: {question}\nAnswer: {answer}\n'
     return prompt
 
-def get_gpt_answer_to_question(question: str, snippets: list[str], qa_list, text, model=qa_model) -> str:
+def get_gpt_answer_to_question(question: str, snippets: list[str], qa_list, text, model=qa_model, language=None, stream_handler=None, cache_scope=None) -> str:
     """Get response from GPT-3 API.
     question: to be answered using the snippets
     snippets: list of strings that likely contain the answer to the question
+    language: of the text, if known (see nlp_utils.detect_language); detected otherwise
+    stream_handler: if given, the answer is streamed to it, see gpt_streamed_completion
+    cache_scope: see gpt_completion
     
     The question is put together with the snippets and a prompt, and is sent to GPT3.
     Note: may consider a cheaper model (next cheaper OpenAI: text-curie-001. Can also consider open-source model)
@@ -740,17 +933,20 @@ def get_gpt_answer_to_question(question: str, snippets: list[str], qa_list, text
     We therefore implement the following change: when the text is sufficiently short, we feed it directly to the model,
     without selecting text based on embeddings.
     '''
-    language = nlp_utils.detect_language(text) # either 'en' or not for now (3/4/2023)
+    if language is None:
+        language = nlp_utils.detect_language(text) # either 'en' or not for now (3/4/2023)
     if (len(text) < 9500 and language == 'en') or (len(text) < 5600):
         print('Asking question directly to model, as text is short.')
-        response_text = chat_question(question, qa_list, context_text=text, model=model)
+        response_text = chat_question(question, qa_list, context_text=text, model=model, stream_handler=stream_handler, cache_scope=cache_scope)
         return response_text, ''
     
     #prompt_title = '''You are trying to help a user get an answer to a question based on a document. You are given the question, the first 1000 characters of the text for context and several possibly relevant snippets of text that may contain (or may not) the answer. If the snippets do not contain the answer but you know the answer regardless of them - give the answer, but admit that it is not based on the document (adding \"(not based on the document)\"). If you're not sure about the answer, refuse to give an answer and admit that you're not sure, but again - if you know the answer from elsewhere - say it. Be concise, informative and give only the answer to the question.'''
     prompt_title = '''You are trying to help a user get an answer to a question based on a document. You are given the question, the first 1000 characters of the text for context and several possibly relevant snippets of text that may contain (or may not) the answer. If you are not sure what is the answer, say you're not sure. Be concise, informative and give only the answer to the question.'''
     prompt_title_w_prev_qa = '''You are trying to help a user get an answer to a question. You are given previous answered questions, the new question and several sentences or snippets of text that may contain (or may not) the answer. Try to give the answer to the question. If you are not absolutely sure, say you're not sure. Be concise.'''
 
-    previous_questions_answers_prompt = promptize_qa_list(qa_list)
+    previous_questions_answers_prompt = promptize_qa_list(qa_list, model=model, cache_scope=cache_scope)
+    if previous_questions_answers_prompt != '':
+        previous_questions_answers_prompt = 'Previous questions and answers:\n' + previous_questions_answers_prompt
 
     question = question.strip()
     question = question[0].upper() + question[1:] # capitalize the first letter of the question
@@ -758,20 +954,31 @@ def get_gpt_answer_to_question(question: str, snippets: list[str], qa_list, text
         question += '?'
     output_prompt = 'Answer (either based on the snippets or not):'
 
+    # a failed call falls back to the next model, and the failed model is not tried again; when the last one fails, the snippets are cut
+    models = routing_utils.route('answer', preferred=model)
     successful_response = False
     number_of_snippets = len(snippets)
     print('Number of snippets: ', number_of_snippets)
     while not successful_response and number_of_snippets > 0:
+        model = models[0]
 
         text_to_decode = [snip + '\n' for snip in snippets[:number_of_snippets]]
-        query_to_model = prompt_title + "\n" + question + '\n' + 'Context:\n' + text[0:1000] + '\nSnippets:\n' + ''.join(text_to_decode) + output_prompt + "\n"
+        query_to_model = prompt_title + "\n" + previous_questions_answers_prompt + question + '\n' + 'Context:\n' + text[0:1000] + '\nSnippets:\n' + ''.join(text_to_decode) + output_prompt + "\n"
         # print(query_to_model[:100])
         print('query to model ###########################')
         print(query_to_model)
         try:
-            response = gpt_completion(query_to_model, max_tokens=512, model=model)
+            with metrics_utils.span('answer', model=model):
+                if stream_handler is None:
+                    response = gpt_completion(query_to_model, max_tokens=512, model=model, cache_scope=cache_scope)
+                else:
+                    response = gpt_streamed_completion(query_to_model, stream_handler, max_tokens=512, model=model, cache_scope=cache_scope)
             successful_response = True
         except Exception as e:
+            if len(models) > 1:
+                routing_utils.log_fallback('answer', model, models[1], e)
+                models = models[1:]
+                continue
             print(e)
             print('Decreasing amount of candidate snippets.')
             number_of_snippets -= 1
@@ -783,7 +990,7 @@ def get_gpt_answer_to_question(question: str, snippets: list[str], qa_list, text
 
     return response_text, query_to_model
 
-def qa_about_text(question: str, text: str, url: str, qa_list, top=6, sigma=1, top_answers=4, compact_sentences=5):
+def qa_about_text(question: str, text: str, url: str, qa_list, top=6, sigma=1, top_answers=4, compact_sentences=5, language=None, stream_handler=None, cache_scope=None):
     """Get answer to a question about a text.
         question: to be answered using the text
         text: text to be used for answering the question
@@ -791,9 +998,13 @@ def qa_about_text(question: str, text: str, url: str, qa_list, top=6, sigma=1, t
         top: number of top similar sentences to use for generating the answer
         sigma: number of sentences around the top similar sentences to use for generating the answer
         top_answers: number of top answers to return
+        language: of the text, if known, see get_gpt_answer_to_question
+        stream_handler: if given, the answer is streamed to it, see gpt_streamed_completion
+        cache_scope: see gpt_completion
     """
     try:
-        cosine_similarities, sentences, embeddings_a, embeddings_q = nlp_utils.get_embeddings(question, text, url, backend="openai", compact_sentences=compact_sentences) # nlp_utils.get_embeddings_qa(question, text)
+        with metrics_utils.span('embeddings'):
+            cosine_similarities, sentences, embeddings_a, embeddings_q = nlp_utils.get_embeddings(question, text, url, backend="openai", compact_sentences=compact_sentences) # nlp_utils.get_embeddings_qa(question, text)
         print('Got embeddings.')
     except Exception as e:
         print(e)
@@ -821,10 +1032,11 @@ def qa_about_text(question: str, text: str, url: str, qa_list, top=6, sigma=1, t
     top_sentences = [sent.replace('\n', ' ') for sent in top_sentences]
     top_sentences = [re.sub(r'\s{2,}', ' ', sent) for sent in top_sentences]
 
-    response_text, query_to_model = get_gpt_answer_to_question(question, top_sentences, qa_list, text)
+    response_text, query_to_model = get_gpt_answer_to_question(question, top_sentences, qa_list, text, language=language, stream_handler=stream_handler, cache_scope=cache_scope)
     response_text = response_text.strip() # basic cleaning
 
-    supporting_sentences = nlp_utils.get_supporting_sentences(sentences_islands, embeddings_a, response_text, sentences, top_answers)
+    with metrics_utils.span('supporting_sentences'):
+        supporting_sentences = nlp_utils.get_supporting_sentences(sentences_islands, embeddings_a, response_text, sentences, top_answers)
     supporting_quote = '...' + '... '.join(supporting_sentences) + '...'
 
     # replace \n in supporting_quote with space
@@ -842,29 +1054,60 @@ def prepare_qa_for_chat(question, answer):
         question = question + '\n(Based on an attached document - redacted)'
     return question, answer
 
-def chat_question(question, qa_list, context_text='', model="gpt-3.5-turbo"):
+def chat_question(question, qa_list, context_text='', model=qa_model, stream_handler=None, cache_scope=None):
+    """Ask the chat model a question, with the previous questions and answers as chat history.
+    The context text is cut to what fits the context window. The history gets what is left of it, up to CHAT_HISTORY_TOKEN_BUDGET:
+    the most recent turns are sent as is, the ones before them as a summary, see history_utils.
+    model: the requested model; the call is routed among the chat models by routing_utils.route, and falls back to the next one on failure.
+    """
+    max_tokens = 768
+    context_prompt = '\nContext text:\n'
+    chat_qa_list = [prepare_qa_for_chat(*qa[:2]) for qa in (qa_list or [])]
+    models = routing_utils.route('chat', text=context_text, prompts=[question, context_prompt], max_tokens=max_tokens, preferred=model, chat_only=True)
+    for i, chat_model in enumerate(models):
+        try:
+            with metrics_utils.span('chat', model=chat_model):
+                answer = chat_question_with_model(question, chat_qa_list, context_text, context_prompt, chat_model, max_tokens, stream_handler=stream_handler, cache_scope=cache_scope)
+        except Exception as e:
+            if i < len(models) - 1:
+                routing_utils.log_fallback('chat', chat_model, models[i + 1], e)
+                continue
+            print(e)
+            return 'ERROR: problem occured. Try again or try selecting another text.'
+        if answer is not None:
+            return answer
+    return 'ERROR: problem occured. Try again or try selecting another text.'
+
+def chat_question_with_model(question, chat_qa_list, context_text, context_prompt, chat_model, max_tokens, stream_handler=None, cache_scope=None):
+    """The call of chat_question to one model, with the context text and history sized to its window. Returns the answer, or None."""
+    available_tokens = token_utils.get_input_budget(chat_model, [context_prompt], max_tokens) - token_utils.count_tokens(question, chat_model)
+    if context_text != '':
+        context_text = context_text[:token_utils.fit_text_to_budget(context_text, available_tokens, chat_model)]
+        available_tokens -= token_utils.count_tokens(context_text, chat_model)
+    history_budget = max(0, min(CHAT_HISTORY_TOKEN_BUDGET, available_tokens))
+
+    summary, recent_turns = history_utils.compact_history(chat_qa_list, history_budget, chat_model, cache_scope=cache_scope)
     prev_msgs = []
-    for qa in qa_list:
-        prev_question, prev_answer = qa[:2]
-        prev_question, prev_answer = prepare_qa_for_chat(prev_question, prev_answer)
+    if summary != '':
+        prev_msgs.append({"role": "system", "content": "Summary of the earlier conversation:\n" + summary})
+    for prev_question, prev_answer in recent_turns:
         prev_msgs.append({"role": "user", "content": prev_question})
         prev_msgs.append({"role": "assistant", "content": prev_answer})
     if context_text == '':
         query = question
     else:
-        query = question + '\nContext text:\n' + context_text
+        query = question + context_prompt + context_text
     
     prev_msgs.append({"role": "user", "content": query})
     
-    try:
-        response = gpt_completion('', max_tokens=768, model='gpt-3.5-turbo', prev_msgs=prev_msgs)
-    except Exception as e:
-        print(e)
-        return 'ERROR: problem occured. Try again or try selecting another text.'
+    if stream_handler is None:
+        response = gpt_completion('', max_tokens=max_tokens, model=chat_model, prev_msgs=prev_msgs, cache_scope=cache_scope)
+    else:
+        response = gpt_streamed_completion('', stream_handler, max_tokens=max_tokens, model=chat_model, prev_msgs=prev_msgs, cache_scope=cache_scope)
     if 'choices' not in response:
-        return 'ERROR: problem occured. Try again or try selecting another text.'
+        return None
     
     answer = response['choices'][0]['message']['content']
     answer = answer.strip()
 
-    return answer
\ No newline at end of file
+    return answer
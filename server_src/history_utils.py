@@ -0,0 +1,137 @@
+'''
+Chat history within a token budget.
+
+The most recent turns (question, answer) are kept verbatim, as many as fit the budget. The turns before them are folded
+into a running summary. A summary is cached under a hash of the conversation prefix it summarizes, and the hashes are
+chained (the hash of a prefix covers the hash of the prefix before it). So as a chat grows and turns move out of the
+verbatim window, only the newly dropped turns are folded into the summary cached for the shorter prefix.
+'''
+import hashlib
+import json
+import os
+import yaml
+from cachelib.file import FileSystemCache
+from retry import retry
+from . import general_utils, llm_utils, token_utils
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+COMPLETION_TIMEOUT = cfg["COMPLETION_TIMEOUT"]
+CHAT_HISTORY_SUMMARY_MAX_TOKENS = cfg["CHAT_HISTORY_SUMMARY_MAX_TOKENS"]
+CACHE_CHAT_SUMMARY_SECONDS = cfg["CACHE_CHAT_SUMMARY_SECONDS"]
+CACHE_CHAT_SUMMARY_THRESHOLD = cfg["CACHE_CHAT_SUMMARY_THRESHOLD"]
+
+SUMMARY_PROMPT_TITLE = "Summarize the following conversation between a user and an assistant. Keep the facts, names, numbers, decisions and open questions that later messages may refer to. Be concise.\n"
+SUMMARY_PREV_PROMPT = "\nSummary of the conversation before that:\n"
+SUMMARY_TURNS_PROMPT = "\nConversation:\n"
+SUMMARY_OUTPUT_PROMPT = "\nSummary:"
+
+data_path = general_utils.get_data_path()
+summary_cache = FileSystemCache(os.path.join(data_path, 'chat_summary_cache'), threshold=CACHE_CHAT_SUMMARY_THRESHOLD, default_timeout=CACHE_CHAT_SUMMARY_SECONDS)
+
+def get_turns(qa_list):
+    '''
+    qa_list: list of [question, answer, ...] as sent by the client (may be None). Returns a list of (question, answer).
+    '''
+    return [(qa[0], qa[1]) for qa in (qa_list or [])]
+
+def get_prefix_hashes(turns, model, cache_scope=None):
+    '''
+    Returns hashes[i] of the conversation prefix turns[:i], for i = 0..len(turns).
+    '''
+    hashes = [hashlib.sha256(json.dumps(['chat_summary', model, cache_scope]).encode('utf-8')).hexdigest()]
+    for turn in turns:
+        hashes.append(hashlib.sha256((hashes[-1] + json.dumps(turn, ensure_ascii=False)).encode('utf-8')).hexdigest())
+    return hashes
+
+def count_turn_tokens(turn, model):
+    question, answer = turn
+    return token_utils.count_tokens(question, model) + token_utils.count_tokens(answer, model) + 2 * token_utils.CHAT_TOKENS_PER_MESSAGE
+
+def split_turns_to_budget(turns, budget_tokens, model):
+    '''
+    Returns the index from which the turns fit budget_tokens, going back from the most recent turn.
+    '''
+    total_tokens = 0
+    for i in range(len(turns) - 1, -1, -1):
+        total_tokens += count_turn_tokens(turns[i], model)
+        if total_tokens > budget_tokens:
+            return i + 1
+    return 0
+
+def promptize_turns(turns, model, budget_tokens):
+    '''
+    The turns as text for the summary prompt. A turn longer than the budget is cut.
+    '''
+    text = ''
+    for question, answer in turns:
+        text += 'User: ' + question + '\nAssistant: ' + answer + '\n'
+    return text[:token_utils.fit_text_to_budget(text, budget_tokens, model)]
+
+@retry(exceptions=(llm_utils.LLMTimeout, llm_utils.LLMRateLimitError), tries=3, delay=1, backoff=2, jitter=(0, 1))
+def fold_turns(previous_summary, turns, model):
+    '''
+    Returns a summary of the conversation: previous_summary (of the turns before), followed by turns.
+    '''
+    prompt_texts = [SUMMARY_PROMPT_TITLE, SUMMARY_PREV_PROMPT, previous_summary, SUMMARY_TURNS_PROMPT, SUMMARY_OUTPUT_PROMPT]
+    budget_tokens = token_utils.get_input_budget(model, prompt_texts, CHAT_HISTORY_SUMMARY_MAX_TOKENS)
+    query = SUMMARY_PROMPT_TITLE
+    if previous_summary != '':
+        query += SUMMARY_PREV_PROMPT + previous_summary
+    query += SUMMARY_TURNS_PROMPT + promptize_turns(turns, model, budget_tokens) + SUMMARY_OUTPUT_PROMPT
+    response = llm_utils.chat_completion([{"role": "user", "content": query}], model, max_tokens=CHAT_HISTORY_SUMMARY_MAX_TOKENS, timeout=COMPLETION_TIMEOUT)
+    return response["choices"][-1]["message"]["content"].strip()
+
+def get_history_summary(turns, model, cache_scope=None, fold_budget_tokens=None):
+    '''
+    Returns the summary of all the turns, reusing the summary of the longest cached prefix.
+    Turns are folded in groups of at most fold_budget_tokens (by default, as many as fit a summary prompt), and every folded prefix is cached.
+    '''
+    if len(turns) == 0:
+        return ''
+    hashes = get_prefix_hashes(turns, model, cache_scope)
+    summary, start = '', 0
+    for i in range(len(turns), 0, -1):
+        cached_summary = summary_cache.get(hashes[i])
+        if cached_summary is not None:
+            summary, start = cached_summary, i
+            break
+    if start == len(turns):
+        print('Using cached chat summary...')
+        return summary
+
+    if fold_budget_tokens is None:
+        # the previous summary takes up to CHAT_HISTORY_SUMMARY_MAX_TOKENS of the prompt
+        prompt_texts = [SUMMARY_PROMPT_TITLE, SUMMARY_PREV_PROMPT, SUMMARY_TURNS_PROMPT, SUMMARY_OUTPUT_PROMPT]
+        fold_budget_tokens = token_utils.get_input_budget(model, prompt_texts, CHAT_HISTORY_SUMMARY_MAX_TOKENS) - CHAT_HISTORY_SUMMARY_MAX_TOKENS
+    while start < len(turns):
+        end = start + 1
+        group_tokens = count_turn_tokens(turns[start], model)
+        while end < len(turns) and group_tokens + count_turn_tokens(turns[end], model) <= fold_budget_tokens:
+            group_tokens += count_turn_tokens(turns[end], model)
+            end += 1
+        print('Folding chat turns ' + str(start) + '-' + str(end) + ' into the summary...')
+        summary = fold_turns(summary, turns[start:end], model)
+        summary_cache.set(hashes[end], summary)
+        start = end
+    return summary
+
+def compact_history(qa_list, budget_tokens, model, cache_scope=None):
+    '''
+    Returns (summary, recent_turns): the most recent turns that fit budget_tokens, verbatim,
+    and a summary of the turns before them ('' if there are none).
+    If the summary fails, the older turns are dropped.
+    '''
+    turns = get_turns(qa_list)
+    if split_turns_to_budget(turns, budget_tokens, model) == 0:
+        return '', turns
+    # the summary comes out of the same budget
+    split = split_turns_to_budget(turns, budget_tokens - CHAT_HISTORY_SUMMARY_MAX_TOKENS - token_utils.CHAT_TOKENS_PER_MESSAGE, model)
+    try:
+        summary = get_history_summary(turns[:split], model, cache_scope=cache_scope)
+    except Exception as e:
+        print('Chat summary failed, dropping ' + str(split) + ' older turns. Error: ', e)
+        summary = ''
+    return summary, turns[split:]
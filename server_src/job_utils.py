@@ -0,0 +1,169 @@
+'''
+Durable job queue for requests that wait on the model (/process, /processbatch, /processmarked, /question with "async"), in an SQLite file
+in the data folder. The web workers enqueue a job and return its id right away; job_worker.py runs the jobs in its own processes.
+The remaining passes of a progressive /process run as a job as well.
+
+A claimed job is invisible to other workers for JOB_VISIBILITY_TIMEOUT_SECONDS, which its worker extends every
+JOB_HEARTBEAT_SECONDS while the job runs (see extend_visibility). If its worker dies, the job becomes visible again and is
+claimed by another worker. The attempt of a claim is its token: a worker whose job was claimed again can neither complete nor fail it. A job that raised is retried after JOB_RETRY_DELAY_SECONDS (times the attempt), up to
+JOB_MAX_ATTEMPTS attempts. Jobs are therefore run at least once - a job retried after a crash may have saved its output already.
+'''
+import json
+import os
+import sqlite3
+import time
+import uuid
+import yaml
+from . import general_utils
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+JOB_VISIBILITY_TIMEOUT_SECONDS = cfg["JOB_VISIBILITY_TIMEOUT_SECONDS"]
+JOB_MAX_ATTEMPTS = cfg["JOB_MAX_ATTEMPTS"]
+JOB_RETRY_DELAY_SECONDS = cfg["JOB_RETRY_DELAY_SECONDS"]
+JOB_RETENTION_SECONDS = cfg["JOB_RETENTION_SECONDS"]
+JOB_HEARTBEAT_SECONDS = cfg["JOB_HEARTBEAT_SECONDS"]
+
+data_path = general_utils.get_data_path()
+JOB_DB_PATH = os.path.join(data_path, 'jobs.db')
+
+db_initialized_pid = None
+
+def connect():
+    global db_initialized_pid
+    connection = sqlite3.connect(JOB_DB_PATH, timeout=10, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    if db_initialized_pid != os.getpid():
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, payload TEXT, user_id TEXT, status TEXT, '
+                           'attempts INTEGER, visible_at REAL, created REAL, updated REAL, result TEXT, error TEXT)')
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_visible ON jobs (status, visible_at)')
+        db_initialized_pid = os.getpid()
+    return connection
+
+def job_to_dict(row):
+    return {
+        'id': row['id'],
+        'kind': row['kind'],
+        'payload': json.loads(row['payload']),
+        'user_id': row['user_id'],
+        'status': row['status'],
+        'attempts': row['attempts'],
+        'result': json.loads(row['result']) if row['result'] is not None else None,
+        'error': row['error']}
+
+def enqueue(kind, payload, user_id):
+    '''
+    Adds a job. payload: keyword arguments of the handler of the kind, see job_worker.py. Returns the id of the job.
+    '''
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    connection = connect()
+    try:
+        connection.execute('INSERT INTO jobs (id, kind, payload, user_id, status, attempts, visible_at, created, updated) VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)',
+                           (job_id, kind, json.dumps(payload), str(user_id), 'queued', now, now, now))
+    finally:
+        connection.close()
+    return job_id
+
+def claim():
+    '''
+    Takes the oldest visible job: queued, or running past its visibility timeout (its worker died). Returns the job, or None.
+    A job that ran out of attempts this way is marked as failed instead, and returned with status 'failed', for the worker to
+    clean up after it as after any job that failed for good (see job_worker.py).
+    '''
+    now = time.time()
+    connection = connect()
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            expired = True
+            row = connection.execute("SELECT * FROM jobs WHERE status = 'running' AND visible_at <= ? AND attempts >= ? ORDER BY created LIMIT 1",
+                                     (now, JOB_MAX_ATTEMPTS)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET status = 'failed', error = 'Timed out.', updated = ? WHERE id = ?", (now, row['id']))
+            else:
+                expired = False
+                row = connection.execute("SELECT * FROM jobs WHERE status IN ('queued', 'running') AND visible_at <= ? ORDER BY created LIMIT 1", (now,)).fetchone()
+                if row is not None:
+                    connection.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, visible_at = ?, updated = ? WHERE id = ?",
+                                       (now + JOB_VISIBILITY_TIMEOUT_SECONDS, now, row['id']))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    job = job_to_dict(row)
+    if expired:
+        job['status'] = 'failed'
+    else:
+        job['status'], job['attempts'] = 'running', job['attempts'] + 1
+    return job
+
+def extend_visibility(job_id, attempts):
+    '''
+    Keeps a running job invisible to other workers for another JOB_VISIBILITY_TIMEOUT_SECONDS.
+    attempts: of the claim (see claim). Returns False if the job is not running under this claim anymore.
+    '''
+    now = time.time()
+    connection = connect()
+    try:
+        cursor = connection.execute("UPDATE jobs SET visible_at = ?, updated = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+                                    (now + JOB_VISIBILITY_TIMEOUT_SECONDS, now, job_id, attempts))
+    finally:
+        connection.close()
+    return cursor.rowcount == 1
+
+def complete(job_id, attempts, result):
+    '''
+    Stores the result of the job. Returns False, storing nothing, if the job was claimed again since this attempt.
+    '''
+    connection = connect()
+    try:
+        cursor = connection.execute("UPDATE jobs SET status = 'done', result = ?, updated = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+                                    (json.dumps(result), time.time(), job_id, attempts))
+    finally:
+        connection.close()
+    return cursor.rowcount == 1
+
+def fail(job_id, attempts, error):
+    '''
+    Called when the job raised. Returns True if the job will be retried - or was claimed again since this attempt - and
+    False if it failed for good.
+    '''
+    now = time.time()
+    will_retry = attempts < JOB_MAX_ATTEMPTS
+    connection = connect()
+    try:
+        if will_retry:
+            cursor = connection.execute("UPDATE jobs SET status = 'queued', visible_at = ?, error = ?, updated = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+                                        (now + JOB_RETRY_DELAY_SECONDS * attempts, error, now, job_id, attempts))
+        else:
+            cursor = connection.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+                                        (error, now, job_id, attempts))
+    finally:
+        connection.close()
+    return will_retry or cursor.rowcount == 0
+
+def get_job(job_id):
+    connection = connect()
+    try:
+        row = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    finally:
+        connection.close()
+    return job_to_dict(row) if row is not None else None
+
+def delete_old_jobs():
+    '''
+    Removes finished jobs older than JOB_RETENTION_SECONDS.
+    '''
+    connection = connect()
+    try:
+        connection.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (time.time() - JOB_RETENTION_SECONDS,))
+    finally:
+        connection.close()
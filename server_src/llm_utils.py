@@ -0,0 +1,460 @@
+'''
+HTTP client for the model API (OpenAI, or Azure OpenAI) - chat, completion and embedding calls all go through here.
+
+Connections are pooled and kept alive per worker process, so that short calls (titles, embeddings) do not pay
+for a new TCP + TLS handshake every time. There are sync functions (used by the Flask routes and the thread pools)
+and async ones, with the same arguments, for use from asyncio code.
+
+Responses are the JSON of the API, as plain dictionaries - the same shape the openai module returned.
+Streamed calls return an iterator over the chunks (also dictionaries).
+
+Every call first waits for capacity in the shared rate limiter, see rate_limit_utils. Its latency, outcome and tokens
+(from the usage field of the answer) are recorded in metrics_utils.
+
+When both Azure and OpenAI credentials are set, Azure is the primary backend and non-streamed chat and completion calls
+are hedged: if Azure has not answered within HEDGE_LATENCY_PERCENTILE of its recent latencies - of calls of the same kind and
+model, with about the same max_tokens - the same call is sent to OpenAI as well, and the first answer is used. The other call is left to finish in the background and its answer dropped.
+'''
+import asyncio
+import json
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+import httpx
+import yaml
+from . import metrics_utils, rate_limit_utils, token_utils
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+COMPLETION_TIMEOUT = cfg["COMPLETION_TIMEOUT"]
+LLM_POOL_MAX_CONNECTIONS = cfg["LLM_POOL_MAX_CONNECTIONS"]
+LLM_POOL_MAX_KEEPALIVE = cfg["LLM_POOL_MAX_KEEPALIVE"]
+LLM_KEEPALIVE_SECONDS = cfg["LLM_KEEPALIVE_SECONDS"]
+LLM_CONNECT_TIMEOUT = cfg["LLM_CONNECT_TIMEOUT"]
+HEDGE_REQUESTS = cfg["HEDGE_REQUESTS"]
+HEDGE_LATENCY_PERCENTILE = cfg["HEDGE_LATENCY_PERCENTILE"]
+HEDGE_LATENCY_WINDOW = cfg["HEDGE_LATENCY_WINDOW"]
+HEDGE_MIN_SAMPLES = cfg["HEDGE_MIN_SAMPLES"]
+HEDGE_MIN_DELAY_SECONDS = cfg["HEDGE_MIN_DELAY_SECONDS"]
+
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE") if os.getenv("OPENAI_API_BASE") else 'https://api.openai.com/v1'
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+if not OPENAI_API_KEY:
+    # try to get the key from file in parent folder
+    with open('../../openai_gpt3_key.txt', 'r') as f:
+        OPENAI_API_KEY = f.read().strip()
+
+azure_flag = False
+if os.getenv("AZURE_OPENAI_KEY") and os.getenv("AZURE_OPENAI_ENDPOINT"):
+    AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT").rstrip('/')
+    AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
+    azure_flag = True
+
+primary_backend = 'azure' if azure_flag else 'openai'
+secondary_backend = 'openai' if azure_flag and OPENAI_API_KEY and HEDGE_REQUESTS else None   # None: no hedging
+
+# Azure serves deployments rather than models: the chat models below, completion models under their own name, and one embedding model
+AZURE_CHAT_DEPLOYMENTS = {'gpt-3.5-turbo': 'essence-gpt35turbo'}
+AZURE_EMBEDDING_DEPLOYMENT = 'essence-embed'
+AZURE_API_VERSIONS = {'chat': '2023-06-01-preview', 'completion': '2023-05-15', 'embedding': '2023-05-15'}
+API_PATHS = {'chat': '/chat/completions', 'completion': '/completions', 'embedding': '/embeddings'}
+
+class LLMError(Exception):
+    """An error returned by the model API, or a failure to reach it."""
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class LLMTimeout(LLMError):
+    pass
+
+class LLMRateLimitError(LLMError):
+    """A 429 from the API. retry_after: seconds, if the API said how long to wait."""
+    def __init__(self, message, status_code=429, retry_after=None):
+        super().__init__(message, status_code=status_code)
+        self.retry_after = retry_after
+
+class LLMCapacityError(LLMError):
+    """The rate limiter had no capacity for the call within RATE_LIMIT_MAX_WAIT_SECONDS; the call was not sent."""
+    pass
+
+def get_limits():
+    return httpx.Limits(max_connections=LLM_POOL_MAX_CONNECTIONS, max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE, keepalive_expiry=LLM_KEEPALIVE_SECONDS)
+
+def get_timeout(timeout):
+    return httpx.Timeout(timeout, connect=min(timeout, LLM_CONNECT_TIMEOUT))
+
+client = None
+client_pid = None
+client_lock = threading.Lock()
+async_clients = weakref.WeakKeyDictionary()    # an AsyncClient is bound to its event loop
+
+def get_client():
+    """Returns the connection pool of this process. A process forked from another gets its own pool."""
+    global client, client_pid
+    if client is None or client_pid != os.getpid():
+        with client_lock:
+            if client is None or client_pid != os.getpid():
+                client = httpx.Client(limits=get_limits(), timeout=get_timeout(COMPLETION_TIMEOUT))
+                client_pid = os.getpid()
+    return client
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    if loop not in async_clients:
+        async_clients[loop] = httpx.AsyncClient(limits=get_limits(), timeout=get_timeout(COMPLETION_TIMEOUT))
+    return async_clients[loop]
+
+# recent latencies of successful calls, per get_latency_key, for the hedging threshold; and counters, of this worker process
+latencies = {}
+latencies_lock = threading.Lock()
+hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'hedges_skipped': 0}
+hedge_stats_lock = threading.Lock()
+hedge_executor = ThreadPoolExecutor(max_workers=2 * LLM_POOL_MAX_CONNECTIONS)
+background_tasks = set()    # async calls that lost a hedge, kept referenced until they finish
+
+def count_hedge_event(event):
+    with hedge_stats_lock:
+        hedge_stats[event] += 1
+
+def get_hedge_stats():
+    with hedge_stats_lock:
+        return dict(hedge_stats)
+
+metrics_utils.register_process_stats('essence_hedge_events_total', get_hedge_stats)
+
+def get_latency_key(backend, kind, model, payload):
+    """Calls are compared with calls of the same model and kind, and max_tokens rounded up to a power of two -
+    a title (64 tokens) takes a fraction of the time of a summary (768 or 1024 tokens)."""
+    max_tokens = payload.get('max_tokens')
+    return backend, kind, model, (1 << (max_tokens - 1).bit_length()) if max_tokens else None
+
+def record_latency(backend, kind, model, payload, seconds):
+    key = get_latency_key(backend, kind, model, payload)
+    with latencies_lock:
+        if key not in latencies:
+            latencies[key] = deque(maxlen=HEDGE_LATENCY_WINDOW)
+        latencies[key].append(seconds)
+
+def get_azure_deployment(kind, model):
+    """Returns the Azure deployment of the model, or None if it has none."""
+    if kind == 'chat':
+        return AZURE_CHAT_DEPLOYMENTS.get(model)
+    if kind == 'embedding':
+        return AZURE_EMBEDDING_DEPLOYMENT
+    return model
+
+def is_model_served(model):
+    """Checks if the primary backend serves the model: on Azure, only the chat models with a deployment. See routing_utils.route."""
+    return not azure_flag or not token_utils.is_chat_model(model) or model in AZURE_CHAT_DEPLOYMENTS
+
+def get_hedge_delay(backend, kind, model, payload):
+    """Returns how long to wait for the backend before hedging the call, or None if there are too few latencies recorded yet."""
+    with latencies_lock:
+        samples = sorted(latencies.get(get_latency_key(backend, kind, model, payload), ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    percentile_latency = samples[min(len(samples) - 1, int(len(samples) * HEDGE_LATENCY_PERCENTILE / 100))]
+    return max(HEDGE_MIN_DELAY_SECONDS, percentile_latency)
+
+def get_bucket(backend, kind, model):
+    """Returns the name of the rate limiter bucket of a call - the model, or on Azure the deployment."""
+    if backend == 'azure':
+        return get_azure_deployment(kind, model) or model
+    return model
+
+def estimate_tokens(kind, model, payload):
+    """Tokens the API counts against the limit: the input, plus max_tokens of completion."""
+    if kind == 'chat':
+        n_tokens = token_utils.count_messages_tokens(payload['messages'], model)
+    elif kind == 'completion':
+        n_tokens = token_utils.count_tokens(payload['prompt'], model)
+    else:
+        n_tokens = sum(token_utils.count_tokens(text, model) for text in payload['input'])
+    return n_tokens + (payload.get('max_tokens') or 0)
+
+def wait_for_capacity(backend, kind, model, payload, max_wait_seconds=rate_limit_utils.RATE_LIMIT_MAX_WAIT_SECONDS):
+    bucket = get_bucket(backend, kind, model)
+    if not rate_limit_utils.acquire(bucket, estimate_tokens(kind, model, payload), max_wait_seconds=max_wait_seconds):
+        raise LLMCapacityError('No capacity for ' + bucket + ' within ' + str(max_wait_seconds) + ' seconds.')
+
+def get_request(backend, kind, model, payload):
+    """Returns the URL, headers and JSON body of a call. backend: 'azure' or 'openai'. kind: 'chat', 'completion' or 'embedding'."""
+    if backend == 'azure':
+        deployment = get_azure_deployment(kind, model)
+        if deployment is None:
+            raise LLMError('No Azure deployment of ' + model + '.')
+        url = AZURE_OPENAI_ENDPOINT + '/openai/deployments/' + deployment + API_PATHS[kind] + '?api-version=' + AZURE_API_VERSIONS[kind]
+        headers = {'api-key': AZURE_OPENAI_KEY}
+        body = payload
+    else:
+        url = OPENAI_API_BASE + API_PATHS[kind]
+        headers = {'Authorization': 'Bearer ' + OPENAI_API_KEY}
+        body = {'model': model, **payload}
+    return url, headers, body
+
+def get_retry_after(response):
+    try:
+        return float(response.headers['retry-after'])
+    except (KeyError, ValueError):
+        return None
+
+def raise_for_response(response, backend, kind, model):
+    if response.status_code < 400:
+        return
+    try:
+        message = response.json()['error']['message']
+    except Exception:
+        message = response.text[:500]
+    if response.status_code == 429:
+        retry_after = get_retry_after(response)
+        rate_limit_utils.report_throttled(get_bucket(backend, kind, model), retry_after)
+        raise LLMRateLimitError(message, retry_after=retry_after)
+    raise LLMError(message, status_code=response.status_code)
+
+def record_call(backend, kind, model, seconds, outcome):
+    metrics_utils.observe('essence_llm_call_seconds', seconds, kind=kind, model=model, backend=backend)
+    metrics_utils.count('essence_llm_calls_total', kind=kind, model=model, backend=backend, outcome=outcome)
+
+def get_outcome(response):
+    if response.status_code < 400:
+        return 'ok'
+    return 'rate_limited' if response.status_code == 429 else 'error'
+
+def record_usage(kind, model, response_json):
+    usage = response_json.get('usage') or {}
+    for token_type in ['prompt', 'completion']:
+        if usage.get(token_type + '_tokens'):
+            metrics_utils.count('essence_llm_tokens_total', usage[token_type + '_tokens'], kind=kind, model=model, type=token_type)
+
+def parse_stream_line(line):
+    """Returns the chunk of a server-sent event line, None for other lines, or False at the end of the stream."""
+    if not line.startswith('data:'):
+        return None
+    data = line[len('data:'):].strip()
+    if data == '[DONE]':
+        return False
+    return json.loads(data)
+
+def post(kind, model, payload, timeout=COMPLETION_TIMEOUT, backend=primary_backend, max_wait_seconds=rate_limit_utils.RATE_LIMIT_MAX_WAIT_SECONDS):
+    wait_for_capacity(backend, kind, model, payload, max_wait_seconds=max_wait_seconds)
+    url, headers, body = get_request(backend, kind, model, payload)
+    start_time = time.time()
+    try:
+        response = get_client().post(url, headers=headers, json=body, timeout=get_timeout(timeout))
+    except httpx.TimeoutException as e:
+        record_call(backend, kind, model, time.time() - start_time, 'timeout')
+        raise LLMTimeout('Request to the model API timed out: ' + str(e)) from e
+    except httpx.TransportError as e:
+        record_call(backend, kind, model, time.time() - start_time, 'error')
+        raise LLMError('Could not reach the model API: ' + str(e)) from e
+    record_call(backend, kind, model, time.time() - start_time, get_outcome(response))
+    raise_for_response(response, backend, kind, model)
+    record_latency(backend, kind, model, payload, time.time() - start_time)
+    response_json = response.json()
+    record_usage(kind, model, response_json)
+    return response_json
+
+def post_hedged(kind, model, payload, timeout=COMPLETION_TIMEOUT):
+    """Like post, but hedged to secondary_backend if the primary is slow, see above."""
+    hedge_delay = get_hedge_delay(primary_backend, kind, model, payload) if secondary_backend is not None else None
+    if hedge_delay is None:
+        return post(kind, model, payload, timeout=timeout)
+
+    count_hedge_event('requests')
+    primary = hedge_executor.submit(post, kind, model, payload, timeout)
+    try:
+        return primary.result(timeout=hedge_delay)
+    except FutureTimeoutError:
+        pass
+
+    print('No answer from ' + primary_backend + ' within ' + str(round(hedge_delay, 2)) + 's, hedging to ' + secondary_backend)
+    count_hedge_event('hedged')
+    # the hedge only goes out if the secondary has capacity right away; otherwise we keep waiting for the primary
+    secondary = hedge_executor.submit(post, kind, model, payload, timeout, secondary_backend, 0)
+    pending = {primary, secondary}
+    errors = []
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response = future.result()
+            except LLMCapacityError as e:
+                count_hedge_event('hedges_skipped')
+                errors.append(e)
+                continue
+            except LLMError as e:
+                errors.append(e)
+                continue
+            if future is secondary:
+                count_hedge_event('hedge_wins')
+            return response
+    raise next((e for e in errors if not isinstance(e, LLMCapacityError)), errors[0])
+
+def post_stream(kind, model, payload, timeout=COMPLETION_TIMEOUT, backend=primary_backend):
+    """Sends the request right away (so that errors are raised here) and returns an iterator over the chunks."""
+    wait_for_capacity(backend, kind, model, payload)
+    url, headers, body = get_request(backend, kind, model, {**payload, 'stream': True})
+    start_time = time.time()
+    try:
+        request = get_client().build_request('POST', url, headers=headers, json=body, timeout=get_timeout(timeout))
+        response = get_client().send(request, stream=True)
+    except httpx.TimeoutException as e:
+        record_call(backend, kind, model, time.time() - start_time, 'timeout')
+        raise LLMTimeout('Request to the model API timed out: ' + str(e)) from e
+    except httpx.TransportError as e:
+        record_call(backend, kind, model, time.time() - start_time, 'error')
+        raise LLMError('Could not reach the model API: ' + str(e)) from e
+    record_call(backend, kind, model, time.time() - start_time, get_outcome(response))
+    if response.status_code >= 400:
+        response.read()
+        response.close()
+        raise_for_response(response, backend, kind, model)
+
+    def iterate_chunks():
+        try:
+            for line in response.iter_lines():
+                chunk = parse_stream_line(line)
+                if chunk is False:
+                    break
+                if chunk is not None:
+                    yield chunk
+        except httpx.TimeoutException as e:
+            raise LLMTimeout('Stream from the model API timed out: ' + str(e)) from e
+        except httpx.TransportError as e:
+            raise LLMError('Stream from the model API broke: ' + str(e)) from e
+        finally:
+            response.close()
+    return iterate_chunks()
+
+async def apost(kind, model, payload, timeout=COMPLETION_TIMEOUT, backend=primary_backend, max_wait_seconds=rate_limit_utils.RATE_LIMIT_MAX_WAIT_SECONDS):
+    await asyncio.to_thread(wait_for_capacity, backend, kind, model, payload, max_wait_seconds)
+    url, headers, body = get_request(backend, kind, model, payload)
+    start_time = time.time()
+    try:
+        response = await get_async_client().post(url, headers=headers, json=body, timeout=get_timeout(timeout))
+    except httpx.TimeoutException as e:
+        record_call(backend, kind, model, time.time() - start_time, 'timeout')
+        raise LLMTimeout('Request to the model API timed out: ' + str(e)) from e
+    except httpx.TransportError as e:
+        record_call(backend, kind, model, time.time() - start_time, 'error')
+        raise LLMError('Could not reach the model API: ' + str(e)) from e
+    record_call(backend, kind, model, time.time() - start_time, get_outcome(response))
+    raise_for_response(response, backend, kind, model)
+    record_latency(backend, kind, model, payload, time.time() - start_time)
+    response_json = response.json()
+    record_usage(kind, model, response_json)
+    return response_json
+
+async def apost_hedged(kind, model, payload, timeout=COMPLETION_TIMEOUT):
+    hedge_delay = get_hedge_delay(primary_backend, kind, model, payload) if secondary_backend is not None else None
+    if hedge_delay is None:
+        return await apost(kind, model, payload, timeout=timeout)
+
+    count_hedge_event('requests')
+    primary = asyncio.ensure_future(apost(kind, model, payload, timeout=timeout))
+    done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+    if done:
+        return primary.result()
+
+    print('No answer from ' + primary_backend + ' within ' + str(round(hedge_delay, 2)) + 's, hedging to ' + secondary_backend)
+    count_hedge_event('hedged')
+    secondary = asyncio.ensure_future(apost(kind, model, payload, timeout=timeout, backend=secondary_backend, max_wait_seconds=0))
+    pending = {primary, secondary}
+    errors = []
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            try:
+                response = task.result()
+            except LLMCapacityError as e:
+                count_hedge_event('hedges_skipped')
+                errors.append(e)
+                continue
+            except LLMError as e:
+                errors.append(e)
+                continue
+            if task is secondary:
+                count_hedge_event('hedge_wins')
+            # let the other call finish, so that its latency is recorded
+            for other in pending:
+                background_tasks.add(other)
+                other.add_done_callback(background_tasks.discard)
+            return response
+    raise next((e for e in errors if not isinstance(e, LLMCapacityError)), errors[0])
+
+async def apost_stream(kind, model, payload, timeout=COMPLETION_TIMEOUT, backend=primary_backend):
+    await asyncio.to_thread(wait_for_capacity, backend, kind, model, payload)
+    url, headers, body = get_request(backend, kind, model, {**payload, 'stream': True})
+    start_time = time.time()
+    try:
+        async with get_async_client().stream('POST', url, headers=headers, json=body, timeout=get_timeout(timeout)) as response:
+            record_call(backend, kind, model, time.time() - start_time, get_outcome(response))
+            if response.status_code >= 400:
+                await response.aread()
+                raise_for_response(response, backend, kind, model)
+            async for line in response.aiter_lines():
+                chunk = parse_stream_line(line)
+                if chunk is False:
+                    break
+                if chunk is not None:
+                    yield chunk
+    except httpx.TimeoutException as e:
+        raise LLMTimeout('Request to the model API timed out: ' + str(e)) from e
+    except httpx.TransportError as e:
+        raise LLMError('Could not reach the model API: ' + str(e)) from e
+
+def get_chat_payload(messages, max_tokens=None, temperature=None):
+    payload = {'messages': messages}
+    if max_tokens is not None:
+        payload['max_tokens'] = max_tokens
+    if temperature is not None:
+        payload['temperature'] = temperature
+    return payload
+
+def get_completion_payload(prompt, max_tokens, temperature):
+    return {
+        'prompt': prompt,
+        'temperature': temperature,
+        'max_tokens': max_tokens,
+        'top_p': 1,
+        'frequency_penalty': 0,
+        'presence_penalty': 0,
+        'best_of': 1}
+
+def chat_completion(messages, model, max_tokens=None, temperature=None, stream=False, timeout=COMPLETION_TIMEOUT):
+    """messages: list of {"role": ..., "content": ...}. max_tokens and temperature default to those of the API."""
+    payload = get_chat_payload(messages, max_tokens=max_tokens, temperature=temperature)
+    if stream:
+        return post_stream('chat', model, payload, timeout=timeout)
+    return post_hedged('chat', model, payload, timeout=timeout)
+
+def completion(prompt, model, max_tokens=768, temperature=0.7, stream=False, timeout=COMPLETION_TIMEOUT):
+    payload = get_completion_payload(prompt, max_tokens, temperature)
+    if stream:
+        return post_stream('completion', model, payload, timeout=timeout)
+    return post_hedged('completion', model, payload, timeout=timeout)
+
+def embeddings(input, model, timeout=COMPLETION_TIMEOUT):
+    """input: list of strings."""
+    return post('embedding', model, {'input': input}, timeout=timeout)
+
+async def achat_completion(messages, model, max_tokens=None, temperature=None, stream=False, timeout=COMPLETION_TIMEOUT):
+    payload = get_chat_payload(messages, max_tokens=max_tokens, temperature=temperature)
+    if stream:
+        return apost_stream('chat', model, payload, timeout=timeout)
+    return await apost_hedged('chat', model, payload, timeout=timeout)
+
+async def acompletion(prompt, model, max_tokens=768, temperature=0.7, stream=False, timeout=COMPLETION_TIMEOUT):
+    payload = get_completion_payload(prompt, max_tokens, temperature)
+    if stream:
+        return apost_stream('completion', model, payload, timeout=timeout)
+    return await apost_hedged('completion', model, payload, timeout=timeout)
+
+async def aembeddings(input, model, timeout=COMPLETION_TIMEOUT):
+    return await apost('embedding', model, {'input': input}, timeout=timeout)
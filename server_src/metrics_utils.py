@@ -0,0 +1,178 @@
+'''
+Metrics of the processing pipeline - stage latencies, model calls and their tokens - exported in the Prometheus text format by /metrics.
+
+Every worker process adds up its metrics in memory, and adds them to an SQLite file in the data folder every METRICS_FLUSH_SECONDS,
+so that /metrics - answered by whichever worker gets the request - shows the totals of all the processes. The flushes run in a
+background thread of the process, so that an idle process does not keep its last metrics, and once more when the process exits.
+The per-process counters of other modules (e.g. cache_utils.get_cache_stats) are registered with register_process_stats,
+and stored per process on every flush.
+
+Stage latencies are histograms with the labels stage, style and model (the latter '' where they do not apply), see span().
+'''
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import yaml
+from . import general_utils
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+METRICS_FLUSH_SECONDS = cfg["METRICS_FLUSH_SECONDS"]
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80]
+# name: (type, help)
+METRICS = {
+    'essence_stage_seconds': ('histogram', 'Latency of the stages of processing a page or answering a question.'),
+    'essence_llm_call_seconds': ('histogram', 'Latency of calls to the model API (streamed calls: until the first byte).'),
+    'essence_llm_calls_total': ('counter', 'Calls to the model API, by outcome.'),
+    'essence_llm_tokens_total': ('counter', 'Tokens of calls to the model API, from its usage field (not reported for streamed calls).'),
+}
+
+data_path = general_utils.get_data_path()
+METRICS_DB_PATH = os.path.join(data_path, 'metrics.db')
+
+# metrics of this worker process since the last flush: (name, labels) -> value
+pending_metrics = {}
+pending_metrics_lock = threading.Lock()
+process_stats_getters = {}
+process_key = None
+last_flush = time.time()
+db_initialized_pid = None
+flush_thread_pid = None
+flush_thread_lock = threading.Lock()
+
+def connect():
+    global db_initialized_pid
+    connection = sqlite3.connect(METRICS_DB_PATH, timeout=10, isolation_level=None)
+    if db_initialized_pid != os.getpid():
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS metric_values (name TEXT, labels TEXT, value REAL, PRIMARY KEY (name, labels))')
+        connection.execute('CREATE TABLE IF NOT EXISTS process_stats (process TEXT, name TEXT, labels TEXT, value REAL, PRIMARY KEY (process, name, labels))')
+        db_initialized_pid = os.getpid()
+    return connection
+
+def format_labels(labels):
+    return '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for key, value in labels) + '}'
+
+def add(name, labels, value):
+    if flush_thread_pid != os.getpid():
+        start_flush_thread()
+    with pending_metrics_lock:
+        key = (name, format_labels(labels))
+        pending_metrics[key] = pending_metrics.get(key, 0) + value
+
+def count(name, amount=1, **labels):
+    add(name, sorted(labels.items()), amount)
+    maybe_flush()
+
+def observe(name, seconds, **labels):
+    labels = sorted(labels.items())
+    for le in LATENCY_BUCKETS:
+        # the empty buckets are added as well, as quantiles need all of them
+        add(name + '_bucket', labels + [('le', str(le))], 1 if seconds <= le else 0)
+    add(name + '_bucket', labels + [('le', '+Inf')], 1)
+    add(name + '_sum', labels, seconds)
+    add(name + '_count', labels, 1)
+    maybe_flush()
+
+@contextmanager
+def span(stage, style='', model=''):
+    '''
+    Times the block as a stage, see essence_stage_seconds. Also recorded when the block raises.
+    '''
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        observe('essence_stage_seconds', time.time() - start_time, stage=stage, style=style, model=model)
+
+def register_process_stats(name, get_stats):
+    '''
+    name: of a counter, exported as name{event=...}; get_stats: returns the per-process counters as a dictionary of event: value.
+    '''
+    process_stats_getters[name] = get_stats
+
+def maybe_flush():
+    if time.time() - last_flush >= METRICS_FLUSH_SECONDS:
+        flush()
+
+def start_flush_thread():
+    '''
+    Starts the thread that flushes this process every METRICS_FLUSH_SECONDS, on its first metric - once per process, as a forked
+    worker does not inherit the thread of its parent.
+    '''
+    global flush_thread_pid
+    with flush_thread_lock:
+        if flush_thread_pid == os.getpid():
+            return
+        flush_thread_pid = os.getpid()
+    threading.Thread(target=flush_periodically, daemon=True).start()
+
+def flush_periodically():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        maybe_flush()
+
+@atexit.register
+def flush_at_exit():
+    if len(pending_metrics) > 0:
+        flush()
+
+def flush():
+    '''
+    Adds the pending metrics of this process to the metrics file, and stores its process stats. Errors are reported, and the metrics dropped.
+    '''
+    global last_flush, process_key
+    with pending_metrics_lock:
+        metrics, last_flush = dict(pending_metrics), time.time()
+        pending_metrics.clear()
+    if process_key is None or not process_key.startswith(str(os.getpid()) + '-'):
+        process_key = str(os.getpid()) + '-' + str(time.time())
+    process_stats = [(name, format_labels([('event', event)]), value) for name, get_stats in process_stats_getters.items() for event, value in get_stats().items()]
+
+    try:
+        connection = connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT INTO metric_values (name, labels, value) VALUES (?, ?, ?) ON CONFLICT(name, labels) DO UPDATE SET value = value + excluded.value',
+                                   [(name, labels, value) for (name, labels), value in metrics.items()])
+            connection.executemany('INSERT OR REPLACE INTO process_stats (process, name, labels, value) VALUES (?, ?, ?, ?)',
+                                   [(process_key, name, labels, value) for name, labels, value in process_stats])
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+    except Exception as e:
+        print('Metrics error: ', e)
+
+def get_family(name):
+    for suffix in ['_bucket', '_sum', '_count']:
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+def render():
+    '''
+    Returns the metrics of all the processes in the Prometheus text format.
+    '''
+    flush()
+    connection = connect()
+    try:
+        rows = connection.execute('SELECT name, labels, value FROM metric_values').fetchall()
+        rows += connection.execute('SELECT name, labels, SUM(value) FROM process_stats GROUP BY name, labels').fetchall()
+    finally:
+        connection.close()
+
+    families = {}
+    for name, labels, value in rows:
+        families.setdefault(get_family(name), []).append((name, labels, value))
+    lines = []
+    for family in sorted(families):
+        metric_type, metric_help = METRICS.get(family, ('counter', 'Per-process counters, summed over the processes.'))
+        lines += ['# HELP ' + family + ' ' + metric_help, '# TYPE ' + family + ' ' + metric_type]
+        lines += [name + labels + ' ' + repr(float(value)) for name, labels, value in sorted(families[family])]
+    return '\n'.join(lines) + '\n'
@@ -1,6 +1,8 @@
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.feature_extraction.text import TfidfVectorizer
 import nltk
-from langdetect import detect
+from langdetect import DetectorFactory, detect
+from langdetect.lang_detect_exception import LangDetectException
 from nltk.tokenize import sent_tokenize
 import requests
 import numpy as np
@@ -9,11 +11,10 @@ import yaml
 from cachelib.file import FileSystemCache
 import hashlib
 import re
-from . import general_utils
+from functools import lru_cache
+from . import general_utils, llm_utils, metrics_utils, token_utils
 from retry import retry
 
-import openai as openaiembed
-
 
 with open("server_src/config.yml", 'r') as ymlfile:
     cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
@@ -27,26 +28,29 @@ CACHE_QA_SECONDS = cfg["CACHE_QA_SECONDS"]
 CACHE_QA_THRESHOLD = cfg["CACHE_QA_THRESHOLD"]
 INF_ENDPOINT_SENT_TRANS = cfg["INF_ENDPOINT_SENT_TRANS"]
 COMPLETION_TIMEOUT = cfg["COMPLETION_TIMEOUT"]
+EXTRACTIVE_MAX_UNITS = cfg["EXTRACTIVE_MAX_UNITS"]
+
+LANGUAGE_SAMPLE_CHARS = 500     # language is detected on samples of this length from the start, middle and end of the text
+LANGUAGE_MIN_WORDS = 20         # samples with fewer words are left to langdetect
+ENGLISH_MIN_RATIO = 0.12        # a sample is English if at least this share of its words are English function words ...
+NON_ENGLISH_MAX_RATIO = 0.04    # ... and not English below this share; in between, langdetect decides
+# frequent English words that are rare in other languages (no 'a', 'in', 'is', 'die', 'was', 'also', ...)
+ENGLISH_FUNCTION_WORDS = frozenset([
+    'the', 'and', 'of', 'that', 'it', 'with', 'he', 'be', 'by', 'this', 'are', 'his', 'from', 'which', 'but', 'have', 'not',
+    'they', 'you', 'had', 'were', 'their', 'been', 'has', 'would', 'she', 'there', 'we', 'can', 'if', 'more', 'when', 'who',
+    'what', 'about', 'them', 'him', 'out', 'up', 'into', 'only', 'some', 'could', 'these', 'its', 'than', 'then', 'other', 'our',
+    'any', 'how', 'after', 'should', 'where', 'those', 'just', 'through', 'while', 'because', 'between', 'being', 'does', 'did',
+    'your', 'my', 'very', 'many', 'each', 'such', 'may', 'must', 'said', 'both', 'here', 'one', 'all', 'first', 'new',
+])
+WORD_PATTERN = re.compile(r'[^\W\d_]+')
+
+DetectorFactory.seed = 0    # langdetect is random unless seeded
 
 SECRET_SENTEMBED_KEY = os.getenv("SECRET_HF_MODEL_KEY") if os.getenv("SECRET_HF_MODEL_KEY") else ''
 
-data_path = os.path.abspath(os.path.join(os.getcwd(), os.pardir, 'data'))  # get absolute path to one folder up
-if os.getenv("ESSENCE_DATA_PATH"):
-    data_path = os.getenv("ESSENCE_DATA_PATH")
+data_path = general_utils.get_data_path()
 embed_cache = FileSystemCache(os.path.join(data_path, 'embed_cache'), threshold=CACHE_QA_THRESHOLD, default_timeout=CACHE_QA_SECONDS)
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-openaiembed.api_key = OPENAI_API_KEY
-openaiembed.api_type = 'openai'
-
-azure_flag = False
-if os.getenv("AZURE_OPENAI_KEY") and os.getenv("AZURE_OPENAI_ENDPOINT"):
-    openaiembed.api_type = "azure"
-    openaiembed.api_base = os.getenv("AZURE_OPENAI_ENDPOINT") 
-    openaiembed.api_version = "2023-05-15"
-    openaiembed.api_key = os.getenv("AZURE_OPENAI_KEY")
-    azure_flag = True
-
 def hash_text(text):
     sha256 = hashlib.sha256()
     sha256.update(text.encode())
@@ -121,22 +125,23 @@ def get_embed_if_exists(id: str, text: str, backend: str):
             return elem["embeddings"]
     return None
 
-@retry(exceptions=openaiembed.error.Timeout, tries=4)
+@retry(exceptions=(llm_utils.LLMTimeout, llm_utils.LLMRateLimitError), tries=4, delay=1, backoff=2, jitter=(0, 1))
 def OpenAIEmbeddings(input, model=SENTENCE_QA_EMBED_MODEL):
-    if azure_flag:
+    if llm_utils.azure_flag:
         print('Using Azure OpenAI...')
         if len(input) == 1:
-            openai_embeddings = openaiembed.Embedding.create(input=input, engine="essence-embed")
+            openai_embeddings = llm_utils.embeddings(input, model, timeout=COMPLETION_TIMEOUT)
         else:
             # Azure OpenAI, as of May 22, 2023, does not support batch embeddings. Sad.
+            # The calls reuse the pooled connection of llm_utils, so they at least do not pay for a new handshake each.
             openai_embeddings = {}
             openai_embeddings["data"] = []
             for i in range(len(input)):
-                openai_embeddings["data"].append(openaiembed.Embedding.create(input=[input[i]], engine="essence-embed")["data"][0])
+                openai_embeddings["data"].append(llm_utils.embeddings([input[i]], model, timeout=COMPLETION_TIMEOUT)["data"][0])
             return openai_embeddings
     else:
         print('Using OpenAI... with model: ' + model)
-        openai_embeddings = openaiembed.Embedding.create(input=input, model=model, request_timeout=COMPLETION_TIMEOUT)
+        openai_embeddings = llm_utils.embeddings(input, model, timeout=COMPLETION_TIMEOUT)
         print('Finished.')
     return openai_embeddings
 
@@ -167,13 +172,14 @@ def combine_strings(l, m):
 
 # @general_utils.retry_on_timeout(retries=3, timeout_seconds=15)
 def get_embeddings(question: str, text: str, url:str, backend="openai", max_sentences=100, compact_sentences=1):
-    text = prepare_text_for_sent_split(text)
-    sentences = sent_tokenize(text)
-    sentences = rerun_text_after_sent_split(sentences)
-    sentences = quality_assurance_sentences(sentences)
-
-    if compact_sentences > 1:
-        sentences = combine_strings(sentences, compact_sentences)
+    with metrics_utils.span('sentence_split'):
+        text = prepare_text_for_sent_split(text)
+        sentences = sent_tokenize(text)
+        sentences = rerun_text_after_sent_split(sentences)
+        sentences = quality_assurance_sentences(sentences)
+
+        if compact_sentences > 1:
+            sentences = combine_strings(sentences, compact_sentences)
         
     # we'd like to reduce the number of sentences to max_sentences. We do it by batching to nearest power of 2.
     # sentences = combine_strings(sentences, 2 ** int(np.floor(np.log2(len(sentences) / max_sentences))))
@@ -197,25 +203,29 @@ def get_embeddings(question: str, text: str, url:str, backend="openai", max_sent
 
     elif backend == "openai":
         print('Going to use OpenAI embeddings...')
-        openai_embeddings_q = OpenAIEmbeddings([question], model=SENTENCE_QA_EMBED_MODEL)
+        with metrics_utils.span('embed_question', model=SENTENCE_QA_EMBED_MODEL):
+            openai_embeddings_q = OpenAIEmbeddings([question], model=SENTENCE_QA_EMBED_MODEL)
         if "data" not in openai_embeddings_q:
             print('ERROR: OPENAI EMBEDDINGS API FAILED.')
             raise ValueError('OpenAI Embeddings API failed.')
         embeddings_q = openai_embeddings_q["data"][0]["embedding"]
         embeddings_q = [embeddings_q]
 
-        cache_embed_response = get_embed_if_exists(url + hash_text(text), text, backend)
+        with metrics_utils.span('embed_cache_lookup'):
+            cache_embed_response = get_embed_if_exists(url + hash_text(text), text, backend)
         if cache_embed_response is not None:
             embeddings_a = cache_embed_response
         else:
-            openai_embeddings_a = OpenAIEmbeddings(sentences, model=SENTENCE_QA_EMBED_MODEL)
+            with metrics_utils.span('embed_text', model=SENTENCE_QA_EMBED_MODEL):
+                openai_embeddings_a = OpenAIEmbeddings(sentences, model=SENTENCE_QA_EMBED_MODEL)
             if "data" not in openai_embeddings_q:
                 raise ValueError('OpenAI Embeddings API failed.')
             embeddings_a = [openai_embeddings_a["data"][i]["embedding"] for i in range(len(sentences))]
             set_embed(url + hash_text(text), text, backend, embeddings_a)
     else:
         raise ValueError('backend not supported')
-    cosine_sim = get_embeddings_similarity(embeddings_q, embeddings_a)
+    with metrics_utils.span('similarity'):
+        cosine_sim = get_embeddings_similarity(embeddings_q, embeddings_a)
     
     return cosine_sim, sentences, embeddings_a, embeddings_q
 
@@ -241,21 +251,129 @@ def get_supporting_sentences(sentences_islands, embeddings_a, answer, sentences,
     supporting_sentences = [' '.join([sentences[candidate_sentences_locs[i]] for i in sublist]) for sublist in top_locs_islands]
     return supporting_sentences
 
-def text_not_in_english(text):
-    # use NLTK to check if text is in English by a simple heuristic
+def split_text_to_sentences(text):
+    '''
+    Returns the sentences of the text as (paragraph index, sentence) pairs, in order.
+    '''
+    units = []
+    paragraphs = [paragraph for paragraph in text.split('\n') if paragraph.strip() != '']
+    for paragraph_index, paragraph in enumerate(paragraphs):
+        sentences = rerun_text_after_sent_split(sent_tokenize(prepare_text_for_sent_split(paragraph)))
+        units += [(paragraph_index, sentence) for sentence in sentences if sentence.strip() != '']
+    return units
+
+def textrank_scores(sentences, damping=0.85, max_iterations=100, tolerance=1e-6):
+    '''
+    TextRank: PageRank over the graph of sentences, weighted by the TF-IDF cosine similarity between them.
+    Returns a numpy array with a score per sentence.
+    '''
+    n = len(sentences)
+    try:
+        tfidf = TfidfVectorizer(sublinear_tf=True).fit_transform(sentences)   # rows are L2-normalized, so the product is the cosine similarity
+    except ValueError:
+        # no words to compare, e.g. only numbers or symbols
+        return np.full(n, 1 / n)
+    similarity = (tfidf @ tfidf.T).toarray()
+    np.fill_diagonal(similarity, 0)
+    row_sums = similarity.sum(axis=1, keepdims=True)
+    # a sentence similar to no other sentence links to all of them, as in PageRank's dangling nodes
+    transition = np.divide(similarity, row_sums, out=np.full_like(similarity, 1 / n), where=row_sums > 0)
+
+    scores = np.full(n, 1 / n)
+    for _ in range(max_iterations):
+        new_scores = (1 - damping) / n + damping * (transition.T @ scores)
+        if np.abs(new_scores - scores).sum() < tolerance:
+            return new_scores
+        scores = new_scores
+    return scores
+
+def compress_text_extractive(text, budget_tokens, model, max_chars=None):
+    '''
+    Extractive compression: keeps the most salient sentences of the text (by TextRank), in their original order,
+    such that they fit budget_tokens (and max_chars, if given). Paragraph breaks between kept sentences are preserved.
+    Texts with more than EXTRACTIVE_MAX_UNITS sentences are ranked in groups of consecutive sentences.
+    A sentence or group that alone does not fit (e.g. a long unpunctuated paragraph) is cut down to fit, so something is always kept.
+    '''
+    units = split_text_to_sentences(text)
+    if len(units) == 0:
+        return text
+    group_size = -(-len(units) // EXTRACTIVE_MAX_UNITS)
+    if group_size > 1:
+        units = [(units[i][0], ' '.join(sentence for _, sentence in units[i:i + group_size])) for i in range(0, len(units), group_size)]
+    sentences = [sentence for _, sentence in units]
+
+    scores = textrank_scores(sentences)
+    n_tokens = [token_utils.count_tokens(sentence, model) + 1 for sentence in sentences]   # + 1 for the separator
+    for i, sentence in enumerate(sentences):
+        if n_tokens[i] > budget_tokens or (max_chars is not None and len(sentence) + 1 > max_chars):
+            sentence = sentence[:token_utils.fit_text_to_budget(sentence, budget_tokens - 1, model)]
+            sentences[i] = sentence[:max_chars - 1] if max_chars is not None else sentence
+            n_tokens[i] = token_utils.count_tokens(sentences[i], model) + 1
+    selected, total_tokens, total_chars = [], 0, 0
+    for i in np.argsort(-scores, kind='stable'):
+        if total_tokens + n_tokens[i] > budget_tokens or (max_chars is not None and total_chars + len(sentences[i]) + 1 > max_chars):
+            continue
+        selected.append(i)
+        total_tokens += n_tokens[i]
+        total_chars += len(sentences[i]) + 1
+    selected.sort()
+
+    compressed_text = ''
+    for j, i in enumerate(selected):
+        if j > 0:
+            compressed_text += ' ' if units[i][0] == units[selected[j - 1]][0] else '\n'
+        compressed_text += sentences[i]
+    print('Extractive stage: kept ' + str(len(selected)) + ' of ' + str(len(sentences)) + ' sentences, ' + str(total_tokens) + ' tokens.')
+    return compressed_text
+
+def get_language_samples(text, sample_chars=LANGUAGE_SAMPLE_CHARS):
+    '''
+    Samples from the start, middle and end of the text, so that a page whose header or footer is in another language still counts as English.
+    '''
+    if len(text) <= sample_chars:
+        return (text,)
+    middle = len(text) // 2
+    return (text[:sample_chars], text[middle:middle + sample_chars], text[-sample_chars:])
+
+def english_word_ratio(text):
+    '''
+    The share of the words of the text that are English function words, or None if the text has too few words to tell.
+    '''
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < LANGUAGE_MIN_WORDS:
+        return None
+    return sum(word in ENGLISH_FUNCTION_WORDS for word in words) / len(words)
+
+def langdetect_language(text):
     try:
-        if (detect(text[:150]) == 'en' or detect(text[len(text)//2:len(text)//2+150]) == 'en' or detect(text[-150:]) == 'en'):
-            return False
-        if (detect(text[:500]) == 'en' or detect(text[len(text)//2:len(text)//2+500]) == 'en' or detect(text[-500:]) == 'en'):
-            return False
-    except Exception as e:
-        # if language detection fails -- possibly throws LangDetectException -- assume it is not in English
+        return detect(text)
+    except LangDetectException as e:
         print(e)
-        return True
-    return True
+        return None
+
+@lru_cache(maxsize=1024)
+def detect_language_of_samples(samples):
+    '''
+    Returns 'en' if any of the samples is in English, otherwise 'non-en'.
+    Samples are first scored by their share of English function words; only those that score in between
+    (or have too few words) go to langdetect, which is about a hundred times slower.
+    '''
+    ratios = [english_word_ratio(sample) for sample in samples]
+    if any(ratio is not None and ratio >= ENGLISH_MIN_RATIO for ratio in ratios):
+        return 'en'
+    for sample, ratio in zip(samples, ratios):
+        if (ratio is None or ratio >= NON_ENGLISH_MAX_RATIO) and langdetect_language(sample) == 'en':
+            return 'en'
+    return 'non-en'
 
 def detect_language(text):
-    return 'en' if not text_not_in_english(text) else 'non-en'
+    '''
+    Either 'en' or 'non-en'. Deterministic, and memoized on the samples of the text, see get_language_samples.
+    '''
+    return detect_language_of_samples(get_language_samples(text))
+
+def text_not_in_english(text):
+    return detect_language(text) != 'en'
 
 def clean_marked_text(marked_text, min_length=3):
     # remove all lines with less than min_length characters
@@ -0,0 +1,383 @@
+'''
+Parsing of model output into the structured form returned to the extension, i.e. [{'key': key, 'value': value}].
+A value is a string, or a table - a list of rows, each a list of cells.
+
+Each line is tokenized in a single scan that finds which category delimiters (':') separate a key from its value.
+A ':' does not separate a key from its value when it is
+    1) part of a time (e.g. 10:30) or of a URL (e.g. https://...),
+    2) inside paranthesis,
+    3) after a table delimiter ('|') - or after a URL, which is treated alike.
+Also, a ',' that comes before a ':' is probably a missing new line; this follows the earlier, per-character implementation exactly
+(see benchmarks/legacy_parse.py), so that the parsed output remains the same.
+'''
+import re
+import yaml
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+BULLETS_GENERIC_STYLE_NAME = cfg["BULLETS_GENERIC_STYLE_NAME"]
+TABULARIZE_STYLE_NAME = cfg["TABULARIZE_STYLE_NAME"]
+
+VALUES_TO_DROP = ['', '-', 'None', 'N/A', 'n/a', 'N/a', 'NA', 'Not available', 'Not Available', 'not available', 'Not available.', 'Not Available.', 'not available.', 'varies', 'Varies', 'Unknown', 'unknown', 'Not provided', 'not mentioned', 'none mentioned']
+
+URL_PATTERN = re.compile(r'(https?://[^\s:]+(?::\d+)?(?:/[^\s]*)?)', re.IGNORECASE)
+PROTECTED_DELIMITER = '\x00'    # stands for a protected ':' while splitting a line
+
+# The "is it a list" check looks for ':' in the first 30 characters of the output, in which the earlier implementation had replaced
+# time and URL delimiters by placeholders of these lengths. We keep counting them this way, so that the check does not change.
+LIST_CHECK_LENGTH = 30
+TIME_PLACEHOLDER_LENGTH = len('<<STT>>')
+URL_PLACEHOLDER_LENGTH = len('<<|HTTP|>>')
+
+def parse_bullet_line(line):
+    """Converts a single line of the form '- bullet' or '1. bullet' to 'bullet'. Returns None if the line holds no bullet."""
+    if len(line) < 3:
+        return None
+    line = line.strip()
+    if len(line) < 2:
+        return None
+    if line[1].isdigit():
+        line = line[2:]
+    else:
+        line = line.strip()[1:]
+
+    # find index of first letter or number in any alphabet
+    first_letter_index = -1
+    for i, c in enumerate(line):
+        if c.isalnum():
+            first_letter_index = i
+            break
+    if first_letter_index == -1:
+        return None
+
+    return line[first_letter_index:]
+
+def parse_gpt_response_bullets(response: str):
+    """Converts a string of the form '- bullet1 \n- bullet2' to a [bullet1, bullet2]."""
+
+    stripped_s = response.strip()
+
+    # remove lines which are whitespace only
+    stripped_s = re.sub(r'^[\s]*\n', '', stripped_s, flags=re.MULTILINE)
+
+    l_dict = []
+    for j, line in enumerate(stripped_s.split('\n')):
+        bullet = parse_bullet_line(line)
+        if bullet is None:
+            continue
+
+        l_dict.append({'key': j+1, 'value': bullet})
+
+    return l_dict
+
+def is_likely_key_val_list(s):
+    """Returns True if the string is likely to be of the form 'key1:\nvalue1\nvalue2\nkey2:value1'"""
+    if len(s) < 10:
+        return False
+    if s.count(':') < 2:
+        return False
+    if s.count('\n') < 2:
+        return False
+    s = s.strip()
+    s_lines = s.split('\n')
+    if s_lines[0].count(':') == 0:
+        return False
+    if s_lines[0].split(':')[1].strip() != '':
+        return False
+    return True
+
+def find_delimiters(line, delimiter):
+    positions = []
+    position = line.find(delimiter)
+    while position != -1:
+        positions.append(position)
+        position = line.find(delimiter, position + 1)
+    return positions
+
+def find_time_and_url_delimiters(line, delimiter_positions):
+    """Returns the positions (among delimiter_positions) of ':' that are part of a time, and those that are part of a URL."""
+    time_positions = []
+    for position in delimiter_positions:
+        if 0 < position < len(line) - 1 and line[position-1].isdecimal() and line[position+1].isdecimal():
+            # the digits before ':' must not be the minutes of a previous time, e.g. only the first ':' of 1:2:3 is a time
+            if len(time_positions) > 0 and line[time_positions[-1]+1:position].isdecimal():
+                continue
+            time_positions.append(position)
+
+    url_positions = []
+    if '://' in line:
+        line_without_times = line
+        for position in time_positions:
+            line_without_times = line_without_times[:position] + PROTECTED_DELIMITER + line_without_times[position+1:]
+        url_spans = [match.span() for match in URL_PATTERN.finditer(line_without_times)]
+        span_i = 0
+        for position in delimiter_positions:
+            while span_i < len(url_spans) and url_spans[span_i][1] <= position:
+                span_i += 1
+            if span_i < len(url_spans) and url_spans[span_i][0] <= position and line_without_times[position] != PROTECTED_DELIMITER:
+                url_positions.append(position)
+
+    return time_positions, url_positions
+
+def tokenize_line(line, category_delimiter=':', table_delimiter='|'):
+    """Finds the category delimiters that separate a key from its value in a line.
+    Returns (key, value) if the line holds a key, or None if it does not (then it is a table row or multi-line text).
+    """
+    delimiter_positions = find_delimiters(line, category_delimiter)
+    if len(delimiter_positions) == 0:
+        return None
+
+    time_positions, url_positions = find_time_and_url_delimiters(line, delimiter_positions)
+    protected = set(time_positions)
+    protected.update(url_positions)
+
+    # a ':' after a table delimiter or after a URL is inside a table
+    table_start = line.find(table_delimiter)
+    if len(url_positions) > 0 and (table_start == -1 or url_positions[0] < table_start):
+        table_start = url_positions[0]
+
+    free_positions = []
+    paranthesis_open = False
+    previous_position = 0
+    for position in delimiter_positions:
+        segment = line[previous_position:position]
+        previous_position = position
+        open_i, close_i = segment.rfind('('), segment.rfind(')')
+        if open_i != close_i:
+            paranthesis_open = open_i > close_i
+        if position in protected or paranthesis_open or (table_start != -1 and position > table_start):
+            protected.add(position)
+        else:
+            free_positions.append(position)
+
+    if len(free_positions) == 0:
+        return None
+
+    # a ',' before a ':' is taken as a missing new line, see the module docstring
+    comma_positions = find_delimiters(line[:free_positions[-1]], ',') if ',' in line else []
+    if len(comma_positions) == 0:
+        key = line[:free_positions[0]]
+        value = line[free_positions[0]+1:free_positions[1]] if len(free_positions) > 1 else line[free_positions[0]+1:]
+        return key.strip(), value.strip()
+
+    new_line_positions = []
+    for position in free_positions[::-1]:
+        while len(comma_positions) > 0 and comma_positions[-1] > position:
+            comma_positions.pop()
+        if len(comma_positions) == 0:
+            break
+        new_line_positions.append(comma_positions[-1])
+
+    marked_line = line
+    for position in protected:
+        marked_line = marked_line[:position] + PROTECTED_DELIMITER + marked_line[position+1:]
+    marked_line = marked_line[:new_line_positions[0]].strip() + '\n' * len(new_line_positions) + marked_line[new_line_positions[-1]+1:].strip()
+    line_split = marked_line.split(category_delimiter, 2)
+    return line_split[0].strip().replace(PROTECTED_DELIMITER, category_delimiter), line_split[1].strip().replace(PROTECTED_DELIMITER, category_delimiter)
+
+def looks_like_list(lines, category_delimiter=':'):
+    """Returns True if a free category delimiter occurs in the beginning of the text (see LIST_CHECK_LENGTH)."""
+    length = 0
+    for line in lines:
+        delimiter_positions = find_delimiters(line, category_delimiter)
+        time_positions, url_positions = find_time_and_url_delimiters(line, delimiter_positions)
+        previous_position = 0
+        for position in delimiter_positions:
+            length += position - previous_position
+            if length >= LIST_CHECK_LENGTH:
+                return False
+            if position in time_positions:
+                length += TIME_PLACEHOLDER_LENGTH
+            elif position in url_positions:
+                length += URL_PLACEHOLDER_LENGTH
+            else:
+                return True
+            previous_position = position + 1
+        length += len(line) - previous_position + 1
+        if length >= LIST_CHECK_LENGTH:
+            return False
+    return False
+
+def split_table_row(row, prev_col_len, table_delimiter='|'):
+    """Splits a table row into cells. Returns the cells and the number of columns to compare the next row with.
+    Sometimes the table is not aligned - a row with fewer columns than the previous row gets an empty first column.
+    """
+    columns = row.count(table_delimiter)
+    if columns < prev_col_len:
+        return [s_i.strip() for s_i in (' ' + table_delimiter + ' ' + row).split(table_delimiter)], prev_col_len
+    return [s_i.strip() for s_i in row.split(table_delimiter)], columns
+
+def parse_gpt_response(s, style='', category_delimiter=':', table_delimiter='|', values_to_drop=VALUES_TO_DROP):
+    """Converts a string, usually of the form 'key1:value1,key2:value2', to a dictionary/JSON."""
+
+    if style == BULLETS_GENERIC_STYLE_NAME:
+        if not is_likely_key_val_list(s):
+            if s.strip()[:s.find('\n')].count(':') == 1:
+                s = '- ' + s.strip()
+            print('Parsing as bullet points.')
+            parsed_s = parse_gpt_response_bullets(s)
+            return parsed_s
+        # remove incoming '-'. It's a thing that ChatGPT does.
+        s = '\n'.join([line if not line.startswith('- ') else line[2:] for line in s.splitlines()])
+
+    if style == TABULARIZE_STYLE_NAME:
+        if not s.startswith('Table:'):
+            s = 'Table:\n' + s
+
+    stripped_s = s.strip()
+    s_lines = stripped_s.split('\n')
+
+    # check if string is not a list
+    if not looks_like_list(s_lines, category_delimiter):
+        return [{'key': ' ', 'value': stripped_s}]
+
+    # proceed to parsing of the form {key1: value1, key2: value2, ...}, with values potentially being tables
+    d = {}
+    last_key = ''       # last key - used to store multi-line values
+    prev_col_len = 0    # number of columns in the previous row of the table of last_key
+    for line in s_lines:
+        key_value = tokenize_line(line, category_delimiter, table_delimiter)
+        if key_value is not None:
+            key, value = key_value
+            last_key = ''
+            d[key] = value
+            if value == '':
+                last_key = key
+                d[last_key] = []
+                prev_col_len = 0
+        elif last_key != '':
+            # a line without a key is a table row, or a multi-line value - which we treat the same
+            row, prev_col_len = split_table_row(line.strip(), prev_col_len, table_delimiter)
+            d[last_key].append(row)
+
+    # convert {key: val} to [{key: key, value: val}], replacing empty lists by empty strings and removing "empty" values
+    l_dict = []
+    for key in d:
+        value = d[key] if d[key] != [] else ''
+        if isinstance(value, list) or value not in values_to_drop:
+            l_dict.append({'key': key, 'value': value})
+
+    return l_dict
+
+class IncrementalResponseParser:
+    """Parses model output piece by piece, as it is streamed, so that results can be shown progressively.
+    feed(text) takes the next piece of the output and returns the items that were completed by it.
+    close() returns the remaining items and the output of parse_gpt_response on the whole text, which remains the final result.
+
+    Items are dictionaries of the following types:
+        {'type': 'pair', 'key': key, 'value': value} - a key with a single-line value
+        {'type': 'key', 'key': key} - a key whose value (a table or multi-line text) follows in the next rows
+        {'type': 'row', 'key': key, 'value': [cell1, cell2, ...]} - a table row (or a line of multi-line text) of key
+        {'type': 'bullet', 'key': j, 'value': bullet} - a bullet point
+    An item is emitted as soon as its line is complete. The handling of each line follows parse_gpt_response.
+    Output that does not look like a list is only available from close().
+    """
+
+    def __init__(self, style='', category_delimiter=':', table_delimiter='|', values_to_drop=VALUES_TO_DROP):
+        self.style = style
+        self.category_delimiter = category_delimiter
+        self.table_delimiter = table_delimiter
+        self.values_to_drop = values_to_drop
+
+        self.text = ''              # all the text fed so far
+        self.buffer = ''            # the last, incomplete line
+        self.pending_lines = []     # complete lines waiting for the mode to be determined
+        self.mode = None            # 'list', 'bullets' or 'text', once determined
+        self.n_lines = 0            # number of non-empty lines processed, used for bullet keys
+        self.last_key = ''
+        self.prev_col_len = 0
+
+    def feed(self, text):
+        self.text += text
+        self.buffer += text
+        lines = self.buffer.split('\n')
+        self.buffer = lines[-1]
+        self.pending_lines.extend(lines[:-1])
+        return self.process_pending_lines(final=False)
+
+    def close(self):
+        """Returns the items of the last line, and the final parse of the whole text."""
+        self.pending_lines.append(self.buffer)
+        self.buffer = ''
+        items = self.process_pending_lines(final=True)
+        return items, parse_gpt_response(self.text, style=self.style, category_delimiter=self.category_delimiter, table_delimiter=self.table_delimiter, values_to_drop=self.values_to_drop)
+
+    def determine_mode(self, final):
+        """Decides, like parse_gpt_response, whether the output is a list, bullet points or plain text.
+        Returns False if more text is needed to decide."""
+        stripped_text = self.text.strip()
+        complete_lines = [line for line in self.pending_lines if line.strip() != '']
+
+        if self.style == BULLETS_GENERIC_STYLE_NAME:
+            if len(complete_lines) == 0 and not final:
+                return False
+            first_line = complete_lines[0] if len(complete_lines) > 0 else stripped_text
+            if first_line.count(self.category_delimiter) > 0 and first_line.split(self.category_delimiter)[1].strip() == '':
+                self.mode = 'list'
+            else:
+                self.mode = 'bullets'
+                if first_line.count(self.category_delimiter) == 1:
+                    # see parse_gpt_response - a first line with a single ':' is a bullet point as well
+                    self.pending_lines[self.pending_lines.index(first_line)] = '- ' + first_line.strip()
+            return True
+
+        if self.style == TABULARIZE_STYLE_NAME:
+            if len(stripped_text) < len('Table:') and not final:
+                return False
+            self.mode = 'list'
+            if not self.text.startswith('Table:'):
+                self.pending_lines.insert(0, 'Table:')
+            return True
+
+        if (len(stripped_text) < LIST_CHECK_LENGTH or len(complete_lines) == 0) and not final:
+            return False
+        self.mode = 'list' if looks_like_list(stripped_text.split('\n'), self.category_delimiter) else 'text'
+        return True
+
+    def process_pending_lines(self, final):
+        if self.mode is None and not self.determine_mode(final):
+            return []
+
+        items = []
+        for line in self.pending_lines:
+            if self.mode == 'bullets':
+                items.extend(self.process_bullet_line(line))
+            elif self.mode == 'list':
+                items.extend(self.process_list_line(line))
+        self.pending_lines = []
+        return items
+
+    def process_bullet_line(self, line):
+        if line.strip() == '':
+            return []
+        self.n_lines += 1
+        bullet = parse_bullet_line(line if self.n_lines > 1 else line.strip())
+        if bullet is None:
+            return []
+        return [{'type': 'bullet', 'key': self.n_lines, 'value': bullet}]
+
+    def process_list_line(self, line):
+        if self.style == BULLETS_GENERIC_STYLE_NAME and line.startswith('- '):
+            line = line[2:]
+        if self.n_lines == 0:
+            line = line.strip()
+        self.n_lines += 1
+
+        key_value = tokenize_line(line, self.category_delimiter, self.table_delimiter)
+        if key_value is not None:
+            key, value = key_value
+            if value == '':
+                self.last_key = key
+                self.prev_col_len = 0
+                return [{'type': 'key', 'key': key}]
+            self.last_key = ''
+            if value in self.values_to_drop:
+                return []
+            return [{'type': 'pair', 'key': key, 'value': value}]
+
+        if self.last_key == '' or line.strip() == '':
+            return []
+        row, self.prev_col_len = split_table_row(line.strip(), self.prev_col_len, self.table_delimiter)
+        return [{'type': 'row', 'key': self.last_key, 'value': row}]
@@ -0,0 +1,161 @@
+'''
+Token-bucket rate limiter for the model API, shared by all worker processes through an SQLite file in the data folder.
+
+Every model (on Azure, every deployment) with limits in RATE_LIMITS has two buckets: requests and tokens.
+They refill continuously at the per-minute rates and hold up to RATE_LIMIT_BURST_SECONDS' worth of them.
+A call takes one request and its estimated tokens, waiting for them if needed - up to RATE_LIMIT_MAX_WAIT_SECONDS,
+after which it is rejected. A 429 from the API empties the buckets until its Retry-After has passed, so that
+the other workers back off as well, instead of retrying into the limit.
+'''
+import os
+import random
+import sqlite3
+import threading
+import time
+import yaml
+from . import general_utils, metrics_utils
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+RATE_LIMITS = cfg["RATE_LIMITS"]
+RATE_LIMIT_BURST_SECONDS = cfg["RATE_LIMIT_BURST_SECONDS"]
+RATE_LIMIT_MAX_WAIT_SECONDS = cfg["RATE_LIMIT_MAX_WAIT_SECONDS"]
+
+DEFAULT_THROTTLE_SECONDS = 1    # buckets are emptied for this long on a 429 without Retry-After
+MAX_SLEEP_SECONDS = 1           # waiting callers re-check the buckets at least this often, as limits may be shared unevenly
+
+data_path = general_utils.get_data_path()
+RATE_LIMIT_DB_PATH = os.path.join(data_path, 'rate_limits.db')
+
+# counters of this worker process
+rate_limit_stats = {'acquired': 0, 'waits': 0, 'wait_seconds': 0.0, 'rejections': 0, 'throttled': 0}
+rate_limit_stats_lock = threading.Lock()
+db_initialized_pid = None
+
+def count_rate_limit_event(event, amount=1):
+    with rate_limit_stats_lock:
+        rate_limit_stats[event] += amount
+
+def get_rate_limit_stats():
+    with rate_limit_stats_lock:
+        return dict(rate_limit_stats)
+
+metrics_utils.register_process_stats('essence_rate_limit_events_total', get_rate_limit_stats)
+
+def connect():
+    global db_initialized_pid
+    connection = sqlite3.connect(RATE_LIMIT_DB_PATH, timeout=10, isolation_level=None)
+    if db_initialized_pid != os.getpid():
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL)')
+        db_initialized_pid = os.getpid()
+    return connection
+
+def get_limits(bucket):
+    '''
+    Returns (requests per second, tokens per second, request capacity, token capacity), or None if the bucket is not limited.
+    '''
+    limits = RATE_LIMITS.get(bucket)
+    if limits is None:
+        return None
+    requests_rate, tokens_rate = limits['rpm'] / 60, limits['tpm'] / 60
+    return requests_rate, tokens_rate, max(1, requests_rate * RATE_LIMIT_BURST_SECONDS), max(1, tokens_rate * RATE_LIMIT_BURST_SECONDS)
+
+def try_acquire(connection, bucket, n_tokens):
+    '''
+    Takes a request and n_tokens from the buckets if they have them. Returns 0 on success, otherwise the seconds to wait.
+    '''
+    requests_rate, tokens_rate, requests_capacity, tokens_capacity = get_limits(bucket)
+    n_tokens = min(n_tokens, tokens_capacity)  # a call larger than the bucket goes once the bucket is full
+    now = time.time()
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        row = connection.execute('SELECT requests, tokens, updated FROM buckets WHERE name = ?', (bucket,)).fetchone()
+        if row is None:
+            requests, tokens, updated = requests_capacity, tokens_capacity, now
+        else:
+            requests, tokens, updated = row
+        if now < updated:
+            # emptied after a 429, until 'updated'
+            connection.execute('COMMIT')
+            return updated - now
+
+        elapsed = now - updated
+        requests = min(requests_capacity, requests + elapsed * requests_rate)
+        tokens = min(tokens_capacity, tokens + elapsed * tokens_rate)
+        if requests >= 1 and tokens >= n_tokens:
+            requests, tokens, wait_seconds = requests - 1, tokens - n_tokens, 0
+        else:
+            wait_seconds = max((1 - requests) / requests_rate, (n_tokens - tokens) / tokens_rate)
+        connection.execute('INSERT OR REPLACE INTO buckets (name, requests, tokens, updated) VALUES (?, ?, ?, ?)', (bucket, requests, tokens, now))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    return wait_seconds
+
+def acquire(bucket, n_tokens, max_wait_seconds=RATE_LIMIT_MAX_WAIT_SECONDS):
+    '''
+    Waits until the bucket has capacity for a request of n_tokens (prompt + max completion), and takes it.
+    Returns False if that did not happen within max_wait_seconds. Buckets without limits always return True.
+    With max_wait_seconds=0, only takes capacity that is there right away; that is not counted as a rejection.
+    Errors of the limiter itself are reported and let the call through.
+    '''
+    if get_limits(bucket) is None:
+        return True
+
+    start = time.time()
+    try:
+        connection = connect()
+    except Exception as e:
+        print('Rate limiter error: ', e)
+        return True
+
+    try:
+        slept = False
+        while True:
+            try:
+                wait_seconds = try_acquire(connection, bucket, n_tokens)
+            except Exception as e:
+                print('Rate limiter error: ', e)
+                return True
+            waited = time.time() - start
+            if wait_seconds == 0:
+                count_rate_limit_event('acquired')
+                if slept:
+                    count_rate_limit_event('waits')
+                    count_rate_limit_event('wait_seconds', waited)
+                return True
+            if waited + wait_seconds > max_wait_seconds:
+                if max_wait_seconds > 0:
+                    print('Rate limit: no capacity for ' + bucket + ' within ' + str(max_wait_seconds) + ' seconds.')
+                    count_rate_limit_event('rejections')
+                    count_rate_limit_event('wait_seconds', waited)
+                return False
+            # a little jitter, so that waiting workers do not all retry at the same moment
+            time.sleep(min(wait_seconds, MAX_SLEEP_SECONDS) * random.uniform(1, 1.2))
+            slept = True
+    finally:
+        connection.close()
+
+def report_throttled(bucket, retry_after=None):
+    '''
+    Called on a 429 from the API: empties the buckets for retry_after seconds, for all workers.
+    '''
+    count_rate_limit_event('throttled')
+    if get_limits(bucket) is None:
+        return
+    blocked_until = time.time() + (retry_after if retry_after is not None else DEFAULT_THROTTLE_SECONDS)
+    try:
+        connection = connect()
+        try:
+            connection.execute(
+                'INSERT INTO buckets (name, requests, tokens, updated) VALUES (?, 0, 0, ?) '
+                'ON CONFLICT(name) DO UPDATE SET requests = 0, tokens = 0, updated = MAX(updated, excluded.updated)', (bucket, blocked_until))
+        finally:
+            connection.close()
+    except Exception as e:
+        print('Rate limiter error: ', e)
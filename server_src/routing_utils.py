@@ -0,0 +1,113 @@
+'''
+Picks the model of each call, and the models to fall back to when it fails.
+
+route() orders the candidates - the model of the style (styles.yml) or the requested one, then MODEL_CASCADE - by:
+    - health: a model with more than ROUTER_MAX_ERROR_RATE of its recent calls failing, or a median latency above
+      ROUTER_MAX_LATENCY_SECONDS, is moved behind the healthy ones;
+    - length: a text that needs more than one pass of the model goes to the first of ROUTER_LONG_TEXT_MODELS that takes it
+      in a single pass, if there is one.
+The first model is the one to call; the others are the fallbacks, tried in order when a call fails or times out,
+instead of shrinking the input (see gpt_utils.get_gpt_response).
+Titles always go to TITLE_MODEL, the cheapest and fastest one.
+Only models the backend serves are candidates: on Azure, the chat models with a deployment (see llm_utils.is_model_served).
+
+Outcomes of calls are kept per worker process (record_call). Routing decisions are printed and counted in metrics_utils.
+'''
+import statistics
+import threading
+from collections import deque
+import yaml
+from . import llm_utils, metrics_utils, style_utils, token_utils
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+MODEL = cfg["MODEL"]
+MODEL_CASCADE = cfg["MODEL_CASCADE"]
+TITLE_MODEL = cfg["TITLE_MODEL"]
+ROUTER_LONG_TEXT_MODELS = cfg["ROUTER_LONG_TEXT_MODELS"]
+ROUTER_WINDOW = cfg["ROUTER_WINDOW"]
+ROUTER_MIN_SAMPLES = cfg["ROUTER_MIN_SAMPLES"]
+ROUTER_MAX_ERROR_RATE = cfg["ROUTER_MAX_ERROR_RATE"]
+ROUTER_MAX_LATENCY_SECONDS = cfg["ROUTER_MAX_LATENCY_SECONDS"]
+
+# recent calls of this worker process, per model: (succeeded, seconds)
+recent_calls = {}
+recent_calls_lock = threading.Lock()
+
+def record_call(model, succeeded, seconds):
+    with recent_calls_lock:
+        if model not in recent_calls:
+            recent_calls[model] = deque(maxlen=ROUTER_WINDOW)
+        recent_calls[model].append((succeeded, seconds))
+
+def get_health(model):
+    '''
+    Returns (error rate, median latency of successful calls) of the recent calls of the model, or None if there are too few of them.
+    '''
+    with recent_calls_lock:
+        calls = list(recent_calls.get(model, []))
+    if len(calls) < ROUTER_MIN_SAMPLES:
+        return None
+    latencies = [seconds for succeeded, seconds in calls if succeeded]
+    error_rate = 1 - len(latencies) / len(calls)
+    return error_rate, statistics.median(latencies) if latencies else None
+
+def is_unhealthy(model):
+    health = get_health(model)
+    if health is None:
+        return False
+    error_rate, median_latency = health
+    return error_rate > ROUTER_MAX_ERROR_RATE or (median_latency is not None and median_latency > ROUTER_MAX_LATENCY_SECONDS)
+
+def fits_single_pass(model, text, prompts, max_tokens):
+    return token_utils.count_tokens(text, model) <= token_utils.get_input_budget(model, prompts, max_tokens)
+
+def route(task, text='', prompts=(), max_tokens=768, style='', preferred=None, chat_only=False):
+    '''
+    Returns the models for a call, in order: the model to call, and then its fallbacks.
+    task: what the call is for, e.g. 'summary' or 'answer' - for the log.
+    text, prompts, max_tokens: the input text, the prompts sent with it and the completion length, to route long texts.
+    preferred: the requested model; MODEL by default. The model of the style, if it has one, comes first.
+    chat_only: only chat models, for calls with a chat history.
+    '''
+    style_definition = style_utils.get_style(style) if style != '' else None
+    first = style_definition.model if style_definition is not None and style_definition.model else (preferred or MODEL)
+    candidates = [first] + [model for model in MODEL_CASCADE if model != first]
+    if chat_only:
+        candidates = [model for model in candidates if token_utils.is_chat_model(model)]
+    reason = 'style' if style_definition is not None and style_definition.model else 'default'
+    served = [model for model in candidates if llm_utils.is_model_served(model)]
+    if served and served[0] != first:
+        reason = 'unserved ' + first
+    candidates = served or candidates
+
+    unhealthy = [model for model in candidates if is_unhealthy(model)]
+    if unhealthy and len(unhealthy) < len(candidates):
+        candidates = [model for model in candidates if model not in unhealthy] + unhealthy
+        if candidates[0] != first:
+            reason = 'unhealthy ' + ', '.join(unhealthy)
+
+    if text != '' and not fits_single_pass(candidates[0], text, prompts, max_tokens):
+        long_text_model = next((model for model in ROUTER_LONG_TEXT_MODELS if model not in unhealthy and (token_utils.is_chat_model(model) or not chat_only)
+                                and llm_utils.is_model_served(model) and fits_single_pass(model, text, prompts, max_tokens)), None)
+        if long_text_model is not None:
+            candidates = [long_text_model] + [model for model in candidates if model != long_text_model]
+            reason = 'long text'
+
+    print('Routing ' + task + (' (' + style + ')' if style != '' else '') + ' to ' + candidates[0] + ': ' + reason + '. Fallbacks: ' + ', '.join(candidates[1:]))
+    metrics_utils.count('essence_route_decisions_total', task=task, model=candidates[0], reason=reason.split(' ')[0])
+    return candidates
+
+def get_fallbacks(model, chat_only=False):
+    '''
+    Returns the model followed by the models of MODEL_CASCADE to fall back to - healthy ones first.
+    For calls whose model was already routed (see route), e.g. each pass of a summary.
+    '''
+    candidates = [model] + [other for other in MODEL_CASCADE if other != model and (token_utils.is_chat_model(other) or not chat_only) and llm_utils.is_model_served(other)]
+    return candidates[:1] + sorted(candidates[1:], key=is_unhealthy)
+
+def log_fallback(task, model, next_model, error):
+    print('Falling back from ' + model + ' to ' + next_model + ' (' + task + '). Error: ', error)
+    metrics_utils.count('essence_route_fallbacks_total', task=task, model=model, fallback=next_model)
@@ -4,11 +4,13 @@ import requests, justext, trafilatura
 import uuid
 import textract
 import os
-from . import twitter_utils, scihub_utils, youtube_utils
+import html
+import subprocess
+from bs4 import BeautifulSoup
+from . import general_utils, twitter_utils, scihub_utils, youtube_utils, nlp_utils, metrics_utils
 from cachelib.file import FileSystemCache
 import yaml
 import re
-from pathlib import Path
 
 with open("server_src/config.yml", 'r') as ymlfile:
     cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
@@ -19,30 +21,46 @@ CACHE_URL_THRESHOLD = cfg["CACHE_URL_THRESHOLD"]
 MIN_SCRAPING_LENGTH = cfg["MIN_SCRAPING_LENGTH"]
 MIN_SCRAPING_LENGTH_JS = cfg["MIN_SCRAPING_LENGTH_JS"]
 
-data_path = os.path.abspath(os.path.join(str(Path(os.getcwd()).parent), 'data'))  # get absolute path to one folder up
-if os.getenv("ESSENCE_DATA_PATH"):
-    data_path = os.getenv("ESSENCE_DATA_PATH")
+data_path = general_utils.get_data_path()
 url_cache = FileSystemCache(os.path.join(data_path, 'url_cache') , threshold=CACHE_URL_THRESHOLD, default_timeout=CACHE_URL_SECONDS)
 
-def url_to_text(url: str, data_path: str) -> str:
+MIN_TITLE_LENGTH = 4
+MAX_TITLE_LENGTH = 200
+TITLE_SEPARATORS = [' | ', ' - ', ' – ', ' — ', ' :: ', ' · ']
+JUNK_TITLES = ['untitled', 'untitled document', 'home', 'homepage', 'home page', 'index', 'document', 'page', 'pdf', 'article', 'blog', 'news', 'welcome',
+               'loading...', 'just a moment...', 'access denied', 'attention required! | cloudflare', 'page not found', 'not found', 'error', 'sign in', 'log in', 'login',
+               'redirecting...', 'youtube', 'twitter']
+JUNK_TITLE_PATTERN = re.compile(r'^(?:[45]\d\d\b|microsoft (?:word|powerpoint) - )|\.(?:pdf|docx?|pptx?|tex|dvi|html?)$', re.IGNORECASE)
+
+MIN_TABLE_ROWS = 2
+MIN_TABLE_COLUMNS = 2
+MAX_TABLE_COLSPAN = 50
+MAX_TABLE_ROWSPAN = 100
+MAX_HTML_TABLES = 10
+
+def url_to_text(url: str, data_path: str, refresh=False) -> str:
     '''
         Takes a URL and data path, checks the cache, and returns the text from the URL.
-        Output: (text, original_text)
+        Output: (text, original_text, metadata), metadata is a dictionary, see get_html_metadata.
+        The metadata of a fetched text also holds its language, see nlp_utils.detect_language
+        refresh: fetch the URL even if it is cached, e.g. to check whether the page changed; the cache is updated.
     '''
     print('URL is: ' + url)
     if url.startswith('file://'):
-        return '', ''
-    if url_cache.has(url):
+        return '', '', {}
+    if not refresh and url_cache.has(url):
         print('Using cached URL...')
         elem = url_cache.get(url)
-        return elem['text'], elem['original_text']
+        return elem['text'], elem['original_text'], elem.get('metadata', {})
     else:
         print('Fresh URL fetch...')
-        text, original_text = url_to_text_mine(url, data_path)
-        elem = {'text': text, 'original_text': original_text}
+        text, original_text, metadata = url_to_text_mine(url, data_path)
+        if text != '':
+            metadata = {**metadata, 'language': nlp_utils.detect_language(text)}
+        elem = {'text': text, 'original_text': original_text, 'metadata': metadata}
         if text != '':
             url_cache.set(url, elem)
-        return text, original_text
+        return text, original_text, metadata
 
 def get_domain_name(url):
     domain = urlparse(url).netloc
@@ -62,7 +80,7 @@ def bot_complying_url(url):
 
 def url_to_text_mine(url, data_path):
     '''
-    Mines the url for text. Returns the "cleaned" text and the original text (e.g. HTML for websites).
+    Mines the url for text. Returns the "cleaned" text, the original text (e.g. HTML for websites) and the metadata of the page.
     Does some special handling for particular sites
     '''
     domain = get_domain_name(url)
@@ -72,7 +90,7 @@ def url_to_text_mine(url, data_path):
             try:           
                 tweet, replies = twitter_utils.get_thread(tweet)
                 replies_list = [tweet.data['text']] + [tweet.text for tweet in replies.data[::-1]]
-                return '(The following is mined from Twitter and may contain garbage)\n' + '\n'.join(replies_list), '\n\n'.join(replies_list)
+                return '(The following is mined from Twitter and may contain garbage)\n' + '\n'.join(replies_list), '\n\n'.join(replies_list), {}
             except Exception as e:
                 print(e)
                 print('Error with Twitter API')
@@ -81,18 +99,21 @@ def url_to_text_mine(url, data_path):
     if 'onlinelibrary.wiley.com' in domain and 'epdf' in url:
         url = url.replace('epdf', 'pdfdirect')
     if 'youtube.com' in domain or 'youtu.be' in domain:
-        return youtube_utils.get_youtube_text(url)
+        text, original_text = youtube_utils.get_youtube_text(url)
+        metadata = {'title': youtube_utils.get_youtube_title(url), 'title_source': 'oembed'} if text != '' else {}
+        return text, original_text, metadata
     '''
     Get the website using requests
     '''
     url = bot_complying_url(url)
     try:
-        response = requests.get(url, timeout=2)
+        with metrics_utils.span('fetch'):
+            response = requests.get(url, timeout=2)
         print(response.text[:100] + '...')
     except Exception as e:
         print("Timeout with requests (url_to_text): ")
         print(e)
-        return ('', '')
+        return ('', '', {})
     
     content_type = response.headers.get('content-type')
 
@@ -105,41 +126,132 @@ def url_to_text_mine(url, data_path):
     else:
         ext = ''
         print('Unknown type: {}'.format(content_type))
-        return ('', '')
+        return ('', '', {})
 
 def pdf_to_text(url, data_path, response=None, special_getter=None):
     '''
     A function to convert a PDF URL to text.
+    Returns (clean text, text, metadata), with the title of the document info as metadata, see get_pdf_metadata.
     '''
     original_url_text = ''
 
     if not special_getter:
         try:
             if response is None:
-                response = requests.get(url, timeout=2)
+                with metrics_utils.span('fetch'):
+                    response = requests.get(url, timeout=2)
             pdf_content = response.content
         except:
             print("Timeout with requests")
-            return ('', original_url_text)
+            return ('', original_url_text, {})
     else:
         try:
             pdf_content = special_getter(url)
         except:
             print("Problem with special getter")
-            return ('', original_url_text)
+            return ('', original_url_text, {})
 
     if not os.path.exists(os.path.join(data_path, 'temp')): os.makedirs(os.path.join(data_path, 'temp'))
     temp_filename = os.path.join(data_path, 'temp/' + str(uuid.uuid4()) + '.pdf')
     with open(temp_filename, 'wb') as f:
         f.write(pdf_content)
 
-    pdf_bytes = textract.process(temp_filename)
+    with metrics_utils.span('textract'):
+        pdf_bytes = textract.process(temp_filename)
 
     text = bytes_to_string(pdf_bytes)
     clean_text = clean_pdf_text(text)
 
     print('clean_text: ' + clean_text[:100] + '...')
-    return (clean_text, text)
+    return (clean_text, text, get_pdf_metadata(temp_filename))
+
+def get_pdf_metadata(filename):
+    '''
+    Reads the document info of a PDF with pdfinfo (poppler, which textract uses as well).
+    Returns {'title': ..., 'title_source': 'pdfinfo'}, or {} if there is no title.
+    '''
+    try:
+        pdfinfo = subprocess.run(['pdfinfo', filename], capture_output=True, timeout=5).stdout.decode('utf-8', errors='ignore')
+    except Exception as e:
+        print('Problem with pdfinfo: ', e)
+        return {}
+    for line in pdfinfo.split('\n'):
+        if line.startswith('Title:'):
+            title = line[len('Title:'):].strip()
+            return {'title': title, 'title_source': 'pdfinfo'} if title else {}
+    return {}
+
+def get_html_metadata(original_url_text):
+    '''
+    Returns the metadata of an HTML page: {'title': ..., 'title_source': ..., 'sitename': ...}.
+    The title is taken from trafilatura (which looks at og:title, <title>, <h1> and more), falling back to og:title and <title>.
+    '''
+    if not original_url_text:
+        return {}
+    if isinstance(original_url_text, bytes):
+        original_url_text = original_url_text.decode('utf-8', errors='ignore')
+
+    title, sitename, title_source = '', '', ''
+    try:
+        document = trafilatura.extract_metadata(original_url_text)
+        if document is not None:
+            title, sitename, title_source = document.title or '', document.sitename or '', 'trafilatura'
+    except Exception as e:
+        print('Problem with trafilatura metadata: ', e)
+
+    if not title:
+        match = re.search(r'<meta[^>]+property=["\']og:title["\'][^>]*content=["\']([^"\']*)["\']', original_url_text, re.IGNORECASE) or \
+                re.search(r'<meta[^>]+content=["\']([^"\']*)["\'][^>]*property=["\']og:title["\']', original_url_text, re.IGNORECASE)
+        title_source = 'og:title'
+        if match is None:
+            match = re.search(r'<title[^>]*>(.*?)</title>', original_url_text, re.IGNORECASE | re.DOTALL)
+            title_source = 'title'
+        if match is not None:
+            title = html.unescape(match.group(1))
+
+    title = ' '.join(title.split())
+    if not title:
+        return {}
+    return {'title': title, 'title_source': title_source, 'sitename': sitename}
+
+def strip_sitename(title, sitename):
+    '''
+    Removes the site name from the beginning or end of a title, e.g. "Some article | The Site" -> "Some article".
+    '''
+    if not sitename:
+        return title
+    for separator in TITLE_SEPARATORS:
+        if title.lower().endswith((separator + sitename).lower()):
+            return title[:-len(separator + sitename)].strip()
+        if title.lower().startswith((sitename + separator).lower()):
+            return title[len(sitename + separator):].strip()
+    return title
+
+def is_junk_title(title, url=''):
+    '''
+    Returns True if a metadata title is not worth showing: empty, generic ("Home", "Untitled"), an error page,
+    a file name, just the site's domain, or too long to be a title.
+    '''
+    if len(title) < MIN_TITLE_LENGTH or len(title) > MAX_TITLE_LENGTH:
+        return True
+    if not any(c.isalpha() for c in title):
+        return True
+    if title.lower() in JUNK_TITLES or JUNK_TITLE_PATTERN.search(title):
+        return True
+    if url and title.lower() in [get_domain_name(url).lower(), url.lower()]:
+        return True
+    return False
+
+def get_metadata_title(metadata, url=''):
+    '''
+    Returns the title from the metadata of a page (see url_to_text), or '' if there is none or it looks like junk.
+    '''
+    title = strip_sitename(metadata.get('title', ''), metadata.get('sitename', ''))
+    if is_junk_title(title, url):
+        if metadata.get('title'):
+            print('Metadata title looks like junk: ' + metadata['title'])
+        return ''
+    return title
 
 def html_quality_check(text):
     '''
@@ -172,11 +284,13 @@ def html_to_text(original_url_text, backend='trafilatura', attempt=0):
     Returns:
         text (str): the text from the URL after cleaning (using the backend)
         original_url_text (str): the text from the URL before cleaning
+        metadata (dict): see get_html_metadata
     '''
 
     ######### justext #########
     if backend == 'justext':
-        paragraphs = justext.justext(original_url_text, justext.get_stoplist("English"))
+        with metrics_utils.span('justext'):
+            paragraphs = justext.justext(original_url_text, justext.get_stoplist("English"))
         text = ''
         for paragraph in paragraphs:
             if not paragraph.is_boilerplate:
@@ -188,7 +302,8 @@ def html_to_text(original_url_text, backend='trafilatura', attempt=0):
     elif backend == 'trafilatura':
         print('original url text with trafilatura: ' + original_url_text[:100] + '...')
         try:
-            text = trafilatura.extract(original_url_text)
+            with metrics_utils.span('trafilatura'):
+                text = trafilatura.extract(original_url_text)
         except:
             print("Error occured with trafilatura extract.")
             text = ''
@@ -204,15 +319,83 @@ def html_to_text(original_url_text, backend='trafilatura', attempt=0):
     if text == '' and attempt == 0:
         if backend == 'justext':
             print('trying again with trafilatura')
-            text, original_url_text = html_to_text(original_url_text, 'trafilatura', attempt=1)
+            text, original_url_text, _ = html_to_text(original_url_text, 'trafilatura', attempt=1)
         elif backend == 'trafilatura':
             print('trying again with jusText')
-            text, original_url_text = html_to_text(original_url_text, 'justext', attempt=1)
+            text, original_url_text, _ = html_to_text(original_url_text, 'justext', attempt=1)
 
     ''' 
     Second postprocessing on text: none yet
     '''
-    return (text, original_url_text) if (text and html_quality_check(text)) else ('', original_url_text)
+    if not (text and html_quality_check(text)):
+        return ('', original_url_text, {})
+    return (text, original_url_text, get_html_metadata(original_url_text) if attempt == 0 else {})
+
+def get_cell_span(cell, attribute, max_span):
+    try:
+        return max(1, min(int(cell.get(attribute, 1)), max_span))
+    except ValueError:
+        return 1
+
+def skip_spanned_columns(row, row_spans):
+    '''
+    Adds an empty cell to the row for every column at its end that a cell of a row above spans.
+    '''
+    while len(row) in row_spans:
+        row_spans[len(row)] -= 1
+        if row_spans[len(row)] == 0:
+            del row_spans[len(row)]
+        row.append('')
+
+def html_to_tables(original_text):
+    '''
+    Extracts the data tables of an HTML page, for the tabularize style without the model (see gpt_utils.get_html_tables_output).
+    Returns a list of tables, each a list of rows, each a list of cells - as the value of a table in parse_utils.parse_gpt_response.
+    A cell spanning several columns is followed by empty cells, and a cell spanning several rows leaves empty cells in its
+    columns of the next rows, to keep the columns aligned.
+    Only tables with a header (<th> cells or a <thead>) are taken as data tables. Layout tables (with tables inside them), and
+    tables with fewer than MIN_TABLE_ROWS rows or MIN_TABLE_COLUMNS columns, are skipped.
+    '''
+    if not original_text:
+        return []
+    if isinstance(original_text, bytes):
+        original_text = original_text.decode('utf-8', errors='ignore')
+    if '<table' not in original_text.lower():
+        return []
+
+    tables = []
+    try:
+        soup = BeautifulSoup(original_text, 'html.parser')
+        for table in soup.find_all('table'):
+            if table.find('table') is not None or table.find(['th', 'thead']) is None:
+                continue
+            rows = []
+            row_spans = {}     # column: number of the next rows a cell above still spans
+            for tr in table.find_all('tr'):
+                row = []
+                for cell in tr.find_all(['th', 'td']):
+                    skip_spanned_columns(row, row_spans)
+                    row.append(' '.join(cell.get_text(' ').split()))
+                    colspan = get_cell_span(cell, 'colspan', MAX_TABLE_COLSPAN)
+                    rowspan = get_cell_span(cell, 'rowspan', MAX_TABLE_ROWSPAN)
+                    row += [''] * (colspan - 1)
+                    if rowspan > 1:
+                        for column in range(len(row) - colspan, len(row)):
+                            row_spans[column] = rowspan - 1
+                skip_spanned_columns(row, row_spans)
+                while len(row_spans) > 0 and len(row) <= max(row_spans):
+                    row.append('')
+                    skip_spanned_columns(row, row_spans)
+                if any(cell != '' for cell in row):
+                    rows.append(row)
+            if len(rows) >= MIN_TABLE_ROWS and max(len(row) for row in rows) >= MIN_TABLE_COLUMNS:
+                tables.append(rows)
+                if len(tables) == MAX_HTML_TABLES:
+                    break
+    except Exception as e:
+        print('Problem extracting HTML tables: ', e)
+        return []
+    return tables
 
 def html_url_to_text(url, response=None, backend='trafilatura', attempt=0):
     '''
@@ -225,6 +408,7 @@ def html_url_to_text(url, response=None, backend='trafilatura', attempt=0):
     Returns:
         text (str): the text from the URL after cleaning (using the backend)
         original_url_text (str): the text from the URL before cleaning
+        metadata (dict): see get_html_metadata
 
     Comments: See https://adrien.barbaresi.eu/blog/evaluating-text-extraction-python.html
               for a claim that trafilatura is better than most alternatives.
@@ -235,12 +419,14 @@ def html_url_to_text(url, response=None, backend='trafilatura', attempt=0):
     if backend == 'justext':
         try:
             if response is None:
-                response = requests.get(url, timeout=2)
+                with metrics_utils.span('fetch'):
+                    response = requests.get(url, timeout=2)
             original_url_text = response.content
         except:
             print("Timeout with requests")
-            return ('', original_url_text)
-        paragraphs = justext.justext(response.content, justext.get_stoplist("English"))
+            return ('', original_url_text, {})
+        with metrics_utils.span('justext'):
+            paragraphs = justext.justext(response.content, justext.get_stoplist("English"))
         text = ''
         for paragraph in paragraphs:
             if not paragraph.is_boilerplate:
@@ -251,14 +437,16 @@ def html_url_to_text(url, response=None, backend='trafilatura', attempt=0):
     ######### trafilatura #########
     elif backend == 'trafilatura':
         try:
-            downloaded = trafilatura.fetch_url(url)
+            with metrics_utils.span('fetch'):
+                downloaded = trafilatura.fetch_url(url)
             original_url_text = downloaded
-            text = trafilatura.extract(downloaded)
+            with metrics_utils.span('trafilatura'):
+                text = trafilatura.extract(downloaded)
         except:
             print("Timeout with trafilatura fetch_url")
             if attempt == 0:
                 return html_url_to_text(url, backend='justext', attempt=1)
-            return ('', original_url_text)
+            return ('', original_url_text, {})
     
     ######### unsupported #########
     else:
@@ -271,16 +459,18 @@ def html_url_to_text(url, response=None, backend='trafilatura', attempt=0):
     if text == '' and attempt == 0:
         if backend == 'justext':
             print('trying again with trafilatura')
-            text, original_url_text = html_url_to_text(url, 'trafilatura', attempt=1)
+            text, original_url_text, _ = html_url_to_text(url, 'trafilatura', attempt=1)
         elif backend == 'trafilatura':
             print('trying again with jusText')
-            text, original_url_text = html_url_to_text(url, 'justext', attempt=1)
+            text, original_url_text, _ = html_url_to_text(url, 'justext', attempt=1)
 
     ''' 
     Second postprocessing on text: none yet
     '''
 
-    return (text, original_url_text) if (text and html_quality_check(text)) else ('', original_url_text)
+    if not (text and html_quality_check(text)):
+        return ('', original_url_text, {})
+    return (text, original_url_text, get_html_metadata(original_url_text))
 
 def bytes_to_string(bytes):
     ''' 
@@ -5,13 +5,15 @@ from urllib.parse import urlparse
 import csv
 import os
 from typing import Type
-from . import scraping_utils, gpt_utils, export_utils, nlp_utils, notion_utils
+from . import scraping_utils, gpt_utils, export_utils, nlp_utils, notion_utils, diff_utils
 import json
 import datetime
 from sqlalchemy import and_
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 import yaml
+import queue
+from threading import Thread
 
 date_time_format = "%Y-%m-%d %H:%M:%S"
 data_path = '/data'
@@ -136,6 +138,15 @@ def expired_date(date1, date2, days=1, hours=0, minutes=0):
     delta = datetime.datetime.strptime(date1, date_time_format) - datetime.datetime.strptime(date2, date_time_format)
     return delta > datetime.timedelta(days=days, hours=hours, minutes=minutes)
 
+def get_cache_scope(message, username):
+    '''
+    Returns the scope of the completion cache for processing the message (see gpt_utils.gpt_completion):
+    processing of private input - HTML sent by the extension or marked text - is only cached for the same user.
+    '''
+    if ('web_html' in message and message['web_html'] != '') or ('is_marked_text' in message and message['is_marked_text']):
+        return username
+    return None
+
 def should_use_cached_data(message, db, app, UserQuery, user_id, days=50, hours=0, minutes=0):
     # searches in previous user queries. If previous query is found, 
     # is not older than X days, and is not marked as private or bad, 
@@ -156,7 +167,8 @@ def should_use_cached_data(message, db, app, UserQuery, user_id, days=50, hours=
             UserQuery.style_name == style,
             UserQuery.is_private == False,
             UserQuery.marked_text == '', # Currently not supporting marked_text. Since marked_text could be private information, we might only use it for a single user, therefore not a huge optimization gain.
-            UserQuery.good_bad_flag.in_([0, 1])
+            UserQuery.good_bad_flag.in_([0, 1]),
+            UserQuery.refining == False # the output of a query still being refined is partial
         ).order_by(UserQuery.date.desc()).first()
 
         if user_query is not None and not expired_date(date, user_query.date, days=days, hours=hours, minutes=minutes):
@@ -169,6 +181,7 @@ def should_use_cached_data(message, db, app, UserQuery, user_id, days=50, hours=
                 'cleaned_text': user_query.cleaned_text,
                 'from_cached_query': user_query.id,
                 'title': user_query.title,
+                'cached_date': user_query.date,
                 'status': 'SUCCESS'}
             return True, output
         else:
@@ -179,7 +192,8 @@ def should_use_cached_data(message, db, app, UserQuery, user_id, days=50, hours=
                 UserQuery.is_private == True,
                 UserQuery.user_id == user_id,
                 UserQuery.marked_text == '', # Currently not supporting marked_text. Since marked_text could be private information, we might only use it for a single user, therefore not a huge optimization gain.
-                UserQuery.good_bad_flag.in_([0, 1])
+                UserQuery.good_bad_flag.in_([0, 1]),
+                UserQuery.refining == False # the output of a query still being refined is partial
             ).order_by(UserQuery.date.desc()).first()
             if user_query is not None and not expired_date(date, user_query.date, days=days, hours=hours, minutes=minutes):
                 output = {
@@ -191,11 +205,19 @@ def should_use_cached_data(message, db, app, UserQuery, user_id, days=50, hours=
                     'cleaned_text': user_query.cleaned_text,
                     'from_cached_query': user_query.id,
                     'title': user_query.title,
+                    'cached_date': user_query.date,
                     'status': 'SUCCESS'}
                 return True, output
 
             return False, None
 
+def should_revise_cached_data(message, cached_output, hours=diff_utils.REVISE_AFTER_HOURS):
+    '''
+    Checks if the cached output of should_use_cached_data is old enough to be checked against the current page,
+    and revised if the page changed (see gpt_utils.revise_output).
+    '''
+    return expired_date(message['date'], cached_output['cached_date'], days=0, hours=hours)
+
 def print_request_info(args):
     '''
     We assume args is a dictionary.
@@ -301,21 +323,24 @@ def save_email_to_waiting_list(data_path: str, list_name: str, email: str) -> No
         writer = csv.writer(csv_file)
         writer.writerow([email, list_name, datetime.datetime.now()])
 
-def get_answer_on_url(question, url, marked_text, web_html, qa_list, data_path, username, min_marked_length=100):
+def get_answer_on_url(question, url, marked_text, web_html, qa_list, data_path, username, min_marked_length=100, stream_handler=None):
+    metadata = {}
     if marked_text and len(marked_text) > min_marked_length:
         marked_text = nlp_utils.clean_marked_text(marked_text)
         text = marked_text
         original_text = marked_text
     elif len(web_html) > 0:
         print_log("Using web html... " + web_html[:150], username, text_private="Using web html... ")
-        text, original_text = scraping_utils.html_to_text(web_html)
+        text, original_text, _ = scraping_utils.html_to_text(web_html)
     else:
-        text, original_text = scraping_utils.url_to_text(url, data_path)
+        text, original_text, metadata = scraping_utils.url_to_text(url, data_path)
     
     if text == '':
         return "Error in getting text from the page. Try marking text (possibly all of it).", {}, "No source."
-    
-    answer, model_prompt, supporting_quote = gpt_utils.qa_about_text(question, text[:MAX_CHAR_LEN_QA], url, qa_list)
+
+    # completions based on private text are only reused for the same user
+    cache_scope = username if ((marked_text and len(marked_text) > min_marked_length) or len(web_html) > 0) else None
+    answer, model_prompt, supporting_quote = gpt_utils.qa_about_text(question, text[:MAX_CHAR_LEN_QA], url, qa_list, language=metadata.get('language'), stream_handler=stream_handler, cache_scope=cache_scope)
     if answer.startswith("ERROR"):
         return answer, {}, ""
     if len(text) > MAX_CHAR_LEN_QA:
@@ -325,14 +350,52 @@ def get_answer_on_url(question, url, marked_text, web_html, qa_list, data_path,
 
     return answer, backend_answer, supporting_quote
 
-def get_answer_on_chat(question, qa_list, data_path, username):
+def get_answer_on_chat(question, qa_list, data_path, username, stream_handler=None):
     if question.startswith("/chat"):
         question = question[5:].strip()
-    answer = gpt_utils.chat_question(question, qa_list)
+    answer = gpt_utils.chat_question(question, qa_list, stream_handler=stream_handler, cache_scope=username)
     backend_answer = {'success': True} if len(answer) > 0 else {}
 
     return answer, backend_answer
 
+def run_with_event_stream(func, *args, keepalive_seconds=15, **kwargs):
+    '''
+    Runs func(*args, stream_handler=..., **kwargs) in a background thread, and yields (event_type, data) pairs 
+    as the function streams them (e.g. 'reset', 'token', 'progress').
+    The last pair is ('result', return value of func), or ('error', error message) if func raised.
+    A ('keepalive', None) pair is yielded when nothing arrived for keepalive_seconds, to keep proxies from closing the connection.
+    '''
+    events = queue.Queue()
+
+    def stream_handler(event_type, data):
+        events.put((event_type, data))
+
+    def target():
+        try:
+            events.put(('result', func(*args, stream_handler=stream_handler, **kwargs)))
+        except Exception as e:
+            print(e)
+            events.put(('error', 'ERROR: problem occured. Try again.'))
+
+    Thread(target=target, daemon=True).start()
+    while True:
+        try:
+            event_type, data = events.get(timeout=keepalive_seconds)
+        except queue.Empty:
+            yield 'keepalive', None
+            continue
+        yield event_type, data
+        if event_type in ['result', 'error']:
+            return
+
+def format_sse(event_type, data=None):
+    '''
+    Formats an event as a server-sent event. Keepalive events are sent as SSE comments.
+    '''
+    if event_type == 'keepalive':
+        return ': keepalive\n\n'
+    return 'event: ' + event_type + '\ndata: ' + json.dumps(data) + '\n\n'
+
 def save_session(data, divider_name, username, app, db, User):
     print_log("Saving session... with data: " + str(data)[:150], username, text_private="Saving session...")
     with app.app_context():
@@ -440,7 +503,8 @@ def processed_tweet_exists(tweetid, app, db, UserQuery, style):
                                             UserQuery.style_name == style,
                                             UserQuery.is_private == False,
                                             UserQuery.marked_text == '', 
-                                            UserQuery.good_bad_flag.in_([0, 1])
+                                            UserQuery.good_bad_flag.in_([0, 1]),
+                                            UserQuery.refining == False
                                             ).order_by(UserQuery.date.desc()).first()
         if user_query:
             return user_query.model_output_parsed
@@ -453,9 +517,10 @@ def print_object(obj):
     '''
     print(obj)
 
-def get_auto_title(subtitles):
+def get_auto_title(subtitles, username=None):
     '''
     Returns a unified title given several subtitles
+    username: the subtitles come from the user's queries, so the completion is cached for the user only
     '''
     eligible_subtitles = []
     for subtitle in subtitles:
@@ -468,7 +533,7 @@ def get_auto_title(subtitles):
         return eligible_subtitles[0]
     else:
         joined_titles = 'Subtitle: ' + '\nSubtitle: '.join(eligible_subtitles)
-        title = gpt_utils.get_title_for_entry('', query_to_model = "Summarize the following subtitles to something that can serve as an overall title.\nSubtitles:\n" + joined_titles + "\nTitle:")
+        title = gpt_utils.get_title_for_entry('', query_to_model = "Summarize the following subtitles to something that can serve as an overall title.\nSubtitles:\n" + joined_titles + "\nTitle:", cache_scope=username)
         return title
 
 def send_email(user_emails, subject, text):
@@ -541,6 +606,25 @@ def user_has_credits(app, user, type='process'):
                 return True
     return False
     
+def reserve_user_queries(user_id, n_queries, db, User):
+    '''
+    Takes n_queries of the remaining queries of the user up front, for a batch request. Done in a single UPDATE,
+    so that concurrent requests cannot both take the last queries. Returns False, taking nothing, if the user has fewer.
+    '''
+    n_updated = User.query.filter(User.id == user_id, User.remaining_queries >= n_queries).update(
+        {User.remaining_queries: User.remaining_queries - n_queries}, synchronize_session=False)
+    db.session.commit()
+    return n_updated == 1
+
+def refund_user_queries(user_id, n_queries, db, User):
+    '''
+    Gives back queries taken by reserve_user_queries that were not used.
+    '''
+    if n_queries <= 0:
+        return
+    User.query.filter(User.id == user_id).update({User.remaining_queries: User.remaining_queries + n_queries}, synchronize_session=False)
+    db.session.commit()
+
 def update_user_quota(username, new_queries, new_questions, code, app, db, User):
     if code != os.getenv('UPDATE_QUOTA_CODE'):
         return {"Error": "Invalid API key."}
@@ -66,6 +66,8 @@ class UserQuery(db.Model):
     user_id             = db.Column(db.String(80), db.ForeignKey('users.id'))                   # user who made the request
     style_name          = db.Column(db.String(60), db.ForeignKey('styles.code_name'))           # style of the query
     title               = db.Column(db.String(256), unique=False, nullable=True)                # model-generated title of the query
+    version             = db.Column(db.Integer, unique=False, nullable=False, default=1, server_default='1')            # incremented when the output is refined by more passes
+    refining            = db.Column(db.Boolean, unique=False, nullable=False, default=False, server_default=db.false()) # whether more passes are still running for this query (progressive /process)
     user = db.relationship('User', foreign_keys=[user_id], lazy=True)
     style = db.relationship('Style', foreign_keys=[style_name], lazy=True)
 
@@ -0,0 +1,123 @@
+'''
+Registry of the summarization styles - their prompts, examples, keywords and continuation prompts.
+
+Styles are defined in server_src/styles.yml and built once, at import, with the prompt already joined.
+Styles can be added or changed without a deploy by placing a styles.yml of the same format in the data folder.
+That file is reloaded when it changes, and its styles take precedence over the built-in ones.
+
+Token counts of the joined prompts are computed once per model, see token_utils.count_prompt_tokens.
+'''
+import os
+import threading
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+import yaml
+from . import general_utils
+
+BUILTIN_STYLES_PATH = 'server_src/styles.yml'
+VARIANT_SUFFIX = '_variant'
+
+data_path = general_utils.get_data_path()
+OVERRIDE_STYLES_PATH = os.path.join(data_path, 'styles.yml')
+
+class StyleDefinition(NamedTuple):
+    name: str
+    prompt_title: str
+    input_prompt: str
+    output_prompt: str
+    examples: tuple                             # input_prompt + text + output_prompt + output, for each example pair
+    example_pairs: tuple
+    keywords: tuple
+    continued_prompt_dict: Optional[MappingProxyType]
+    first_pass_prompt: str                      # prompt_title + examples + input_prompt, i.e. everything before the text
+    variant: Optional[str]                      # the style to use if the output seems hijacked, if exists
+    compression: Optional[str]                  # 'extractive': a text longer than a single pass is compressed to fit it, see nlp_utils.compress_text_extractive
+    model: Optional[str]                        # the model to summarize in, instead of the default one, see routing_utils.route
+    digest: bool                                # a text longer than a single pass is summarized from its digest, see gpt_utils.get_document_digest
+
+def freeze(value):
+    """Converts lists and dictionaries (from YAML) to tuples and read-only mappings."""
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    return value
+
+def build_style(name, style_dict):
+    example_pairs = freeze(style_dict.get('example_pairs') or [])
+    input_prompt = style_dict['input_prompt']
+    output_prompt = style_dict['output_prompt']
+    examples = tuple(input_prompt + example_pair[0] + output_prompt + example_pair[1] for example_pair in example_pairs)
+    continued_prompt_dict = style_dict.get('continued_prompt_dict')
+    return StyleDefinition(
+        name=name,
+        prompt_title=style_dict['prompt_title'],
+        input_prompt=input_prompt,
+        output_prompt=output_prompt,
+        examples=examples,
+        example_pairs=example_pairs,
+        keywords=freeze(style_dict.get('keywords') or []),
+        continued_prompt_dict=freeze(continued_prompt_dict) if continued_prompt_dict is not None else None,
+        first_pass_prompt=style_dict['prompt_title'] + ''.join(examples) + input_prompt,
+        variant=None,
+        compression=style_dict.get('compression'),
+        model=style_dict.get('model'),
+        digest=bool(style_dict.get('digest', False)))
+
+def load_styles_file(path):
+    with open(path, 'r') as f:
+        styles_dict = yaml.safe_load(f)['styles']
+    return {name: build_style(name, style_dict) for name, style_dict in styles_dict.items()}
+
+def link_variants(styles_by_name):
+    styles_by_name = {
+        name: style._replace(variant=name + VARIANT_SUFFIX if name + VARIANT_SUFFIX in styles_by_name else None)
+        for name, style in styles_by_name.items()}
+    return MappingProxyType(styles_by_name)
+
+builtin_styles = load_styles_file(BUILTIN_STYLES_PATH)
+styles = link_variants(builtin_styles)
+override_mtime = None
+styles_lock = threading.Lock()
+
+def refresh_styles():
+    """Reloads the styles of OVERRIDE_STYLES_PATH if the file changed since it was last loaded.
+    A file that fails to load is reported and ignored, keeping the styles loaded so far."""
+    global styles, override_mtime
+    try:
+        mtime = os.stat(OVERRIDE_STYLES_PATH).st_mtime
+    except OSError:
+        mtime = None
+    if mtime == override_mtime:
+        return
+
+    with styles_lock:
+        if mtime == override_mtime:
+            return
+        if mtime is None:
+            styles = link_variants(builtin_styles)
+        else:
+            try:
+                override_styles = load_styles_file(OVERRIDE_STYLES_PATH)
+            except Exception as e:
+                print('Could not load styles from ' + OVERRIDE_STYLES_PATH + '. Error: ', e)
+                override_mtime = mtime
+                return
+            styles = link_variants({**builtin_styles, **override_styles})
+            print('Loaded styles from ' + OVERRIDE_STYLES_PATH + ': ' + ', '.join(override_styles.keys()))
+        override_mtime = mtime
+
+def get_style(name):
+    """Returns the StyleDefinition of the style, or None if there is no such style."""
+    refresh_styles()
+    return styles.get(name)
+
+def style_exists(name):
+    return get_style(name) is not None
+
+def get_variant(name):
+    """Returns the StyleDefinition of the '_variant' of the style, or None if there is none."""
+    style = get_style(name)
+    if style is None or style.variant is None:
+        return None
+    return styles.get(style.variant)
@@ -0,0 +1,100 @@
+'''
+Local token counting, used to size model inputs before sending them to the API.
+
+We use tiktoken when it is installed. Otherwise, we fall back to a conservative characters-per-token estimate,
+so that the budget errs on the side of sending less text rather than getting declined by the API.
+'''
+from functools import lru_cache
+import yaml
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+with open("server_src/config.yml", 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
+    cfg = cfg["config"]
+
+MODEL_CONTEXT_WINDOWS = cfg["MODEL_CONTEXT_WINDOWS"]
+TOKEN_BUDGET_SAFETY_MARGIN = cfg["TOKEN_BUDGET_SAFETY_MARGIN"]
+
+DEFAULT_CONTEXT_WINDOW = 4096
+CHARS_PER_TOKEN_ESTIMATE = 3    # used without tiktoken; English is ~4 characters per token, so 3 is on the safe side
+MAX_CHARS_PER_TOKEN = 8         # upper bound on characters per token, used to avoid encoding much more text than needed
+CHAT_TOKENS_PER_MESSAGE = 4     # every chat message is wrapped with role and separator tokens
+CHAT_TOKENS_PER_REPLY = 3       # every chat reply is primed with the assistant role
+
+encodings = {}
+
+def get_encoding(model):
+    '''
+    Returns the tiktoken encoding of the model, or None if tiktoken is not installed.
+    Encodings are built once per model and reused.
+    '''
+    if tiktoken is None:
+        return None
+    if model not in encodings:
+        try:
+            encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encodings[model] = tiktoken.get_encoding('cl100k_base')
+    return encodings[model]
+
+def is_chat_model(model):
+    return model.startswith('gpt-3.5-turbo') or model.startswith('gpt-4')
+
+def get_context_window(model):
+    return MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+def count_tokens(text, model):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN_ESTIMATE)
+    return len(encoding.encode(text, disallowed_special=()))
+
+@lru_cache(maxsize=256)
+def count_prompt_tokens(prompt_text, model):
+    '''
+    count_tokens, memoized - prompts (style prompts with their examples, output prompts) repeat across calls.
+    '''
+    return count_tokens(prompt_text, model)
+
+def count_messages_tokens(messages, model):
+    '''
+    Counts the tokens of a list of chat messages of the form {"role": ..., "content": ...}, including the reply priming.
+    '''
+    n_tokens = CHAT_TOKENS_PER_REPLY
+    for message in messages:
+        n_tokens += CHAT_TOKENS_PER_MESSAGE + count_tokens(message["content"], model)
+    return n_tokens
+
+def get_input_budget(model, prompt_texts, max_tokens):
+    '''
+    Returns how many tokens of text can be added to the prompt_texts,
+    such that the prompt, the text and max_tokens of completion fit the context window of the model.
+    prompt_texts: list of strings that are sent alongside the text, e.g. prompt title + examples and output prompt
+    '''
+    n_prompt_tokens = sum(count_prompt_tokens(prompt_text, model) for prompt_text in prompt_texts)
+    if is_chat_model(model):
+        n_prompt_tokens += CHAT_TOKENS_PER_MESSAGE + CHAT_TOKENS_PER_REPLY
+    return get_context_window(model) - n_prompt_tokens - max_tokens - TOKEN_BUDGET_SAFETY_MARGIN
+
+def fit_text_to_budget(text, budget_tokens, model, initial_char_index=0):
+    '''
+    Returns the largest final_char_index such that text[initial_char_index:final_char_index] is at most budget_tokens long.
+    '''
+    if budget_tokens <= 0:
+        return initial_char_index
+    candidate = text[initial_char_index:initial_char_index + budget_tokens * MAX_CHARS_PER_TOKEN]
+
+    encoding = get_encoding(model)
+    if encoding is None:
+        return initial_char_index + min(len(candidate), budget_tokens * CHARS_PER_TOKEN_ESTIMATE)
+
+    tokens = encoding.encode(candidate, disallowed_special=())
+    if len(tokens) <= budget_tokens:
+        return initial_char_index + len(candidate)
+    # decoding a token prefix gives back a prefix of the text; a character split between tokens is dropped
+    fitted_text = encoding.decode_bytes(tokens[:budget_tokens]).decode('utf-8', errors='ignore')
+    return initial_char_index + len(fitted_text)
@@ -1,6 +1,7 @@
 from youtube_transcript_api import YouTubeTranscriptApi
 from urllib.parse import urlparse, parse_qs
 import json
+import requests
 
 def extract_video_id(url):
     video_id = None
@@ -55,3 +56,17 @@ def get_youtube_text(url):
     combined_text = combine_transcript_lines(yt_response)
 
     return combined_text, json.dumps(yt_response)
+
+def get_youtube_title(url):
+    '''
+    Returns the title of the video from YouTube's oEmbed endpoint, or '' on failure.
+    '''
+    video_id = extract_video_id(url)
+    if video_id is None:
+        return ''
+    try:
+        response = requests.get('https://www.youtube.com/oembed', params={'url': 'https://www.youtube.com/watch?v=' + video_id, 'format': 'json'}, timeout=2)
+        return response.json().get('title', '') if response.ok else ''
+    except Exception as e:
+        print('Problem getting the YouTube title: ', e)
+        return ''